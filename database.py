@@ -4,8 +4,9 @@ Database management for Worker Attendance Bot
 
 import os
 import sqlite3
+import time
 from datetime import datetime, timedelta
-from typing import Optional, List, Tuple
+from typing import Dict, Iterable, Optional, List, Tuple
 from threading import Lock
 
 _DATABASE_URL = os.getenv('DATABASE_URL', '').strip()
@@ -24,6 +25,8 @@ _pool_lock = Lock()
 def initialize_pool() -> None:
     """Initialize PostgreSQL connection pool. Call once at startup."""
     global _pg_pool
+    if not _USING_POSTGRES:
+        return
     with _pool_lock:
         if _pg_pool is not None:
             return
@@ -62,13 +65,16 @@ def close_pool():
         if _pg_pool is not None:
             _pg_pool.closeall()
             _pg_pool = None
+    with _sqlite_pool_lock:
+        while _sqlite_pool:
+            sqlite3.Connection.close(_sqlite_pool.pop())
 
 
 def get_conn():
     if _USING_POSTGRES:
         return _pg_pool.getconn()
     else:
-        return sqlite3.connect(DB_FILE)
+        return _connect()
 
 
 def release_conn(conn):
@@ -113,6 +119,11 @@ def _qmark_to_percent_s(query: str) -> str:
     return ''.join(out)
 
 
+def _is_pragma(query: str) -> bool:
+    # Only the first keyword matters; avoid upper-casing the whole statement
+    return query.lstrip()[:6].upper() == 'PRAGMA'
+
+
 class _PgCompatCursor:
     def __init__(self, cur):
         self._cur = cur
@@ -124,7 +135,7 @@ class _PgCompatCursor:
 
     def execute(self, query, params=None):
         q = str(query)
-        if q.strip().upper().startswith('PRAGMA'):
+        if _is_pragma(q):
             return None
         q = _qmark_to_percent_s(q)
         if params is None:
@@ -133,7 +144,7 @@ class _PgCompatCursor:
 
     def executemany(self, query, params_seq):
         q = str(query)
-        if q.strip().upper().startswith('PRAGMA'):
+        if _is_pragma(q):
             return None
         q = _qmark_to_percent_s(q)
         return self._cur.executemany(q, params_seq)
@@ -192,6 +203,60 @@ if _USING_POSTGRES:
 
 DB_FILE = 'attendance.db'
 _db_lock = Lock()
+# Qısa saxlanılır: bir çox yazı hələ də event loop-dan birbaşa çağırılır və kilid gözləməsi bütün botu dayandırır
+_SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+_SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+_sqlite_pool: List["_PooledSqliteConnection"] = []
+_sqlite_pool_lock = Lock()
+
+
+class _PooledSqliteConnection(sqlite3.Connection):
+    """SQLite connection whose close() returns it to the in-process pool instead of closing the file."""
+
+    _checked_out = False
+
+    def close(self):
+        if not self._checked_out:
+            return
+        self._checked_out = False
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = None
+        with _sqlite_pool_lock:
+            if len(_sqlite_pool) < _SQLITE_POOL_SIZE:
+                _sqlite_pool.append(self)
+                return
+        super().close()
+
+
+def _configure(conn: sqlite3.Connection) -> None:
+    """Yeni SQLite bağlantısına PRAGMA-ları tətbiq edir (bağlantı başına bir dəfə)."""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={_SQLITE_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+
+def _connect():
+    """Get a DB connection. SQLite connections are pooled, run in WAL mode and wait on locks instead of raising."""
+    if _USING_POSTGRES:
+        return sqlite3.connect(DB_FILE)
+    with _sqlite_pool_lock:
+        conn = _sqlite_pool.pop() if _sqlite_pool else None
+    if conn is None:
+        # PRAGMA-lar bağlantı başına bir dəfə işləyir; connection thread-lər arasında ötürülə bilər.
+        # IMMEDIATE: yazı kilidi tranzaksiyanın əvvəlində alınır (busy_timeout ilə gözlənilir),
+        # ilk UPDATE-də DEFERRED -> RESERVED keçidində BUSY xətası yaranmır.
+        conn = sqlite3.connect(
+            DB_FILE,
+            factory=_PooledSqliteConnection,
+            check_same_thread=False,
+            isolation_level='IMMEDIATE',
+        )
+        _configure(conn)
+    conn._checked_out = True
+    return conn
 
 GROUP_CODE_NO_EXPIRY_DATE = os.getenv('GROUP_CODE_NO_EXPIRY_DATE', '9999-12-31')
 
@@ -199,7 +264,7 @@ GROUP_CODE_NO_EXPIRY_DATE = os.getenv('GROUP_CODE_NO_EXPIRY_DATE', '9999-12-31')
 def init_db():
     """Initialize database with required tables"""
     if _USING_POSTGRES:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
 
         cursor.execute(
@@ -246,6 +311,7 @@ def init_db():
 
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_code ON users(code)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_fin_upper ON users(UPPER(fin))')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, date)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_date ON attendance(date)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_codes_expires ON codes(expires_at)')
@@ -255,15 +321,10 @@ def init_db():
         conn.close()
         return
 
-    conn = sqlite3.connect(DB_FILE)
+    # WAL/synchronous/temp_store _connect()-da hər bağlantıya tətbiq olunur
+    conn = _connect()
     cursor = conn.cursor()
 
-    # Enable WAL mode for better concurrency
-    cursor.execute('PRAGMA journal_mode=WAL')
-    cursor.execute('PRAGMA synchronous=NORMAL')
-    cursor.execute('PRAGMA cache_size=10000')
-    cursor.execute('PRAGMA temp_store=MEMORY')
-
     # Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -323,6 +384,7 @@ def init_db():
     # Create indexes for faster queries
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_code ON users(code)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_fin_upper ON users(UPPER(fin))')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, date)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_date ON attendance(date)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_codes_expires ON codes(expires_at)')
@@ -336,7 +398,7 @@ def init_db():
 def add_code(code: str, days_valid: int = 30) -> bool:
     """Add a new access code"""
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         expires_at = datetime.now() + timedelta(days=days_valid)
         cursor.execute(
@@ -352,7 +414,7 @@ def add_code(code: str, days_valid: int = 30) -> bool:
 
 def remove_code(code: str) -> bool:
     """Remove an access code"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM codes WHERE code = ?', (code,))
     affected = cursor.rowcount
@@ -363,7 +425,7 @@ def remove_code(code: str) -> bool:
 
 def is_code_valid(code: str) -> bool:
     """Check if code exists and is not expired"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT COUNT(*) FROM codes WHERE code = ? AND expires_at > ?',
@@ -376,7 +438,7 @@ def is_code_valid(code: str) -> bool:
 
 def get_all_codes() -> List[Tuple]:
     """Get all active codes"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT code, created_at, expires_at FROM codes WHERE expires_at > ? ORDER BY created_at DESC',
@@ -391,7 +453,7 @@ def get_all_codes() -> List[Tuple]:
 def register_user(telegram_id: int, name: str, fin: str, seriya: str, code: str) -> bool:
     """Register a new user"""
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         # is_active defaults to TRUE/1 in schema, no need to specify
         cursor.execute(
@@ -400,6 +462,7 @@ def register_user(telegram_id: int, name: str, fin: str, seriya: str, code: str)
         )
         conn.commit()
         conn.close()
+        _invalidate_profile(telegram_id)
         return True
     except sqlite3.IntegrityError:
         return False
@@ -407,7 +470,7 @@ def register_user(telegram_id: int, name: str, fin: str, seriya: str, code: str)
 
 def get_user_by_telegram_id(telegram_id: int) -> Optional[dict]:
     """Get user by telegram ID"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT id, telegram_id, name, fin, seriya, code, phone_number, is_active FROM users WHERE telegram_id = ?',
@@ -415,29 +478,73 @@ def get_user_by_telegram_id(telegram_id: int) -> Optional[dict]:
     )
     row = cursor.fetchone()
     conn.close()
+    return _user_row_dict(row) if row else None
+
+
+def get_user_by_fin(fin: str) -> Optional[dict]:
+    """Get user by FIN (case-insensitive, uses idx_users_fin_upper)."""
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT id, telegram_id, name, fin, seriya, code, phone_number, is_active FROM users '
+        'WHERE UPPER(fin) = ? ORDER BY id LIMIT 1',
+        (fin.upper(),)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return _user_row_dict(row) if row else None
+
 
-    if row:
-        # Normalize is_active to Python bool (Postgres returns bool, SQLite returns 0/1)
-        is_active_val = row[7] if len(row) > 7 else True
-        if isinstance(is_active_val, int):
-            is_active_val = bool(is_active_val)
-        return {
-            'id': row[0],
-            'telegram_id': row[1],
-            'name': row[2],
-            'fin': row[3],
-            'seriya': row[4],
-            'code': row[5],
-            'phone_number': row[6] if len(row) > 6 else None,
-            'is_active': is_active_val
-        }
-    return None
-
-
-def upsert_user_profile(telegram_id: int, name: str, fin: str, code: str, seriya: str = "", phone_number: str = "") -> None:
-    """Insert or update user profile by telegram_id. 'seriya' and 'phone_number' are optional."""
+def _user_row_dict(row) -> dict:
+    # Normalize is_active to Python bool (Postgres returns bool, SQLite returns 0/1)
+    is_active_val = row[7] if len(row) > 7 else True
+    if isinstance(is_active_val, int):
+        is_active_val = bool(is_active_val)
+    return {
+        'id': row[0],
+        'telegram_id': row[1],
+        'name': row[2],
+        'fin': row[3],
+        'seriya': row[4],
+        'code': row[5],
+        'phone_number': row[6] if len(row) > 6 else None,
+        'is_active': is_active_val
+    }
+
+
+# Profil keşi: telegram_id -> (vaxt, profil). Giriş/Çıxış/lokasiya hər mesajda profili oxuyur;
+# users cədvəlini dəyişən hər funksiya keşi təmizləyir.
+_PROFILE_TTL = 60.0
+_PROFILE_CACHE_MAX = 10_000
+_profile_cache: dict = {}
+
+
+def _invalidate_profile(telegram_id: Optional[int] = None) -> None:
+    """Drop one cached profile, or all of them when telegram_id is None."""
+    if telegram_id is None:
+        _profile_cache.clear()
+    else:
+        _profile_cache.pop(telegram_id, None)
+
+
+def get_user_cached(telegram_id: int) -> Optional[dict]:
+    """get_user_by_telegram_id with a short in-process TTL cache. Returns a copy."""
+    now = time.monotonic()
+    hit = _profile_cache.get(telegram_id)
+    if hit is not None and now - hit[0] < _PROFILE_TTL:
+        prof = hit[1]
+    else:
+        prof = get_user_by_telegram_id(telegram_id)
+        if len(_profile_cache) >= _PROFILE_CACHE_MAX:
+            _profile_cache.clear()
+        _profile_cache[telegram_id] = (now, prof)
+    return dict(prof) if prof else None
+
+
+def upsert_user_profile(telegram_id: int, name: str, fin: str, code: str, seriya: str = "", phone_number: str = "") -> int:
+    """Insert or update user profile by telegram_id and return users.id. 'seriya' and 'phone_number' are optional."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         if _USING_POSTGRES:
             cursor.execute(
@@ -448,9 +555,11 @@ def upsert_user_profile(telegram_id: int, name: str, fin: str, code: str, seriya
                 'fin = EXCLUDED.fin, '
                 'seriya = EXCLUDED.seriya, '
                 'code = EXCLUDED.code, '
-                'phone_number = EXCLUDED.phone_number',
+                'phone_number = EXCLUDED.phone_number '
+                'RETURNING id',
                 (telegram_id, name, fin, seriya, code, phone_number)
             )
+            user_id = cursor.fetchone()[0]
         else:
             # Try insert first (is_active defaults to TRUE/1 in schema)
             try:
@@ -458,6 +567,7 @@ def upsert_user_profile(telegram_id: int, name: str, fin: str, code: str, seriya
                     'INSERT INTO users (telegram_id, name, fin, seriya, code, phone_number) VALUES (?, ?, ?, ?, ?, ?)',
                     (telegram_id, name, fin, seriya, code, phone_number)
                 )
+                user_id = cursor.lastrowid
             except sqlite3.IntegrityError:
                 conn.rollback()
                 # Update existing (don't touch is_active on profile update)
@@ -465,13 +575,17 @@ def upsert_user_profile(telegram_id: int, name: str, fin: str, code: str, seriya
                     'UPDATE users SET name = ?, fin = ?, seriya = ?, code = ?, phone_number = ? WHERE telegram_id = ?',
                     (name, fin, seriya, code, phone_number, telegram_id)
                 )
+                cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
+                user_id = cursor.fetchone()[0]
         conn.commit()
         conn.close()
+        _invalidate_profile(telegram_id)
+        return user_id
 
 
 def get_all_users() -> List[dict]:
     """Get all users"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute('SELECT telegram_id, name FROM users')
     users = [{'telegram_id': row[0], 'name': row[1]} for row in cursor.fetchall()]
@@ -482,7 +596,7 @@ def get_all_users() -> List[dict]:
 # Attendance functions
 def record_giris(user_id: int, date: str, time: str, location: Optional[str] = None) -> bool:
     """Record check-in"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
 
     try:
@@ -506,7 +620,7 @@ def record_giris(user_id: int, date: str, time: str, location: Optional[str] = N
 
 def record_cixis(user_id: int, date: str, time: str, location: Optional[str] = None) -> bool:
     """Record check-out"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
 
     # Try to update existing record
@@ -531,9 +645,49 @@ def record_cixis(user_id: int, date: str, time: str, location: Optional[str] = N
     return True
 
 
+# Sabit SQL mətnləri: pool-dakı bağlantının statement cache-i eyni sətri yenidən parse etmir
+_ATTENDANCE_LOC_UPDATE = {
+    "giris": 'UPDATE attendance SET giris_loc = ? WHERE user_id = ? AND date = ?',
+    "cixis": 'UPDATE attendance SET cixis_loc = ? WHERE user_id = ? AND date = ?',
+}
+
+
+def update_attendance_address(user_id: int, date: str, kind: str, address: str) -> bool:
+    """Set the resolved address of a check-in (kind="giris") or check-out (kind="cixis")."""
+    sql = _ATTENDANCE_LOC_UPDATE[kind]
+    with _db_lock:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute(sql, (address, user_id, date))
+        updated = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+    return updated
+
+
+def update_attendance_addresses(rows: Iterable[Tuple[int, str, str, str]]) -> int:
+    """Batch form of update_attendance_address: (user_id, date, kind, address) rows, one transaction.
+    Returns the number of rows updated."""
+    by_sql: Dict[str, List[Tuple[str, int, str]]] = {}
+    for user_id, date, kind, address in rows:
+        by_sql.setdefault(_ATTENDANCE_LOC_UPDATE[kind], []).append((address, user_id, date))
+    if not by_sql:
+        return 0
+    updated = 0
+    with _db_lock:
+        conn = _connect()
+        cursor = conn.cursor()
+        for sql, params in by_sql.items():
+            cursor.executemany(sql, params)
+            updated += max(cursor.rowcount, 0)
+        conn.commit()
+        conn.close()
+    return updated
+
+
 def has_giris_today(user_id: int, date: str) -> bool:
     """Check if user has already checked in today"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT giris_time FROM attendance WHERE user_id = ? AND date = ?',
@@ -546,7 +700,7 @@ def has_giris_today(user_id: int, date: str) -> bool:
 
 def has_cixis_today(user_id: int, date: str) -> bool:
     """Check if user has already checked out today"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT cixis_time FROM attendance WHERE user_id = ? AND date = ?',
@@ -559,7 +713,7 @@ def has_cixis_today(user_id: int, date: str) -> bool:
 
 def get_attendance_report(code: str, start_date: str, end_date: str) -> List[dict]:
     """Get attendance report for specific code and date range"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -591,7 +745,7 @@ def get_attendance_report(code: str, start_date: str, end_date: str) -> List[dic
 
 def get_all_attendance_report(start_date: str, end_date: str) -> List[dict]:
     """Get attendance report for all users"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -623,7 +777,7 @@ def get_all_attendance_report(start_date: str, end_date: str) -> List[dict]:
 
 def get_all_workers_status(code: Optional[str] = None) -> List[dict]:
     """Get all workers with their latest check-in/out status"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
@@ -662,11 +816,41 @@ def get_all_workers_status(code: Optional[str] = None) -> List[dict]:
     return results
 
 
-def get_attendance_logs(date: Optional[str] = None, profession: Optional[str] = None, code: Optional[str] = None) -> List[dict]:
+def get_workers_status_by_codes(codes: List[str]) -> List[dict]:
+    """Same rows as get_all_workers_status(), limited to users whose code is in `codes`."""
+    if not codes:
+        return []
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(codes))
+    cursor.execute(f'''
+        SELECT 
+            u.telegram_id,
+            u.name,
+            u.fin,
+            u.code,
+            u.registered_at,
+            (SELECT date FROM attendance WHERE user_id = u.id ORDER BY date DESC LIMIT 1) as last_date,
+            (SELECT giris_time FROM attendance WHERE user_id = u.id ORDER BY date DESC LIMIT 1) as last_giris,
+            (SELECT cixis_time FROM attendance WHERE user_id = u.id ORDER BY date DESC LIMIT 1) as last_cixis
+        FROM users u
+        WHERE u.code IN ({placeholders})
+        ORDER BY u.code, u.name
+    ''', tuple(codes))
+
+    results = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return results
+
+
+def get_attendance_logs(date: Optional[str] = None, profession: Optional[str] = None, code: Optional[str] = None,
+                        limit: Optional[int] = None) -> List[dict]:
     """Return entrance/exit logs with locations, optionally filtered by date, profession, code.
     Profession is resolved from registrations table by matching user_id and date.
+    'limit' caps the number of rows returned (applied in SQL).
     """
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     base = (
@@ -693,6 +877,9 @@ def get_attendance_logs(date: Optional[str] = None, profession: Optional[str] =
     if conds:
         base += ' WHERE ' + ' AND '.join(conds)
     base += ' ORDER BY a.date DESC, r.profession, u.name'
+    if limit:
+        base += ' LIMIT ?'
+        params.append(int(limit))
     cursor.execute(base, tuple(params))
     rows = [dict(r) for r in cursor.fetchall()]
     conn.close()
@@ -703,7 +890,7 @@ def get_attendance_logs(date: Optional[str] = None, profession: Optional[str] =
 
 def init_registrations() -> None:
     """Create table for per-day registrations to prevent duplicates and for admin listing."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     if _USING_POSTGRES:
         cursor.execute(
@@ -741,7 +928,7 @@ def init_registrations() -> None:
 
 
 def has_registration(user_id: int, date: str, profession: str, code: str) -> bool:
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT 1 FROM registrations WHERE user_id = ? AND date = ? AND profession = ? AND code = ? LIMIT 1',
@@ -753,23 +940,34 @@ def has_registration(user_id: int, date: str, profession: str, code: str) -> boo
 
 
 def add_registration(user_id: int, date: str, profession: str, code: str) -> bool:
+    """Insert a registration; return False if the same one already exists (no separate lookup needed)."""
+    conn = _connect()
+    cursor = conn.cursor()
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO registrations (user_id, date, profession, code) VALUES (?, ?, ?, ?)',
-            (user_id, date, profession, code)
-        )
+        if _USING_POSTGRES:
+            cursor.execute(
+                'INSERT INTO registrations (user_id, date, profession, code) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (user_id, date, code, profession) DO NOTHING',
+                (user_id, date, profession, code)
+            )
+        else:
+            cursor.execute(
+                'INSERT OR IGNORE INTO registrations (user_id, date, profession, code) VALUES (?, ?, ?, ?)',
+                (user_id, date, profession, code)
+            )
+        inserted = cursor.rowcount > 0
         conn.commit()
-        conn.close()
-        return True
+        return inserted
     except sqlite3.IntegrityError:
+        conn.rollback()
         return False
+    finally:
+        conn.close()
 
 
 def get_registrations_summary(date: str) -> List[dict]:
     """Return counts of registrations grouped by profession+code for a specific date."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     cursor.execute(
@@ -785,7 +983,7 @@ def get_registrations_summary(date: str) -> List[dict]:
 
 
 def get_registrations(date: Optional[str] = None, profession: Optional[str] = None, code: Optional[str] = None) -> List[dict]:
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     query = (
@@ -814,7 +1012,7 @@ def get_registrations(date: Optional[str] = None, profession: Optional[str] = No
 
 def get_last_registration_date(user_id: int) -> Optional[str]:
     """Get the date of the last registration for a user. Returns None if no registration exists."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT date FROM registrations WHERE user_id = ? ORDER BY date DESC LIMIT 1',
@@ -830,10 +1028,9 @@ def get_last_registration_date(user_id: int) -> Optional[str]:
 def init_group_codes() -> None:
     """Create table for daily group codes: profession, date, code, is_active."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn = _connect()
         try:
             cursor = conn.cursor()
-            cursor.execute('PRAGMA busy_timeout=5000')
 
             # Migrate old schema that enforced UNIQUE(profession, date) to allow multiple codes
             # per profession per day (UNIQUE(profession, date, code)).
@@ -937,10 +1134,9 @@ def add_group_code(profession: str, date: str, code: str, is_active: int = 1, ex
         expires_at = GROUP_CODE_NO_EXPIRY_DATE
     with _db_lock:
         try:
-            conn = sqlite3.connect(DB_FILE, timeout=10)
+            conn = _connect()
             try:
                 cursor = conn.cursor()
-                cursor.execute('PRAGMA busy_timeout=5000')
                 # Try insert; if exists, update active flag for the same (profession,date,code)
                 cursor.execute(
                     'INSERT INTO group_codes (profession, date, code, expires_at, is_active) VALUES (?, ?, ?, ?, ?)',
@@ -952,10 +1148,9 @@ def add_group_code(profession: str, date: str, code: str, is_active: int = 1, ex
                 conn.close()
         except sqlite3.IntegrityError:
             # Update existing row for the same (profession,date,code)
-            conn = sqlite3.connect(DB_FILE, timeout=10)
+            conn = _connect()
             try:
                 cursor = conn.cursor()
-                cursor.execute('PRAGMA busy_timeout=5000')
                 cursor.execute(
                     'UPDATE group_codes SET is_active = ?, expires_at = ? WHERE profession = ? AND date = ? AND code = ?',
                     ((bool(is_active) if _USING_POSTGRES else (1 if is_active else 0)), expires_at, profession, date, code)
@@ -969,10 +1164,9 @@ def add_group_code(profession: str, date: str, code: str, is_active: int = 1, ex
 def set_group_code_active(profession: str, date: str, code: str, is_active: int) -> bool:
     """Toggle active flag. Returns True if a row was affected."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn = _connect()
         try:
             cursor = conn.cursor()
-            cursor.execute('PRAGMA busy_timeout=5000')
             cursor.execute(
                 'UPDATE group_codes SET is_active = ? WHERE profession = ? AND date = ? AND code = ?',
                 ((bool(is_active) if _USING_POSTGRES else (1 if is_active else 0)), profession, date, code)
@@ -987,10 +1181,9 @@ def set_group_code_active(profession: str, date: str, code: str, is_active: int)
 def delete_group_code(profession: str, date: str, code: str) -> bool:
     """Delete a specific group code for a given profession and date."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn = _connect()
         try:
             cursor = conn.cursor()
-            cursor.execute('PRAGMA busy_timeout=5000')
             cursor.execute(
                 'DELETE FROM group_codes WHERE profession = ? AND date = ? AND code = ?',
                 (profession, date, code)
@@ -1005,11 +1198,10 @@ def delete_group_code(profession: str, date: str, code: str) -> bool:
 def get_group_codes(date: Optional[str] = None, only_active: Optional[bool] = None, active_on: Optional[str] = None) -> List[dict]:
     """List group codes optionally filtered by date and active flag."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn = _connect()
         conn.row_factory = sqlite3.Row
         try:
             cursor = conn.cursor()
-            cursor.execute('PRAGMA busy_timeout=5000')
             query = 'SELECT profession, date, code, expires_at, is_active FROM group_codes'
             params: list = []
             conds: list[str] = []
@@ -1041,10 +1233,9 @@ def get_group_codes(date: Optional[str] = None, only_active: Optional[bool] = No
 def get_codes_for(profession: str, date: Optional[str] = None, only_active: bool = True) -> List[str]:
     """List codes for a profession, optionally filtered by date, optionally only active."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn = _connect()
         try:
             cursor = conn.cursor()
-            cursor.execute('PRAGMA busy_timeout=5000')
             query = 'SELECT code FROM group_codes WHERE profession = ?'
             params: list = [profession]
             if date is not None:
@@ -1076,10 +1267,9 @@ def is_group_code_valid(profession: str, code: str, on_date: Optional[str] = Non
     if on_date is None:
         on_date = datetime.now().date().isoformat()
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, timeout=10)
+        conn = _connect()
         try:
             cursor = conn.cursor()
-            cursor.execute('PRAGMA busy_timeout=5000')
             expires_cond = '(expires_at >= ? OR expires_at IS NULL)' if _USING_POSTGRES else "(expires_at >= ? OR expires_at IS NULL OR expires_at = '')"
             cursor.execute(
                 'SELECT 1 FROM group_codes WHERE profession = ? AND code = ? AND date <= ? AND {expires_cond} AND is_active = {active} LIMIT 1'.format(
@@ -1097,7 +1287,7 @@ def is_group_code_valid(profession: str, code: str, on_date: Optional[str] = Non
 
 def init_gps_tables():
     """Initialize additional tables for GPS-based sessions (non-breaking)."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     # users2: minimal profile for GPS flow
     if _USING_POSTGRES:
@@ -1165,7 +1355,7 @@ def init_gps_tables():
 def get_or_create_user2(telegram_id: int, full_name: str) -> int:
     """Return users2.id for given telegram_id; create if not exists."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         cursor.execute('SELECT id FROM users2 WHERE telegram_id = ?', (telegram_id,))
         row = cursor.fetchone()
@@ -1186,7 +1376,7 @@ def get_or_create_user2(telegram_id: int, full_name: str) -> int:
 def create_session(user_id: int, start_time: str, lat: float, lon: float) -> int:
     """Create a new open session and return its id."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         if _USING_POSTGRES:
             cursor.execute(
@@ -1207,7 +1397,7 @@ def create_session(user_id: int, start_time: str, lat: float, lon: float) -> int
 
 def get_open_session(user_id: int):
     """Get the latest open session (end_time IS NULL) for a user."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     cursor.execute(
@@ -1225,7 +1415,7 @@ def delete_user_all(telegram_id: int) -> bool:
     """
     affected = 0
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         # Legacy users -> attendance, registrations
         cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
@@ -1249,13 +1439,14 @@ def delete_user_all(telegram_id: int) -> bool:
             affected += cursor.rowcount
         conn.commit()
         conn.close()
+    _invalidate_profile(telegram_id)
     return affected > 0
 
 
 def close_session(session_id: int, end_time: str, end_lat: float, end_lon: float, duration_min: int, distance_m: float) -> None:
     """Close a session with checkout data and computed metrics."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         cursor.execute(
             '''
@@ -1272,7 +1463,7 @@ def close_session(session_id: int, end_time: str, end_lat: float, end_lon: float
 def get_today_sessions(today_iso_date: str):
     """Return today's GPS sessions joined with users2 and users to get registered name.
     today_iso_date format: YYYY-MM-DD"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     if _USING_POSTGRES:
@@ -1310,7 +1501,7 @@ def get_today_sessions(today_iso_date: str):
 
 def get_user_session_on_date(user_id: int, iso_date: str):
     """Return the most recent session for a user on a given ISO date (YYYY-MM-DD), if any."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     if _USING_POSTGRES:
@@ -1338,9 +1529,116 @@ def get_user_session_on_date(user_id: int, iso_date: str):
     return dict(row) if row else None
 
 
+def get_session_user_ids_on_date(iso_date: str) -> List[int]:
+    """Return user ids (users2) that have at least one session started on the given ISO date."""
+    conn = _connect()
+    cursor = conn.cursor()
+    if _USING_POSTGRES:
+        cursor.execute(
+            'SELECT DISTINCT user_id FROM sessions WHERE start_time::date = ?::date',
+            (iso_date,)
+        )
+    else:
+        cursor.execute(
+            'SELECT DISTINCT user_id FROM sessions WHERE substr(start_time, 1, 10) = ?',
+            (iso_date,)
+        )
+    ids = [int(r[0]) for r in cursor.fetchall()]
+    conn.close()
+    return ids
+
+
+# === Geocoding cache (persistent, shared by sync reports and async handlers) ===
+
+def _geo_key(lat: float, lon: float) -> Tuple[int, int]:
+    """Koordinatları ~11m-lik şəbəkəyə yuvarlaqlaşdırır (4 onluq rəqəm)."""
+    return (round(lat * 1e4), round(lon * 1e4))
+
+
+def init_geocode_cache() -> None:
+    """Create geocode_cache table: reverse geocoding results keyed by rounded (lat, lon)."""
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            lat_e4 INTEGER NOT NULL,
+            lon_e4 INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (lat_e4, lon_e4)
+        )
+        '''
+    )
+    conn.commit()
+    conn.close()
+
+
+def get_geocode(lat: float, lon: float) -> Optional[str]:
+    """Return cached address for coordinates, or None."""
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT address FROM geocode_cache WHERE lat_e4 = ? AND lon_e4 = ?',
+        _geo_key(lat, lon)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def get_geocodes(coords: List[Tuple[float, float]]) -> dict:
+    """Bulk lookup. Returns {(lat, lon): address} for the cached subset of coords."""
+    by_key: dict = {}
+    for lat, lon in coords:
+        by_key.setdefault(_geo_key(lat, lon), []).append((lat, lon))
+    keys = list(by_key)
+    if not keys:
+        return {}
+    found: dict = {}
+    conn = _connect()
+    cursor = conn.cursor()
+    # SQLite parametr limitinə düşməmək üçün hissə-hissə
+    for i in range(0, len(keys), 400):
+        chunk = keys[i:i + 400]
+        values = ", ".join(["(?, ?)"] * len(chunk))
+        cursor.execute(
+            f'SELECT lat_e4, lon_e4, address FROM geocode_cache WHERE (lat_e4, lon_e4) IN (VALUES {values})',
+            tuple(v for key in chunk for v in key)
+        )
+        for lat_e4, lon_e4, address in cursor.fetchall():
+            for coord in by_key.get((lat_e4, lon_e4), ()):
+                found[coord] = address
+    conn.close()
+    return found
+
+
+def put_geocode(lat: float, lon: float, address: str) -> None:
+    """Store (or refresh) an address for coordinates."""
+    lat_e4, lon_e4 = _geo_key(lat, lon)
+    with _db_lock:
+        conn = _connect()
+        cursor = conn.cursor()
+        if _USING_POSTGRES:
+            cursor.execute(
+                '''
+                INSERT INTO geocode_cache (lat_e4, lon_e4, address, ts) VALUES (?, ?, ?, ?)
+                ON CONFLICT (lat_e4, lon_e4) DO UPDATE SET address = EXCLUDED.address, ts = EXCLUDED.ts
+                ''',
+                (lat_e4, lon_e4, address, int(time.time()))
+            )
+        else:
+            cursor.execute(
+                'INSERT OR REPLACE INTO geocode_cache (lat_e4, lon_e4, address, ts) VALUES (?, ?, ?, ?)',
+                (lat_e4, lon_e4, address, int(time.time()))
+            )
+        conn.commit()
+        conn.close()
+
+
 def get_todays_attendance(today: str) -> List[dict]:
     """Get today's attendance for all workers"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -1362,22 +1660,25 @@ def get_todays_attendance(today: str) -> List[dict]:
     return results
 
 
-def get_daily_report_for_excel(date: str) -> List[dict]:
+def get_daily_report_for_excel(date: str, code: Optional[str] = None) -> List[dict]:
     """Get daily report with all users and their attendance for Excel export.
     Includes all users, even if they didn't check in/out.
     Returns list of dicts with: name, fin, code, giris_time, cixis_time, profession, giris_loc, cixis_loc
     Profession is taken from today's registration, or latest registration if today's doesn't exist.
     GPS sessions are used to get location coordinates, then reverse geocoded to addresses.
+    If code is given, only users of that group are returned.
     """
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
     # Get all users with their attendance for the date, including users without attendance
     # For profession: first try today's registration, if not found, get the latest registration
     # Also get GPS session coordinates for location
+    code_filter = "AND u.code = ?" if code else ""
+    params = (date, date, date, date, *((code,) if code else ()))
     if _USING_POSTGRES:
-        cursor.execute('''
+        cursor.execute(f'''
             SELECT 
                 u.id,
                 u.telegram_id,
@@ -1408,11 +1709,11 @@ def get_daily_report_for_excel(date: str) -> List[dict]:
             LEFT JOIN registrations r_today ON r_today.user_id = u.id AND r_today.date = ?::date
             LEFT JOIN users2 u2 ON u.telegram_id = u2.telegram_id
             LEFT JOIN sessions s ON s.user_id = u2.id AND s.start_time::date = ?::date
-            WHERE (u.registered_at IS NULL OR u.registered_at::date <= ?::date)
+            WHERE (u.registered_at IS NULL OR u.registered_at::date <= ?::date) {code_filter}
             ORDER BY u.code, u.name
-        ''', (date, date, date, date))
+        ''', params)
     else:
-        cursor.execute('''
+        cursor.execute(f'''
             SELECT 
                 u.id,
                 u.telegram_id,
@@ -1443,63 +1744,162 @@ def get_daily_report_for_excel(date: str) -> List[dict]:
             LEFT JOIN registrations r_today ON r_today.user_id = u.id AND r_today.date = ?
             LEFT JOIN users2 u2 ON u.telegram_id = u2.telegram_id
             LEFT JOIN sessions s ON s.user_id = u2.id AND substr(s.start_time, 1, 10) = ?
-            WHERE (u.registered_at IS NULL OR date(u.registered_at) <= date(?))
+            WHERE (u.registered_at IS NULL OR date(u.registered_at) <= date(?)) {code_filter}
             ORDER BY u.code, u.name
-        ''', (date, date, date, date))
+        ''', params)
     
-    results = []
-    for row in cursor.fetchall():
-        row_dict = dict(row)
-        # Convert empty strings back to None for easier checking in Python
-        if row_dict.get('giris_time') == '':
-            row_dict['giris_time'] = None
-        if row_dict.get('cixis_time') == '':
-            row_dict['cixis_time'] = None
-        if row_dict.get('giris_loc') == '':
-            row_dict['giris_loc'] = None
-        if row_dict.get('cixis_loc') == '':
-            row_dict['cixis_loc'] = None
-        # Set defaults for missing fields
-        if 'seriya' not in row_dict:
-            row_dict['seriya'] = None
-        if 'phone_number' not in row_dict:
-            row_dict['phone_number'] = None
-        if 'is_active' not in row_dict:
-            row_dict['is_active'] = 1
-        results.append(row_dict)
+    results = [_report_row_dict(row) for row in cursor.fetchall()]
     
     conn.close()
     return results
 
 
-def get_period_report_for_excel(start_date: str, end_date: str, code: Optional[str] = None) -> List[dict]:
-    """Get report for date range, optionally filtered by code. Returns all users with attendance in period."""
-    conn = sqlite3.connect(DB_FILE)
+def _report_row_dict(row) -> dict:
+    """Excel/CSV hesabat sətrini dict-ə çevirir (boş sətirlər None olur)."""
+    row_dict = dict(row)
+    # Convert empty strings back to None for easier checking in Python
+    if row_dict.get('giris_time') == '':
+        row_dict['giris_time'] = None
+    if row_dict.get('cixis_time') == '':
+        row_dict['cixis_time'] = None
+    if row_dict.get('giris_loc') == '':
+        row_dict['giris_loc'] = None
+    if row_dict.get('cixis_loc') == '':
+        row_dict['cixis_loc'] = None
+    # Set defaults for missing fields
+    if 'seriya' not in row_dict:
+        row_dict['seriya'] = None
+    if 'phone_number' not in row_dict:
+        row_dict['phone_number'] = None
+    if 'is_active' not in row_dict:
+        row_dict['is_active'] = 1
+    return row_dict
+
+
+# Günün "real" məlumatı: GPS sessiyası, giriş/çıxış vaxtı və ya köhnə lokasiya mətni
+_REPORT_HAS_DATA_SQL = '''
+    AND (
+        s.start_lat IS NOT NULL OR s.end_lat IS NOT NULL
+        OR s.start_lon IS NOT NULL OR s.end_lon IS NOT NULL
+        OR TRIM(COALESCE(a.giris_time, '')) NOT IN ('', '-')
+        OR TRIM(COALESCE(a.cixis_time, '')) NOT IN ('', '-')
+        OR TRIM(COALESCE(a.giris_loc, '')) NOT IN ('', '-')
+        OR TRIM(COALESCE(a.cixis_loc, '')) NOT IN ('', '-')
+    )
+'''
+
+
+def get_range_report_for_excel(start_date: str, end_date: str, code: Optional[str] = None,
+                               only_with_data: bool = False) -> List[dict]:
+    """Same rows as get_daily_report_for_excel for every day in [start_date, end_date], in one query.
+    Each row carries its own 'date'. Ordered by date, code, name.
+    only_with_data=True drops user-days without any attendance/GPS data (period exports).
+    """
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
-    # Get all dates in range
-    start_dt = datetime.strptime(start_date, "%Y-%m-%d").date()
-    end_dt = datetime.strptime(end_date, "%Y-%m-%d").date()
+    code_filter = "AND u.code = ?" if code else ""
+    if only_with_data:
+        code_filter += _REPORT_HAS_DATA_SQL
+    if _USING_POSTGRES:
+        cursor.execute(f'''
+            WITH days(d) AS (
+                SELECT generate_series(?::date, ?::date, interval '1 day')::date
+            )
+            SELECT 
+                days.d::text as date,
+                u.id,
+                u.telegram_id,
+                u.name,
+                u.fin,
+                u.seriya,
+                u.code,
+                u.phone_number,
+                u.is_active,
+                COALESCE(a.giris_time, '') as giris_time,
+                COALESCE(a.cixis_time, '') as cixis_time,
+                COALESCE(a.giris_loc, '') as giris_loc,
+                COALESCE(a.cixis_loc, '') as cixis_loc,
+                COALESCE(
+                    r_today.profession,
+                    (SELECT profession FROM registrations 
+                     WHERE user_id = u.id 
+                     ORDER BY date DESC 
+                     LIMIT 1),
+                    '-'
+                ) as profession,
+                s.start_lat,
+                s.start_lon,
+                s.end_lat,
+                s.end_lon
+            FROM days
+            JOIN users u ON (u.registered_at IS NULL OR u.registered_at::date <= days.d)
+            LEFT JOIN attendance a ON u.id = a.user_id AND a.date = days.d
+            LEFT JOIN registrations r_today ON r_today.user_id = u.id AND r_today.date = days.d
+            LEFT JOIN users2 u2 ON u.telegram_id = u2.telegram_id
+            LEFT JOIN sessions s ON s.user_id = u2.id AND s.start_time::date = days.d
+            WHERE 1 = 1 {code_filter}
+            ORDER BY days.d, u.code, u.name
+        ''', (start_date, end_date, *((code,) if code else ())))
+    else:
+        cursor.execute(f'''
+            WITH RECURSIVE days(d) AS (
+                SELECT date(?)
+                UNION ALL
+                SELECT date(d, '+1 day') FROM days WHERE d < date(?)
+            )
+            SELECT 
+                days.d as date,
+                u.id,
+                u.telegram_id,
+                u.name,
+                u.fin,
+                u.seriya,
+                u.code,
+                u.phone_number,
+                u.is_active,
+                COALESCE(a.giris_time, '') as giris_time,
+                COALESCE(a.cixis_time, '') as cixis_time,
+                COALESCE(a.giris_loc, '') as giris_loc,
+                COALESCE(a.cixis_loc, '') as cixis_loc,
+                COALESCE(
+                    r_today.profession,
+                    (SELECT profession FROM registrations 
+                     WHERE user_id = u.id 
+                     ORDER BY date DESC 
+                     LIMIT 1),
+                    '-'
+                ) as profession,
+                s.start_lat,
+                s.start_lon,
+                s.end_lat,
+                s.end_lon
+            FROM days
+            JOIN users u ON (u.registered_at IS NULL OR date(u.registered_at) <= days.d)
+            LEFT JOIN attendance a ON u.id = a.user_id AND a.date = days.d
+            LEFT JOIN registrations r_today ON r_today.user_id = u.id AND r_today.date = days.d
+            LEFT JOIN users2 u2 ON u.telegram_id = u2.telegram_id
+            LEFT JOIN sessions s ON s.user_id = u2.id AND substr(s.start_time, 1, 10) = days.d
+            WHERE 1 = 1 {code_filter}
+            ORDER BY days.d, u.code, u.name
+        ''', (start_date, end_date, *((code,) if code else ())))
     
-    results = []
-    current_date = start_dt
-    while current_date <= end_dt:
-        date_str = current_date.isoformat()
-        # Get daily report for each date
-        daily_data = get_daily_report_for_excel(date_str)
-        # Filter by code if provided
-        if code:
-            daily_data = [r for r in daily_data if r.get('code') == code]
-        results.extend(daily_data)
-        current_date += timedelta(days=1)
+    results = [_report_row_dict(row) for row in cursor.fetchall()]
     
+    conn.close()
     return results
 
 
+def get_period_report_for_excel(start_date: str, end_date: str, code: Optional[str] = None) -> List[dict]:
+    """Get report for date range, optionally filtered by code. Returns all users with attendance in period."""
+    # Günlər SQL tərəfində yaradılır - Python-da tarix dövrü yoxdur
+    return get_range_report_for_excel(start_date, end_date, code)
+
+
 def get_active_students_count(date: Optional[str] = None) -> int:
     """Get count of active students. If date provided, count students active on that date."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     
     if date:
@@ -1529,7 +1929,7 @@ def get_active_students_count(date: Optional[str] = None) -> int:
 
 def get_total_registered_students() -> dict:
     """Get statistics about registered students."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     cursor = conn.cursor()
     
     # Total registered
@@ -1563,7 +1963,7 @@ def get_total_registered_students() -> dict:
 def set_user_active(telegram_id: int, is_active: bool) -> bool:
     """Activate or deactivate a user. Returns True if user was found and updated."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         active_value = bool(is_active) if _USING_POSTGRES else (1 if is_active else 0)
         cursor.execute(
@@ -1574,13 +1974,14 @@ def set_user_active(telegram_id: int, is_active: bool) -> bool:
         affected = cursor.rowcount
         conn.commit()
         conn.close()
+        _invalidate_profile(telegram_id)
         return affected > 0
 
 
 def deactivate_user_by_code(code: str) -> int:
     """Deactivate all users with a specific code. Returns number of users deactivated."""
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         cursor.execute(
             'UPDATE users SET is_active = {inactive} WHERE code = ?'.format(inactive='FALSE' if _USING_POSTGRES else '0'),
@@ -1590,12 +1991,33 @@ def deactivate_user_by_code(code: str) -> int:
         affected = cursor.rowcount
         conn.commit()
         conn.close()
+        _invalidate_profile()
+        return affected
+
+
+def activate_user_by_code(code: str) -> int:
+    """Activate all inactive users with a specific code. Returns number of users activated."""
+    with _db_lock:
+        conn = _connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE users SET is_active = {active} WHERE code = ? AND is_active = {inactive}'.format(
+                active='TRUE' if _USING_POSTGRES else '1',
+                inactive='FALSE' if _USING_POSTGRES else '0',
+            ),
+            (code,)
+        )
+    
+        affected = cursor.rowcount
+        conn.commit()
+        conn.close()
+        _invalidate_profile()
         return affected
 
 
 def get_all_users_with_status(code: Optional[str] = None, only_active: Optional[bool] = None) -> List[dict]:
     """Get all users with their active status, optionally filtered by code and active status."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -1631,9 +2053,48 @@ def get_all_users_with_status(code: Optional[str] = None, only_active: Optional[
     return results
 
 
+def get_students_grouped_by_code(limit_per_group: int = 20) -> Tuple[List[dict], dict]:
+    """Students grouped by code for the admin listing, in one pass over users.
+    Returns (rows, totals): rows are at most limit_per_group per group, ordered by group then name,
+    each with 'grp' (code or 'Kod yoxdur') and 'grp_total'; totals has total/active/inactive counts.
+    """
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute(
+        '''
+        WITH ranked AS (
+            SELECT
+                telegram_id, name, fin, code, phone_number, is_active,
+                COALESCE(NULLIF(code, ''), 'Kod yoxdur') AS grp,
+                ROW_NUMBER() OVER (PARTITION BY COALESCE(NULLIF(code, ''), 'Kod yoxdur') ORDER BY name) AS rn,
+                COUNT(*) OVER (PARTITION BY COALESCE(NULLIF(code, ''), 'Kod yoxdur')) AS grp_total
+            FROM users
+        )
+        SELECT * FROM ranked WHERE rn <= ? ORDER BY grp, rn
+        ''',
+        (limit_per_group,)
+    )
+    rows = [dict(r) for r in cursor.fetchall()]
+    cursor.execute(
+        '''
+        SELECT
+            COUNT(*) AS total,
+            COALESCE(SUM(CASE WHEN is_active THEN 1 ELSE 0 END), 0) AS active
+        FROM users
+        '''
+    )
+    # row_factory hələ də Row-dur (Postgres-də RealDictCursor) - sütunlar ada görə oxunur
+    counts = cursor.fetchone()
+    total = counts['total'] or 0
+    active = counts['active'] or 0
+    conn.close()
+    return rows, {'total': total, 'active': active, 'inactive': total - active}
+
+
 def get_users_by_code(code: str, only_active: Optional[bool] = None) -> List[dict]:
     """Get all users with specific code, optionally filtered by active status."""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     query = 'SELECT id, telegram_id, name, fin, seriya, code, phone_number, is_active FROM users WHERE code = ?'
@@ -1655,7 +2116,7 @@ def delete_user_by_telegram_id(telegram_id: int) -> bool:
     """Delete a user by telegram_id. Returns True if user was found and deleted."""
     with _db_lock:
         affected = 0
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
         # Get user id first
         cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
@@ -1672,4 +2133,5 @@ def delete_user_by_telegram_id(telegram_id: int) -> bool:
         
         conn.commit()
         conn.close()
+        _invalidate_profile(telegram_id)
         return affected > 0
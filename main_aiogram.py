@@ -1,7 +1,9 @@
 import asyncio
 import atexit
+import calendar
 import os
-from datetime import datetime, timedelta, timezone
+from datetime import date as _date, datetime, timedelta, timezone
+import random
 import re
 import time
 import requests
@@ -13,9 +15,14 @@ from zoneinfo import ZoneInfo
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill
 from openpyxl.utils import get_column_letter
-from typing import Optional, List, Dict
+from openpyxl.writer.excel import ExcelWriter
+from zipfile import ZipFile, ZIP_DEFLATED
+import xlsxwriter
+from itertools import chain, groupby, islice
+from typing import Iterable, Iterator, Optional, Dict
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.exceptions import TelegramConflictError
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
@@ -28,6 +35,7 @@ from aiogram.types import (
     InlineKeyboardButton,
     BotCommandScopeChat,
     FSInputFile,
+    BufferedInputFile,
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -36,10 +44,28 @@ from dotenv import load_dotenv
 import database as db
 from utils.distance import haversine_m
 from utils import notifications
-from utils.reports import check_rules_violation, get_status_color, get_status_name
-from utils.exports import generate_csv_report
-from utils.geocoding import reverse_geocode, reverse_geocode_background
+from utils.reports import RulesConfig, check_rules_violation, get_status_color, get_status_name, render_violations
+from utils.exports import generate_csv_report_async, report_tempfile
+from utils.geocoding import (
+    cached_address,
+    close_session as close_geocoding_session,
+    reverse_geocode_background,
+    set_persistent_cache as set_geocoding_cache,
+)
+from utils.geocoding_worker import enqueue_geocode_update, start_worker as start_geocoding_worker, stop_worker as stop_geocoding_worker
 import csv
+import functools
+import io
+import logging
+import logging.handlers
+import queue
+
+try:
+    import orjson
+except ImportError:  # ixtiyari asılılıq
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 # ================== KONFİQURASİYA ==================
 
@@ -101,6 +127,8 @@ LOCATION_TIMEOUT = 120
 
 # Telegram mesaj limitindən bir az aşağı saxlayırıq
 TG_CHUNK_LIMIT = 3500
+# Bundan uzun siyahılar tək .txt sənəd kimi göndərilir
+TG_TEXT_LIMIT = 4000
 
 # Məkən koordinatları (lat, lon) və radius (metrlə)
 WORKPLACE_LAT = float(os.getenv("WORKPLACE_LAT", "40.4093"))  # Baku koordinatları default
@@ -115,6 +143,12 @@ MIN_WORK_DURATION_HOURS = 6  # Minimum iş müddəti (saat)
 # Lokasiya dəqiqliyi (metrlə) - eyni yer sayılması üçün tolerance
 LOCATION_TOLERANCE_M = 50  # 50 metr tolerance
 
+# Hesabatlardakı qayda yoxlaması üçün həddlər bir obyektdə
+_RULES = RulesConfig(
+    CHECKIN_DEADLINE_HOUR, CHECKOUT_DEADLINE_HOUR, MIN_WORK_DURATION_HOURS,
+    WORKPLACE_LAT, WORKPLACE_LON, WORKPLACE_RADIUS_M, LOCATION_TOLERANCE_M,
+)
+
 try:
     BAKU_TZ = ZoneInfo("Asia/Baku")
 except Exception:
@@ -125,8 +159,16 @@ def now_baku() -> datetime:
     return datetime.now(BAKU_TZ)
 
 
+# (UTC dəqiqəsi, tarix) - Bakı gecəyarısı dəqiqə sərhədinə düşür, ona görə keş köhnəlmir
+_today_cache: tuple[int, str] = (-1, "")
+
+
 def today_baku() -> str:
-    return now_baku().date().isoformat()
+    global _today_cache
+    minute = int(time.time() // 60)
+    if _today_cache[0] != minute:
+        _today_cache = (minute, now_baku().date().isoformat())
+    return _today_cache[1]
 
 
 def parse_dt_to_baku(value) -> datetime:
@@ -140,12 +182,61 @@ def parse_dt_to_baku(value) -> datetime:
 
 # ================== GLOBAL OBYEKTLƏR ==================
 
-bot = Bot(token=BOT_TOKEN)
+# Bot API bağlantı hovuzunun ölçüsü: toplu bildirişlərdə bağlantılar təkrar istifadə olunur
+TELEGRAM_HTTP_LIMIT = int(os.getenv("TELEGRAM_HTTP_LIMIT", "100"))
+
+if orjson is not None:
+    # orjson varsa Bot API sorğuları onunla serializə olunur (stdlib json-dan bir neçə dəfə sürətli)
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(
+            limit=TELEGRAM_HTTP_LIMIT,
+            json_loads=orjson.loads,
+            json_dumps=lambda obj: orjson.dumps(obj).decode(),
+        ),
+    )
+else:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(limit=TELEGRAM_HTTP_LIMIT))
 dp = Dispatcher()
 
 # In-memory pending action per user: (action, ts)
 # action: "checkin" | "checkout", ts: unix timestamp
+# Dict daxiletmə sırasını saxlayır, ona görə ən köhnə niyyətlər həmişə əvvəldədir
 pending_action: dict[int, tuple[str, float]] = {}
+_PENDING_MAX = 100_000
+
+
+def _set_pending(user_id: int, action: str) -> None:
+    """Niyyəti yazır; vaxtı keçmiş (lokasiya göndərilməmiş) qeydləri əvvəldən silir."""
+    now = time.time()
+    pending_action.pop(user_id, None)
+    pending_action[user_id] = (action, now)
+    while True:
+        uid = next(iter(pending_action))
+        if now - pending_action[uid][1] <= LOCATION_TIMEOUT and len(pending_action) <= _PENDING_MAX:
+            break
+        del pending_action[uid]
+
+
+# Bu gün artıq giriş etmiş users2 id-ləri; gün dəyişəndə bir sorğu ilə yenidən yüklənir
+_checked_in_today: set[int] = set()
+_checked_in_today_date: Optional[str] = None
+
+
+def _user_has_checkin_today(uid: int, today: str) -> bool:
+    """Təkrar giriş yoxlaması - DB-yə hər düymədə getmək əvəzinə yaddaşdakı set."""
+    global _checked_in_today_date
+    if _checked_in_today_date != today:
+        _checked_in_today.clear()
+        _checked_in_today.update(db.get_session_user_ids_on_date(today))
+        _checked_in_today_date = today
+    return uid in _checked_in_today
+
+
+def _forget_checkins() -> None:
+    """İstifadəçi silinəndə setin növbəti yoxlamada yenidən yüklənməsini təmin edir."""
+    global _checked_in_today_date
+    _checked_in_today_date = None
 
 PROFESSIONS: list[str] = [
     "Aşpaz",
@@ -156,6 +247,32 @@ PROFESSIONS: list[str] = [
     "Full stack",
     "Satıcı/kassir",
 ]
+_AZ_I_FOLD = str.maketrans({"İ": "i", "ı": "i"})
+
+
+def _fold(s: str) -> str:
+    """Registrsiz müqayisə üçün; "İ"/"I"/"ı"/"i" hamısı "i" sayılır (.lower() "İ"-ni "i̇" edir)."""
+    return s.translate(_AZ_I_FOLD).casefold()
+
+
+# Peşə adları _fold ilə (registrsiz O(1) axtarış üçün)
+_PROF_FOLDED: tuple[str, ...] = tuple(_fold(p) for p in PROFESSIONS)
+_PROF_EXACT: dict[str, str] = {p: p for p in PROFESSIONS} | {f: PROFESSIONS[i] for i, f in enumerate(_PROF_FOLDED)}
+
+# Profil redaktəsi: düymə/söz -> sahə (açarlar casefold edilib)
+_EDIT_FIELD_DISPATCH: dict[str, str] = {
+    k.casefold(): v for k, v in {
+        "👤 Adı dəyişdir": "name",
+        "Adı dəyişdir": "name",
+        "Ad": "name",
+        "🆔 FIN-i dəyişdir": "fin",
+        "FIN-i dəyişdir": "fin",
+        "FIN": "fin",
+    }.items()
+}
+_CANCEL_WORDS = frozenset(("ləğv", "cancel", "legv"))
+_DECLINE_BUTTONS = frozenset(("❌ Xeyr", "❌ Xeyr, ləğv et"))
+_DECLINE_WORDS = frozenset(("xeyr", "ləğv", "cancel", "no"))
 
 
 # ================== FSM STATES ==================
@@ -214,8 +331,27 @@ class AdminManageStudent(StatesGroup):
 # ================== KÖMƏKÇİ FUNKSİYALAR ==================
 
 
+_ADMIN_IDS_SET: frozenset[int] = frozenset({ADMIN_ID}) if ADMIN_ID else frozenset()
+_ADMIN_ONLY_CMD = "❌ Bu əmr yalnız admin üçündür."
+_ADMIN_ONLY_ACTION = "❌ Bu əməliyyat yalnız admin üçündür."
+
+
 def is_admin(user_id: int) -> bool:
-    return ADMIN_ID != 0 and user_id == ADMIN_ID
+    return user_id in _ADMIN_IDS_SET
+
+
+def admin_only(denied_text: str = _ADMIN_ONLY_CMD):
+    """Handleri yalnız admin üçün açır, qalanlarına denied_text cavabı verir."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(message: Message, *args, **kwargs):
+            user = message.from_user
+            if not user or user.id not in _ADMIN_IDS_SET:
+                await message.answer(denied_text)
+                return None
+            return await handler(message, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 def worker_keyboard() -> ReplyKeyboardMarkup:
@@ -255,34 +391,244 @@ def professions_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
 
-def chunk_send(text: str):
-    """Mesajı TG_CHUNK_LIMIT uzunluğunda parçalamaq üçün generator."""
+# Status rəngləri cəmi 3 cürdür - stil obyektləri modul səviyyəsində bir dəfə yaradılır
+_ROW_FILL = {
+    key: PatternFill(start_color=get_status_color(key), end_color=get_status_color(key), fill_type="solid")
+    for key in ("ok", "violation", "inactive")
+}
+_LINK_FONT = Font(color="0000FF", underline="single")
+_OK_STATUS = get_status_name("ok")
+
+# Azerbaijani month names (index = month)
+_MONTHS_AZ = (
+    "", "Yanvar", "Fevral", "Mart", "Aprel", "May", "İyun",
+    "İyul", "Avqust", "Sentyabr", "Oktyabr", "Noyabr", "Dekabr",
+)
+
+
+@functools.lru_cache(maxsize=512)
+def _fmt_date_az(d: str) -> str:
+    """"2024-01-15" -> "15 Yanvar 2024"; tanınmayan dəyər olduğu kimi qaytarılır."""
+    try:
+        date_obj = _date.fromisoformat(d)
+    except (TypeError, ValueError):
+        return d
+    return f"{date_obj.day} {_MONTHS_AZ[date_obj.month]} {date_obj.year}"
+
+
+_MAPS_POINT = "https://maps.google.com/?q={},{}".format
+_MAPS_SEARCH = "https://www.google.com/maps/search/?api=1&query={}".format
+
+
+@functools.lru_cache(maxsize=4096)
+def _encode_addr(address: str) -> str:
+    """urllib.parse.quote keşlə - hesabatlarda eyni ünvan dəfələrlə təkrarlanır."""
+    return urllib.parse.quote(address)
+
+
+def _map_kb(lat: float, lon: float) -> InlineKeyboardMarkup:
+    """Giriş kartı üçün "Xəritədə bax" düyməsi."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="Xəritədə bax", url=_MAPS_POINT(lat, lon))]]
+    )
+
+
+def _legacy_id(prof: Optional[dict]) -> Optional[int]:
+    """users.id (INTEGER PRIMARY KEY) və ya profil yoxdursa None."""
+    return prof.get("id") if prof else None
+
+
+def _save_workbook(wb: Workbook, filepath: str) -> None:
+    """wb.save() ekvivalenti, amma zip sıxılma səviyyəsi 1 ilə (daha sürətli yazılış)."""
+    archive = ZipFile(filepath, "w", ZIP_DEFLATED, allowZip64=True, compresslevel=1)
+    ExcelWriter(wb, archive).save()
+
+
+async def send_text_or_doc(message: Message, text: str, filename: str = "report.txt") -> None:
+    """Qısa mətni adi mesajla, uzun mətni isə bir sorğuda .txt sənəd kimi göndərir."""
+    if len(text) <= TG_TEXT_LIMIT:
+        await message.answer(text)
+        return
+    await message.answer_document(BufferedInputFile(text.encode("utf-8"), filename=filename))
+
+
+# Admin menyularının sabit klaviaturaları (bir dəfə qurulur, handlerlər arasında paylaşılır)
+_KB_MANAGE_GROUPS = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="➕ Qrup kodu əlavə et")],
+        [KeyboardButton(text="🗑 Qrup kodu sil")],
+        [KeyboardButton(text="📋 Qrup kodlarını göstər")],
+        [KeyboardButton(text="❌ Ləğv et")],
+    ],
+    resize_keyboard=True
+)
+_KB_MANAGE_STUDENTS = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📋 Tələbələri göstər"), KeyboardButton(text="🗑 Tələbə sil")],
+        [KeyboardButton(text="✏️ Tələbənin məlumatını dəyiş")],
+        [KeyboardButton(text="🔒 Tələbəni deaktiv et"), KeyboardButton(text="🔓 Tələbəni aktiv et")],
+        [KeyboardButton(text="🔒 Qrup tələbələrini deaktiv et"), KeyboardButton(text="🔓 Qrup tələbələrini aktiv et")],
+        [KeyboardButton(text="❌ Ləğv et")],
+    ],
+    resize_keyboard=True
+)
+_KB_PERIOD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📊 Gündəlik"), KeyboardButton(text="📅 Həftəlik")],
+        [KeyboardButton(text="📆 Aylıq"), KeyboardButton(text="🔖 Kod üzrə")],
+        [KeyboardButton(text="🗓 Tarix aralığı")],
+        [KeyboardButton(text="❌ Ləğv et")],
+    ],
+    resize_keyboard=True
+)
+_KB_FORMAT = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📊 Excel"), KeyboardButton(text="📄 CSV")],
+        [KeyboardButton(text="❌ Ləğv et")],
+    ],
+    resize_keyboard=True
+)
+_KB_CONFIRM_DELETE = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="✅ Bəli, sil"), KeyboardButton(text="❌ Xeyr")],
+    ],
+    resize_keyboard=True
+)
+_KB_EDIT_FIELDS = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="👤 Adı dəyişdir"), KeyboardButton(text="🆔 FIN-i dəyişdir")],
+        [KeyboardButton(text="❌ Ləğv et")],
+    ],
+    resize_keyboard=True
+)
+_KB_ADMIN = admin_keyboard()
+_KB_WORKER = worker_keyboard()
+_KB_LOCATION = location_keyboard("Lokasiyanı göndər")
+_KB_PROFESSIONS = professions_keyboard()
+
+# Dəyişməyən cavab mətnləri
+_MSG_GPS_INVALID = "❌ GPS koordinatları düzgün deyil. GPS-i aktiv edin və yenidən cəhd edin."
+_MSG_CHECKIN_REMINDER = (
+    "💡 Xatırlatma\n\n"
+    "Gününüz xoş keçsin! 🌟\n\n"
+    "⚠️ Çıxış etməyi unutmayın!\n"
+    "Yoxsa iş günü kimi hesablanmayacaq."
+)
+_MSG_CHECKOUT_DONE = (
+    "🎉 İş gününüz uğurla tamamlandı!\n\n"
+    "Xoş istirahətlər! 😊"
+)
+_MSG_CHECKOUT_REMINDER = (
+    "⏰ Xatırlatma\n\n"
+    "8 saat keçib. Xahiş edirik çıxış edin.\n\n"
+    "🔴 Çıxış düyməsinə basın və lokasiyanızı göndərin."
+)
+
+
+_SHLEX_CHARS = frozenset("\"'\\")
+
+
+def _split_command(text: Optional[str]) -> list[str]:
+    """Əmr arqumentlərini bölür; shlex yalnız dırnaq/escape olduqda işə düşür."""
+    raw = text or ""
+    if _SHLEX_CHARS.isdisjoint(raw):
+        return raw.split()
+    return shlex.split(raw)
+
+
+def _txt(message: Message, upper: bool = False) -> str:
+    """Mesaj mətnini boşluqsuz qaytarır (mətn yoxdursa "")."""
+    s = message.text
+    if not s:
+        return ""
+    s = s.strip()
+    return s.upper() if upper else s
+
+
+_MENU_SUFFIX = "\n\nMenyu:"
+
+
+def chunk_send(text: str) -> list[str]:
+    """Mesajı TG_CHUNK_LIMIT uzunluğunda parçalara bölür (sətir sərhədində)."""
+    parts: list[str] = []
     s = text
     while s:
         chunk = s[:TG_CHUNK_LIMIT]
         cut = chunk.rfind("\n")
         if cut == -1:
             cut = len(chunk)
-        yield s[:cut]
+        parts.append(s[:cut])
         s = s[cut:].lstrip("\n")
+    return parts
+
+
+async def _sqlite_retry(op, *args, attempts: int = 5, base: float = 0.05, cap: float = 1.0, **kwargs):
+    """db yazısını "database is locked/busy" xətasında eksponensial gözləmə + jitter ilə təkrarlayır.
+    Yazı ayrı thread-də işləyir - busy_timeout gözləməsi event loop-u bloklamır."""
+    for attempt in range(attempts):
+        try:
+            return await asyncio.to_thread(op, *args, **kwargs)
+        except sqlite3.OperationalError as e:
+            msg = str(e).lower()
+            if attempt == attempts - 1 or ("locked" not in msg and "busy" not in msg):
+                raise
+            await asyncio.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
+# "1." / "1)" / "1 Usta" / "1" kimi peşə nömrəsi prefiksi
+_NUM_PREFIX_RE = re.compile(r"^(\d+)(?:[.)\s]|$)")
+_ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_FIN_RE = re.compile(r"^[A-Za-z0-9]{7,10}$")
+# Vəsiqə seriyası: AA1234567 (2 hərf + 7 rəqəm), AZE12345678 (passport)
+_SERIYA_RE1 = re.compile(r"^[A-Z]{2}\d{7}$")
+_SERIYA_RE2 = re.compile(r"^[A-Z]{3}\d{8}$")
 
 
 def _match_profession(token: str) -> str | None:
-    t = token.strip().lower()
-    for p in PROFESSIONS:
-        if p.lower() == t:
-            return p
+    return _PROF_EXACT.get(_fold(token.strip()))
+
+
+def _pick_profession(raw: str) -> str | None:
+    """Peşəni nömrə ("1." / "1"), dəqiq ad (registrsiz) və ya ad hissəsi ilə tapır."""
+    m = _NUM_PREFIX_RE.match(raw)
+    if m:
+        idx = int(m.group(1)) - 1
+        if 0 <= idx < len(PROFESSIONS):
+            return PROFESSIONS[idx]
+    raw_folded = _fold(raw)
+    chosen = _PROF_EXACT.get(raw) or _PROF_EXACT.get(raw_folded)
+    if chosen:
+        return chosen
+    for i, f in enumerate(_PROF_FOLDED):
+        if raw_folded in f:
+            return PROFESSIONS[i]
     return None
 
 
+# today -> (yaradılma vaxtı, aktiv kodlar); kodlar gündə bir-iki dəfə dəyişir
+_active_codes_cache: dict[str, tuple[float, frozenset[str]]] = {}
+_ACTIVE_CODES_TTL = 60.0
+
+
+def _get_active_codes(today: str) -> frozenset[str]:
+    entry = _active_codes_cache.get(today)
+    if entry and time.time() - entry[0] < _ACTIVE_CODES_TTL:
+        return entry[1]
+    rows = db.get_group_codes(active_on=today, only_active=True)
+    codes = frozenset(r.get('code') for r in rows if r.get('code'))
+    _active_codes_cache[today] = (time.time(), codes)
+    return codes
+
+
 def _parse_date_or_today(s: str) -> str | None:
     """'YYYY-MM-DD' və ya 'bugun' tipini tarixə çevirir, yanlış olsa None qaytarır."""
     s = s.strip().lower()
     if s in ("bugun", "bu gun", "bu gün"):
         return today_baku()
+    if not _ISO_DATE_RE.match(s):
+        return None
     try:
-        dt = datetime.strptime(s, "%Y-%m-%d")
-        return dt.date().isoformat()
+        return _date.fromisoformat(s).isoformat()
     except ValueError:
         return None
 
@@ -296,44 +642,66 @@ async def schedule_checkout_reminder(telegram_id: int, checkin_time: datetime, u
         await asyncio.sleep(wait_seconds)
         
         # Check if user already checked out
-        db.init_gps_tables()
         sess = db.get_open_session(user2_id)
         
         if sess:
             # User hasn't checked out yet, send reminder
             try:
-                reminder_text = (
-                    "⏰ Xatırlatma\n\n"
-                    "8 saat keçib. Xahiş edirik çıxış edin.\n\n"
-                    "🔴 Çıxış düyməsinə basın və lokasiyanızı göndərin."
-                )
-                await bot.send_message(telegram_id, reminder_text, reply_markup=worker_keyboard())
-            except Exception as e:
-                print(f"[schedule_checkout_reminder] Error sending reminder to {telegram_id}: {e}")
+                await bot.send_message(telegram_id, _MSG_CHECKOUT_REMINDER, reply_markup=_KB_WORKER)
+            except Exception:
+                logger.exception("[schedule_checkout_reminder] Error sending reminder to %s", telegram_id)
         # If session is closed, user already checked out, no need to remind
     except asyncio.CancelledError:
         # Task was cancelled, ignore
         pass
-    except Exception as e:
-        print(f"[schedule_checkout_reminder] Error: {e}")
+    except Exception:
+        logger.exception("[schedule_checkout_reminder] Error")
+
+
+def _daily_rule_check(member: dict) -> tuple[str, list[tuple]]:
+    """Günlük hesabat sətri üçün qayda yoxlaması (vaxtlar str-ə, koordinatlar float-a çevrilir)."""
+    giris = member.get('giris_time')
+    cixis = member.get('cixis_time')
+    giris = str(giris).strip() if giris is not None else ''
+    cixis = str(cixis).strip() if cixis is not None else ''
+    start_lat = member.get('start_lat')
+    start_lon = member.get('start_lon')
+    end_lat = member.get('end_lat')
+    end_lon = member.get('end_lon')
+    end_lat = float(end_lat) if end_lat is not None else None
+    end_lon = float(end_lon) if end_lon is not None else None
+    # Giriş nöqtəsi yoxdursa çıxış nöqtəsi götürülür (hesabatdakı lokasiya sütunu kimi)
+    if start_lat is not None and start_lon is not None:
+        lat, lon = float(start_lat), float(start_lon)
+    else:
+        lat, lon = end_lat, end_lon
+        if lat is None or lon is None:
+            lat = lon = None
+    return check_rules_violation(
+        giris or None, cixis or None,
+        lat, lon, end_lat, end_lon,
+        member.get('is_active', 1),
+        _RULES,
+    )
 
 
-def generate_daily_excel_report(date: str) -> str:
-    """Generate Excel report for a specific date. Returns path to the Excel file."""
+def generate_daily_excel_report(date: str, code: Optional[str] = None) -> str:
+    """Generate Excel report for a specific date (optionally one group code). Returns path to the Excel file."""
     # Get all users with attendance data for the date
-    report_data = db.get_daily_report_for_excel(date)
+    report_data = db.get_daily_report_for_excel(date, code)
     
     # Debug: print first few records to check data
     if report_data:
-        print(f"[DEBUG] First record: {report_data[0]}")
-        print(f"[DEBUG] giris_time type: {type(report_data[0].get('giris_time'))}, value: {report_data[0].get('giris_time')}")
-        print(f"[DEBUG] cixis_time type: {type(report_data[0].get('cixis_time'))}, value: {report_data[0].get('cixis_time')}")
+        first = report_data[0]
+        logger.debug("[generate_daily_excel_report] First record: %s", first)
+        logger.debug("[generate_daily_excel_report] giris_time type: %s, value: %s", type(first.get('giris_time')), first.get('giris_time'))
+        logger.debug("[generate_daily_excel_report] cixis_time type: %s, value: %s", type(first.get('cixis_time')), first.get('cixis_time'))
     
     # Group by code to show members
     by_code: dict[str, list[dict]] = {}
     for row in report_data:
-        code = row.get('code') or '-'
-        by_code.setdefault(code, []).append(row)
+        grp_code = row.get('code') or '-'
+        by_code.setdefault(grp_code, []).append(row)
     
     # Calculate statistics
     total_workers = len(report_data)
@@ -347,36 +715,33 @@ def generate_daily_excel_report(date: str) -> str:
     violation_count = 0
     inactive_count = 0
     
+    # Hər sətir bir dəfə yoxlanılır; nəticə aşağıda cədvəl yazılarkən təkrar istifadə olunur
+    rule_results: dict[int, tuple[str, list[tuple]]] = {}
     for member in report_data:
-        is_active = member.get('is_active', 1)
-        if is_active == 0:
+        status, violations = rule_results[id(member)] = _daily_rule_check(member)
+        if status == "inactive":
             inactive_count += 1
-        else:
-            giris_time = member.get('giris_time')
-            cixis_time = member.get('cixis_time')
-            start_lat = member.get('start_lat')
-            start_lon = member.get('start_lon')
-            end_lat = member.get('end_lat')
-            end_lon = member.get('end_lon')
-            
-            status, _ = check_rules_violation(
-                giris_time, cixis_time,
-                float(start_lat) if start_lat is not None else None,
-                float(start_lon) if start_lon is not None else None,
-                float(end_lat) if end_lat is not None else None,
-                float(end_lon) if end_lon is not None else None,
-                is_active,
-                CHECKIN_DEADLINE_HOUR, CHECKOUT_DEADLINE_HOUR, MIN_WORK_DURATION_HOURS,
-                WORKPLACE_LAT, WORKPLACE_LON, WORKPLACE_RADIUS_M, LOCATION_TOLERANCE_M
-            )
-            if status == "ok":
-                ok_count += 1
-            elif status == "violation":
-                violation_count += 1
+        elif status == "ok":
+            ok_count += 1
+        elif status == "violation":
+            violation_count += 1
     
     # Aktiv tələbə sayı
     active_count = db.get_active_students_count(date)
     
+    # Keşlənmiş ünvanlar (bir toplu sorğu)
+    geo_points = []
+    for member in report_data:
+        if member.get('start_lat') is not None and member.get('start_lon') is not None:
+            geo_points.append((float(member['start_lat']), float(member['start_lon'])))
+        elif member.get('end_lat') is not None and member.get('end_lon') is not None:
+            geo_points.append((float(member['end_lat']), float(member['end_lon'])))
+    try:
+        addresses = db.get_geocodes(geo_points)
+    except Exception:
+        logger.exception("[generate_daily_excel_report] Geocode cache error")
+        addresses = {}
+    
     # Create workbook
     wb = Workbook()
     ws = wb.active
@@ -391,17 +756,7 @@ def generate_daily_excel_report(date: str) -> str:
     data_alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
     
     # Format date for display (e.g., "15 Yanvar 2024")
-    try:
-        date_obj = datetime.strptime(date, "%Y-%m-%d")
-        # Azerbaijani month names
-        months_az = {
-            1: "Yanvar", 2: "Fevral", 3: "Mart", 4: "Aprel",
-            5: "May", 6: "İyun", 7: "İyul", 8: "Avqust",
-            9: "Sentyabr", 10: "Oktyabr", 11: "Noyabr", 12: "Dekabr"
-        }
-        formatted_date = f"{date_obj.day} {months_az[date_obj.month]} {date_obj.year}"
-    except:
-        formatted_date = date
+    formatted_date = _fmt_date_az(date)
     
     # Write statistics section at the top
     stats_row = 1
@@ -448,8 +803,8 @@ def generate_daily_excel_report(date: str) -> str:
         for worker in workers_without_giris:
             name = worker.get('name', '?')
             fin = worker.get('fin', '-')
-            code = worker.get('code', '-')
-            ws.cell(row=stats_row, column=1, value=f"• {name} (FIN: {fin}, Kod: {code})")
+            grp_code = worker.get('code', '-')
+            ws.cell(row=stats_row, column=1, value=f"• {name} (FIN: {fin}, Kod: {grp_code})")
             stats_row += 1
     
     # Add empty row before main table
@@ -483,9 +838,17 @@ def generate_daily_excel_report(date: str) -> str:
         cell.font = header_font
         cell.alignment = header_alignment
     
+    # Sütun enləri yazı zamanı izlənir; statistika bloku + başlıq burada bir dəfə ölçülür
+    max_len = [0] * len(headers)
+    for values in ws.iter_rows(min_row=1, max_row=header_row, max_col=len(headers), values_only=True):
+        for col_idx, value in enumerate(values):
+            length = len(str(value))
+            if length > max_len[col_idx]:
+                max_len[col_idx] = length
+    
     # Write data (starting after header row)
     row_num = header_row + 1
-    for code, members in sorted(by_code.items()):
+    for grp_code, members in sorted(by_code.items()):
         # Get all member names for this code
         member_names = [m.get('name', '?') for m in members]
         members_str = ", ".join(member_names) if member_names else "-"
@@ -493,15 +856,14 @@ def generate_daily_excel_report(date: str) -> str:
         for member in members:
             name_full = member.get('name', '')
             # Split name into ad and soyad (assuming space-separated)
-            name_parts = name_full.strip().split(maxsplit=1)
-            ad = name_parts[0] if name_parts else name_full
-            soyad = name_parts[1] if len(name_parts) > 1 else ""
+            head, _, tail = name_full.strip().partition(' ')
+            ad = head or name_full
+            soyad = tail.lstrip()
             
             fin = member.get('fin', '')
             profession = member.get('profession', '-')
             seriya = member.get('seriya') or '-'
             phone_number = member.get('phone_number') or '-'
-            is_active = member.get('is_active', 1)
             
             # Handle entry/exit times
             giris_time_raw = member.get('giris_time')
@@ -551,17 +913,15 @@ def generate_daily_excel_report(date: str) -> str:
                 lat = float(start_lat)
                 lon = float(start_lon)
                 gps_coords = f"{lat}, {lon}"
-                # Sync context: use coordinates (geocoding cache is async-only)
-                address = gps_coords
-                start_link = f"https://maps.google.com/?q={lat},{lon}"
+                address = addresses.get((lat, lon), gps_coords)
+                start_link = _MAPS_POINT(lat, lon)
             elif end_lat is not None and end_lon is not None:
                 # Fallback to end location if start not available
                 lat = float(end_lat)
                 lon = float(end_lon)
                 gps_coords = f"{lat}, {lon}"
-                # Sync context: use coordinates (geocoding cache is async-only)
-                address = gps_coords
-                end_link = f"https://maps.google.com/?q={lat},{lon}"
+                address = addresses.get((lat, lon), gps_coords)
+                end_link = _MAPS_POINT(lat, lon)
             else:
                 # Fallback to legacy attendance location fields
                 giris_loc = member.get('giris_loc') or ''
@@ -570,105 +930,51 @@ def generate_daily_excel_report(date: str) -> str:
                 if giris_loc:
                     address = str(giris_loc).strip()
                     # Generate Google Maps link from address
-                    encoded_address = urllib.parse.quote(address)
-                    start_link = f"https://www.google.com/maps/search/?api=1&query={encoded_address}"
+                    start_link = _MAPS_SEARCH(_encode_addr(address))
                 elif cixis_loc:
                     address = str(cixis_loc).strip()
                     # Generate Google Maps link from address
-                    encoded_address = urllib.parse.quote(address)
-                    end_link = f"https://www.google.com/maps/search/?api=1&query={encoded_address}"
+                    end_link = _MAPS_SEARCH(_encode_addr(address))
             
-            # Qayda yoxlaması
-            status, violations = check_rules_violation(
-                giris_time_raw if giris_time_raw else None,
-                cixis_time_raw if cixis_time_raw else None,
-                lat, lon,
-                float(end_lat) if end_lat is not None else None,
-                float(end_lon) if end_lon is not None else None,
-                is_active,
-                CHECKIN_DEADLINE_HOUR,
-                CHECKOUT_DEADLINE_HOUR,
-                MIN_WORK_DURATION_HOURS,
-                WORKPLACE_LAT,
-                WORKPLACE_LON,
-                WORKPLACE_RADIUS_M,
-                LOCATION_TOLERANCE_M
-            )
+            # Qayda yoxlaması (statistika hissəsində hesablanıb)
+            status, violations = rule_results[id(member)]
             status_name = get_status_name(status)
-            violations_str = "; ".join(violations) if violations else "-"
+            violations_str = "; ".join(render_violations(violations)) if violations else "-"
             
             # Rəng kodlaması
-            status_color = get_status_color(status)
-            row_fill = PatternFill(start_color=status_color, end_color=status_color, fill_type="solid")
+            row_fill = _ROW_FILL[status]
             
-            # Write data with date in first column
-            ws.cell(row=row_num, column=1, value=formatted_date).alignment = data_alignment
-            ws.cell(row=row_num, column=1).fill = row_fill
-            ws.cell(row=row_num, column=2, value=fin).alignment = data_alignment
-            ws.cell(row=row_num, column=2).fill = row_fill
-            ws.cell(row=row_num, column=3, value=ad).alignment = data_alignment
-            ws.cell(row=row_num, column=3).fill = row_fill
-            ws.cell(row=row_num, column=4, value=soyad).alignment = data_alignment
-            ws.cell(row=row_num, column=4).fill = row_fill
-            ws.cell(row=row_num, column=5, value=seriya).alignment = data_alignment
-            ws.cell(row=row_num, column=5).fill = row_fill
-            ws.cell(row=row_num, column=6, value=phone_number).alignment = data_alignment
-            ws.cell(row=row_num, column=6).fill = row_fill
-            ws.cell(row=row_num, column=7, value=code).alignment = data_alignment
-            ws.cell(row=row_num, column=7).fill = row_fill
-            ws.cell(row=row_num, column=8, value=profession).alignment = data_alignment
-            ws.cell(row=row_num, column=8).fill = row_fill
-            ws.cell(row=row_num, column=9, value=giris_time).alignment = data_alignment
-            ws.cell(row=row_num, column=9).fill = row_fill
-            ws.cell(row=row_num, column=10, value=cixis_time).alignment = data_alignment
-            ws.cell(row=row_num, column=10).fill = row_fill
-            ws.cell(row=row_num, column=11, value=gps_coords).alignment = data_alignment
-            ws.cell(row=row_num, column=11).fill = row_fill
-            ws.cell(row=row_num, column=12, value=address).alignment = data_alignment
-            ws.cell(row=row_num, column=12).fill = row_fill
+            # Write data with date in first column; fill/alignment are set as each cell is written
+            values = (
+                formatted_date, fin, ad, soyad, seriya, phone_number, grp_code, profession,
+                giris_time, cixis_time, gps_coords, address,
+                "Giriş xəritə" if start_link != "-" else "-",
+                "Çıxış xəritə" if end_link != "-" else "-",
+                status_name, violations_str, members_str,
+            )
+            for col_idx, value in enumerate(values, start=1):
+                cell = ws.cell(row=row_num, column=col_idx, value=value)
+                cell.alignment = data_alignment
+                cell.fill = row_fill
+                length = len(str(value))
+                if length > max_len[col_idx - 1]:
+                    max_len[col_idx - 1] = length
             
             # Add hyperlink for maps link if available
             if start_link != "-":
-                cell = ws.cell(row=row_num, column=13, value="Giriş xəritə")
+                cell = ws.cell(row=row_num, column=13)
                 cell.hyperlink = start_link
-                cell.font = Font(color="0000FF", underline="single")
-                cell.alignment = data_alignment
-                cell.fill = row_fill
-            else:
-                ws.cell(row=row_num, column=13, value="-").alignment = data_alignment
-                ws.cell(row=row_num, column=13).fill = row_fill
-
+                cell.font = _LINK_FONT
             if end_link != "-":
-                cell2 = ws.cell(row=row_num, column=14, value="Çıxış xəritə")
-                cell2.hyperlink = end_link
-                cell2.font = Font(color="0000FF", underline="single")
-                cell2.alignment = data_alignment
-                cell2.fill = row_fill
-            else:
-                ws.cell(row=row_num, column=14, value="-").alignment = data_alignment
-                ws.cell(row=row_num, column=14).fill = row_fill
-            
-            ws.cell(row=row_num, column=15, value=status_name).alignment = data_alignment
-            ws.cell(row=row_num, column=15).fill = row_fill
-            ws.cell(row=row_num, column=16, value=violations_str).alignment = data_alignment
-            ws.cell(row=row_num, column=16).fill = row_fill
-            ws.cell(row=row_num, column=17, value=members_str).alignment = data_alignment
-            ws.cell(row=row_num, column=17).fill = row_fill
+                cell = ws.cell(row=row_num, column=14)
+                cell.hyperlink = end_link
+                cell.font = _LINK_FONT
             
             row_num += 1
     
     # Auto-adjust column widths
-    for col_idx in range(1, len(headers) + 1):
-        col_letter = get_column_letter(col_idx)
-        max_length = 0
-        for row in ws[col_letter]:
-            try:
-                if len(str(row.value)) > max_length:
-                    max_length = len(str(row.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[col_letter].width = adjusted_width
+    for col_idx, length in enumerate(max_len, start=1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = min(length + 2, 50)
     
     # Freeze header row (freeze after statistics section)
     ws.freeze_panes = f"A{header_row + 1}"
@@ -685,9 +991,9 @@ def generate_daily_excel_report(date: str) -> str:
     ws.row_dimensions[1].height = 25
     
     # Save file
-    filename = f"hesabat_{date}.xlsx"
-    filepath = os.path.join(os.getcwd(), filename)
-    wb.save(filepath)
+    filename = f"hesabat_{date}_{code}.xlsx" if code else f"hesabat_{date}.xlsx"
+    filepath = report_tempfile(filename)
+    _save_workbook(wb, filepath)
     
     return filepath
 
@@ -699,34 +1005,28 @@ async def handle_start(message: Message, state: FSMContext) -> None:
     user = message.from_user
     full_name = user.full_name if user else "Istifadeci"
 
-    # Ensure all tables exist (legacy + GPS)
-    db.init_db()
-    db.init_gps_tables()
-    db.init_group_codes()
-    db.init_registrations()
-
     # Register minimal user2 for GPS flow
     db.get_or_create_user2(telegram_id=user.id, full_name=full_name)  # type: ignore[arg-type]
 
     # If admin, show admin menu directly
     if user and is_admin(user.id):
-        await message.answer("Xoş gəldiniz!\nAdmin menyusundan istifadə edin:", reply_markup=admin_keyboard())
+        await message.answer("Xoş gəldiniz!\nAdmin menyusundan istifadə edin:", reply_markup=_KB_ADMIN)
         return
 
     # Check legacy user profile; if missing, start registration FSM
-    prof = db.get_user_by_telegram_id(user.id) if user else None
+    prof = db.get_user_cached(user.id) if user else None
     if not prof:
         await state.clear()
         await state.set_state(Reg.profession)
         await message.answer(
             "Qeydiyyat: əvvəlcə peşəni seçin",
-            reply_markup=professions_keyboard(),
+            reply_markup=_KB_PROFESSIONS,
         )
         return
 
     # Check if last registration was more than 4 months ago - auto reset
-    if prof and isinstance(prof.get("id"), int):
-        user_id = int(prof["id"])
+    user_id = _legacy_id(prof)
+    if user_id is not None:
         last_reg_date = db.get_last_registration_date(user_id)
         
         if last_reg_date:
@@ -738,15 +1038,16 @@ async def handle_start(message: Message, state: FSMContext) -> None:
                 # If more than 4 months (approximately 120 days) passed, reset user
                 if days_passed > 120:
                     db.delete_user_all(user.id)
+                    _forget_checkins()
                     await state.clear()
                     await state.set_state(Reg.profession)
                     await message.answer(
                         "ℹ️ Son qeydiyyatınızdan 4 aydan çox keçib. Yenidən qeydiyyatdan keçin.\n\nQeydiyyat: əvvəlcə peşəni seçin",
-                        reply_markup=professions_keyboard(),
+                        reply_markup=_KB_PROFESSIONS,
                     )
                     return
-            except Exception as e:
-                print(f"[handle_start] Error checking last registration: {e}")
+            except Exception:
+                logger.exception("[handle_start] Error checking last registration")
 
     # User is registered, show menu immediately
     prof_name = prof.get("name", "İstifadəçi") if prof else "İstifadəçi"
@@ -760,45 +1061,24 @@ async def handle_start(message: Message, state: FSMContext) -> None:
     )
     await message.answer(
         welcome_text,
-        reply_markup=worker_keyboard(),
+        reply_markup=_KB_WORKER,
     )
 
 
 @dp.message(Reg.profession)
 async def reg_pick_profession(message: Message, state: FSMContext) -> None:
     try:
-        text = (message.text or "").strip()
+        text = _txt(message)
         if text == "❌ Ləğv et":
             await state.clear()
-            await message.answer("Ləğv edildi.", reply_markup=worker_keyboard())
+            await message.answer("Ləğv edildi.", reply_markup=_KB_WORKER)
             return
 
-        chosen = None
         raw = text.strip('"\' ').strip()
-
-        # 1) numeric prefix like "1." or just number
-        idx_part = raw.split(".", 1)[0]
-        if idx_part.isdigit():
-            idx = int(idx_part) - 1
-            if 0 <= idx < len(PROFESSIONS):
-                chosen = PROFESSIONS[idx]
-
-        # 2) exact case-insensitive
-        if not chosen:
-            for p in PROFESSIONS:
-                if p.lower() == raw.lower():
-                    chosen = p
-                    break
-
-        # 3) loose contains match
-        if not chosen:
-            for p in PROFESSIONS:
-                if raw.lower() in p.lower():
-                    chosen = p
-                    break
+        chosen = _pick_profession(raw)
 
         if not chosen:
-            await message.answer("Peşə düzgün seçilmədi, siyahıdan seçin.", reply_markup=professions_keyboard())
+            await message.answer("Peşə düzgün seçilmədi, siyahıdan seçin.", reply_markup=_KB_PROFESSIONS)
             return
 
         await state.update_data(profession=chosen)
@@ -808,8 +1088,8 @@ async def reg_pick_profession(message: Message, state: FSMContext) -> None:
             f"Peşə: {chosen}\nİndi isə bu günün kodunu daxil edin ({today})",
             reply_markup=ReplyKeyboardRemove(),
         )
-    except Exception as e:
-        print(f"[reg_pick_profession] error: {e}")
+    except Exception:
+        logger.exception("[reg_pick_profession] error")
         await state.clear()
         await message.answer("❌ Xəta baş verdi. Qeydiyyatı yenidən başlayın: /start")
 
@@ -817,29 +1097,28 @@ async def reg_pick_profession(message: Message, state: FSMContext) -> None:
 @dp.message(Reg.code)
 async def reg_enter_code(message: Message, state: FSMContext) -> None:
     try:
-        code = (message.text or "").strip()
+        code = _txt(message)
         data = await state.get_data()
         prof = data.get("profession")
         if not prof:
             await state.set_state(Reg.profession)
-            await message.answer("Əvvəl peşə seçin.", reply_markup=professions_keyboard())
+            await message.answer("Əvvəl peşə seçin.", reply_markup=_KB_PROFESSIONS)
             return
-        db.init_group_codes()
         if not db.is_group_code_valid(profession=prof, code=code):
             await message.answer("❌ Kod yanlışdır. Yenidən cəhd edin.")
             return
         await state.update_data(code=code)
         await state.set_state(Reg.name)
         await message.answer("Ad Soyad daxil edin:")
-    except Exception as e:
-        print(f"[reg_enter_code] error: {e}")
+    except Exception:
+        logger.exception("[reg_enter_code] error")
         await state.clear()
         await message.answer("❌ Xəta baş verdi. Qeydiyyatı yenidən başlayın: /start")
 
 
 @dp.message(Reg.name)
 async def reg_enter_name(message: Message, state: FSMContext) -> None:
-    name = (message.text or "").strip()
+    name = _txt(message)
     if len(name) < 3:
         await message.answer("Ad ən azı 3 simvol olmalıdır.")
         return
@@ -850,8 +1129,8 @@ async def reg_enter_name(message: Message, state: FSMContext) -> None:
 
 @dp.message(Reg.fin)
 async def reg_enter_fin(message: Message, state: FSMContext) -> None:
-    fin = (message.text or "").strip().upper()
-    if not (7 <= len(fin) <= 10):
+    fin = _txt(message, upper=True)
+    if not _FIN_RE.match(fin):
         await message.answer("FIN düzgün deyil. Yenidən daxil edin.")
         return
     await state.update_data(fin=fin)
@@ -859,25 +1138,23 @@ async def reg_enter_fin(message: Message, state: FSMContext) -> None:
     await message.answer("Vəsiqənin seriya və nömrəsini daxil edin:")
 
 
+_SERIYA_ERROR = (
+    "Vəsiqə seriyası/nömrəsi düzgün deyil. Nümunələr: AA1234567 və ya AZE12345678. "
+    "Yalnız latın hərfləri və rəqəmlər, boşluq olmadan."
+)
+
+
+def validate_seriya(val: str) -> tuple[bool, str]:
+    """Vəsiqə seriyasını yoxlayır. Returns: (is_valid, normalized or error_message)"""
+    s = val.replace(" ", "").upper()
+    if _SERIYA_RE1.match(s) or _SERIYA_RE2.match(s):
+        return True, s
+    return False, _SERIYA_ERROR
+
+
 @dp.message(Reg.document_series_number)
 async def reg_enter_document_series_number(message: Message, state: FSMContext) -> None:
-    raw_value = (message.text or "").strip()
-
-    def validate_seriya(val: str) -> tuple[bool, str]:
-        s = val.replace(" ", "").upper()
-        # Nümunələr: AA1234567 (2 hərf + 7 rəqəm), AZE12345678 (passport)
-        patterns = [
-            r"^[A-Z]{2}\d{7}$",
-            r"^[A-Z]{3}\d{8}$",
-        ]
-        for p in patterns:
-            if re.match(p, s):
-                return True, s
-        return False, (
-            "Vəsiqə seriyası/nömrəsi düzgün deyil. Nümunələr: AA1234567 və ya AZE12345678. "
-            "Yalnız latın hərfləri və rəqəmlər, boşluq olmadan."
-        )
-
+    raw_value = _txt(message)
     ok, normalized = validate_seriya(raw_value)
     if not ok:
         await message.answer(normalized)
@@ -888,58 +1165,69 @@ async def reg_enter_document_series_number(message: Message, state: FSMContext)
     await message.answer("Telefon nömrənizi daxil edin (məs: 501234567 və ya 0501234567):")
 
 
+_OPERATORS = frozenset({"50", "51", "55", "60", "70", "77", "10", "12", "90", "99"})
+# 0 ilə başlayan yerli formatda 90/99 qəbul edilmir
+_OPERATORS_LOCAL = _OPERATORS - {"90", "99"}
+_PHONE_EMPTY_ERROR = "Telefon nömrəsi boş ola bilməz. Zəhmət olmasa telefon nömrənizi daxil edin."
+_PHONE_INVALID_ERROR = "Telefon nömrəsi düzgün deyil. Nümunə: 501234567 və ya 0501234567"
+_PHONE_FORMAT_ERROR = "Telefon nömrəsi düzgün formatda deyil. Nümunə: 501234567 və ya 0501234567"
+_PHONE_SEPARATORS = str.maketrans("", "", " -()")
+
+
 def validate_and_normalize_phone(phone: str) -> tuple[bool, str]:
     """
     Telefon nömrəsini yoxlayır və normalize edir.
     Returns: (is_valid, normalized_phone or error_message)
     """
     phone = phone.strip()
-    
+
     # Boş ola bilməz
     if not phone:
-        return (False, "Telefon nömrəsi boş ola bilməz. Zəhmət olmasa telefon nömrənizi daxil edin.")
-    
-    # Yalnız rəqəmlər və + simvolu
-    clean_phone = phone.replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
+        return (False, _PHONE_EMPTY_ERROR)
+
+    # Tək keçid: boşluq/tire/mötərizələri at, rəqəmləri yığ, "+" yalnız əvvəldə
+    buf: list[str] = []
+    plus = False
+    for ch in phone:
+        if "0" <= ch <= "9":
+            buf.append(ch)
+        elif ch == "+" and not buf and not plus:
+            plus = True
+        elif ch in " -()":
+            continue
+        else:
+            # Əvvəlki mesaj seçimi saxlanılır: +994/994/0 ilə başlayan nömrədə "düzgün deyil"
+            if phone.translate(_PHONE_SEPARATORS).startswith(("+994", "994", "0")):
+                return (False, _PHONE_INVALID_ERROR)
+            return (False, _PHONE_FORMAT_ERROR)
+    digits = "".join(buf)
+    n = len(digits)
 
     # 9 rəqəmli yerli format (məs: 501234567) -> +994501234567
-    if len(clean_phone) == 9 and clean_phone.isdigit():
-        if clean_phone.startswith(("50", "51", "55", "60", "70", "77", "10", "12", "90", "99")):
-            return (True, f"+994{clean_phone}")
-        return (False, "Telefon nömrəsi düzgün deyil. Nümunə: 501234567 və ya 0501234567")
-    
-    # +994 formatında
-    if clean_phone.startswith("+994"):
-        digits = clean_phone[4:]  # +994-dən sonra
-        if len(digits) == 9 and digits.isdigit():
-            # Operator kodu ilə başlamalıdır (50, 51, 55, 60, 70, 77, 10, 12, 90, 99)
-            if digits.startswith(("50", "51", "55", "60", "70", "77", "10", "12", "90", "99")):
-                return (True, f"+994{digits}")
-        return (False, "Telefon nömrəsi düzgün deyil. Nümunə: 501234567 və ya 0501234567")
-    
-    # 994 formatında (+ olmadan)
-    if clean_phone.startswith("994"):
-        digits = clean_phone[3:]  # 994-dən sonra
-        if len(digits) == 9 and digits.isdigit():
-            if digits.startswith(("50", "51", "55", "60", "70", "77", "10", "12", "90", "99")):
-                return (True, f"+994{digits}")
-        return (False, "Telefon nömrəsi düzgün deyil. Nümunə: 501234567 və ya 0501234567")
-    
+    if n == 9 and not plus:
+        if digits[:2] in _OPERATORS:
+            return (True, f"+994{digits}")
+        return (False, _PHONE_INVALID_ERROR)
+
+    # +994 / 994 formatında
+    if digits.startswith("994"):
+        if n == 12 and digits[3:5] in _OPERATORS:
+            return (True, f"+{digits}")
+        return (False, _PHONE_INVALID_ERROR)
+
     # 0 ilə başlayır (yerli format: 050, 051, və s.)
-    if clean_phone.startswith("0"):
-        if len(clean_phone) == 10 and clean_phone.isdigit():
-            operator = clean_phone[1:3]  # 0-dan sonra 2 rəqəm
-            if operator in ("50", "51", "55", "60", "70", "77", "10", "12"):
-                # 0-ı çıxarıb +994 əlavə et
-                return (True, f"+994{clean_phone[1:]}")
-        return (False, "Telefon nömrəsi düzgün deyil. Nümunə: 501234567 və ya 0501234567")
-    
-    return (False, "Telefon nömrəsi düzgün formatda deyil. Nümunə: 501234567 və ya 0501234567")
+    if digits.startswith("0") and not plus:
+        if n == 10 and digits[1:3] in _OPERATORS_LOCAL:
+            # 0-ı çıxarıb +994 əlavə et
+            return (True, f"+994{digits[1:]}")
+        return (False, _PHONE_INVALID_ERROR)
+
+    return (False, _PHONE_FORMAT_ERROR)
 
 
 @dp.message(Reg.phone_number)
 async def reg_enter_phone_number(message: Message, state: FSMContext) -> None:
-    phone_raw = (message.text or "").strip()
+    phone_raw = _txt(message)
     
     # Telefon nömrəsini yoxla və normalize et
     is_valid, result = validate_and_normalize_phone(phone_raw)
@@ -961,21 +1249,15 @@ async def reg_enter_phone_number(message: Message, state: FSMContext) -> None:
         await message.answer("❌ Xəta. Qeydiyyatı yenidən başlayın: /start")
         return
 
-    # Save/Update user profile with all fields
-    db.upsert_user_profile(telegram_id=user.id, name=name, fin=fin, code=code, seriya=document_series_number, phone_number=phone_number)
-
-    # Fetch user row to get users.id
-    prof = db.get_user_by_telegram_id(user.id)
+    # Save/Update user profile with all fields (returns users.id)
+    legacy_user_id = db.upsert_user_profile(telegram_id=user.id, name=name, fin=fin, code=code, seriya=document_series_number, phone_number=phone_number)
     today = today_baku()
 
-    # Duplicate protection for same user + profession + code + date
-    if prof and isinstance(prof.get("id"), int):
-        legacy_user_id = int(prof["id"])  # type: ignore[index]
-        if db.has_registration(legacy_user_id, today, profession, code):
-            await state.clear()
-            await message.answer("ℹ️ Bu gün üçün artıq qeydiyyatınız var.", reply_markup=worker_keyboard())
-            return
-        db.add_registration(legacy_user_id, today, profession, code)
+    # Duplicate protection for same user + profession + code + date (UNIQUE constraint)
+    if not db.add_registration(legacy_user_id, today, profession, code):
+        await state.clear()
+        await message.answer("ℹ️ Bu gün üçün artıq qeydiyyatınız var.", reply_markup=_KB_WORKER)
+        return
 
     await state.clear()
     
@@ -989,7 +1271,7 @@ async def reg_enter_phone_number(message: Message, state: FSMContext) -> None:
         f"💼 Peşə: {profession}\n\n"
         "Menyudan istifadə edin."
     )
-    await message.answer(confirmation_message, reply_markup=worker_keyboard())
+    await message.answer(confirmation_message, reply_markup=_KB_WORKER)
     
     # Xüsusi xəbərdarlıq mesajı
     warning_message = (
@@ -1014,20 +1296,15 @@ async def reg_enter_phone_number(message: Message, state: FSMContext) -> None:
                 user_fin=fin,
                 code=code
             )
-        except Exception as e:
-            print(f"[reg_enter_phone_number] Admin bildirişi xətası: {e}")
+        except Exception:
+            logger.exception("[reg_enter_phone_number] Admin bildirişi xətası")
 
 
 # ================== ADMIN ƏMRLƏRİ ==================
 
 @dp.message(Command("bugun"))
+@admin_only()
 async def cmd_bugun(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-
-    db.init_registrations()
     today = today_baku()
     rows = db.get_registrations_summary(today)
     if not rows:
@@ -1042,24 +1319,17 @@ async def cmd_bugun(message: Message) -> None:
         lines.append(f"{prof} | {code} | {cnt}")
 
     txt = "\n".join(lines)
-    for part in chunk_send(txt):
-        await message.answer(part)
+    await send_text_or_doc(message, txt, filename="qeydiyyatlar.txt")
 
 
 @dp.message(F.text == "👥 İşçilər")
+@admin_only()
 async def btn_isciler(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    db.init_db()
-    workers = db.get_all_workers_status()
-    today = today_baku()
-    db.init_group_codes()
-    active_rows = db.get_group_codes(active_on=today, only_active=True)
-    active_codes = {r.get('code') for r in active_rows}
+    active_codes = _get_active_codes(today_baku())
     if active_codes:
-        workers = [w for w in workers if (w.get('code') in active_codes)]
+        workers = db.get_workers_status_by_codes(sorted(active_codes))
+    else:
+        workers = db.get_all_workers_status()
     if not workers:
         await message.answer("❌ Heç bir işçi qeydiyyatdan keçməyib.")
         return
@@ -1070,16 +1340,15 @@ async def btn_isciler(message: Message) -> None:
         code = w.get('code') or '-'
         by_code.setdefault(code, []).append(w)
 
-    msg_lines: list[str] = ["👥 İşçilər siyahısı\n"]
+    buf = io.StringIO()
+    buf.write("👥 İşçilər siyahısı\n\n")
     for code, lst in sorted(by_code.items()):
-        msg_lines.append(f"📋 Kod: {code} ({len(lst)})")
+        buf.write(f"📋 Kod: {code} ({len(lst)})\n")
         for w in lst:
-            msg_lines.append(f"• {w.get('name','?')} | FIN: {w.get('fin','-')}")
-        msg_lines.append("")
+            buf.write(f"• {w.get('name','?')} | FIN: {w.get('fin','-')}\n")
+        buf.write("\n")
 
-    text = "\n".join(msg_lines)
-    for part in chunk_send(text):
-        await message.answer(part)
+    await send_text_or_doc(message, buf.getvalue(), filename="isciler.txt")
 
 
 @dp.message(Command("isciler"))
@@ -1094,12 +1363,8 @@ async def btn_bugun(message: Message) -> None:
 
 
 @dp.message(F.text == "🎛 Menyu")
+@admin_only()
 async def btn_menu(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    
     # Get statistics
     stats = db.get_total_registered_students()
     today = today_baku()
@@ -1122,51 +1387,30 @@ async def btn_menu(message: Message) -> None:
         "👨‍👩‍👧‍👦 Qruplar — qrup idarəetməsi",
         "🎓 Tələbələr — tələbə idarəetməsi",
     ]
-    await message.answer("\n".join(lines), reply_markup=admin_keyboard())
+    await message.answer("\n".join(lines), reply_markup=_KB_ADMIN)
 
 
 @dp.message(F.text == "➕ Bugünün kodu")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_add_today_code(message: Message, state: FSMContext) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
     await state.clear()
     await state.set_state(AdminAddG.profession)
-    await message.answer("Peşə seçin:", reply_markup=professions_keyboard())
+    await message.answer("Peşə seçin:", reply_markup=_KB_PROFESSIONS)
 
 
 @dp.message(AdminAddG.profession)
 async def adminadd_pick_prof(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     if text == "❌ Ləğv et":
         await state.clear()
-        await message.answer("Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
 
-    chosen = None
     raw = text.strip('"\' ').strip()
-
-    idx_part = raw.split(".", 1)[0]
-    if idx_part.isdigit():
-        idx = int(idx_part) - 1
-        if 0 <= idx < len(PROFESSIONS):
-            chosen = PROFESSIONS[idx]
-
-    if not chosen:
-        for s in PROFESSIONS:
-            if s.lower() == raw.lower():
-                chosen = s
-                break
+    chosen = _pick_profession(raw)
 
     if not chosen:
-        for s in PROFESSIONS:
-            if raw.lower() in s.lower():
-                chosen = s
-                break
-
-    if not chosen:
-        await message.answer("Düzgün peşə seçin.", reply_markup=professions_keyboard())
+        await message.answer("Düzgün peşə seçin.", reply_markup=_KB_PROFESSIONS)
         return
 
     await state.update_data(profession=chosen)
@@ -1176,7 +1420,7 @@ async def adminadd_pick_prof(message: Message, state: FSMContext) -> None:
 
 @dp.message(AdminAddG.code)
 async def adminadd_enter_code(message: Message, state: FSMContext) -> None:
-    code = (message.text or "").strip()
+    code = _txt(message)
     if not code:
         await message.answer("Kod boş ola bilməz.")
         return
@@ -1187,30 +1431,22 @@ async def adminadd_enter_code(message: Message, state: FSMContext) -> None:
         today = today_baku()
     else:
         today = date
-    db.init_group_codes()
 
-    ok = False
-    for attempt in range(3):
-        try:
-            ok = db.add_group_code(profession=profession, date=today, code=str(code), is_active=1)
-            break
-        except sqlite3.OperationalError as e:
-            if 'locked' in str(e).lower():
-                await asyncio.sleep(0.5 * (attempt + 1))
-                continue
-            raise
+    try:
+        ok = await _sqlite_retry(db.add_group_code, profession=profession, date=today, code=str(code), is_active=1)
+        if ok:
+            _active_codes_cache.clear()
+    except sqlite3.OperationalError:
+        logger.exception("[adminadd_enter_code] error")
+        ok = False
     await state.clear()
-    await message.answer("✅ Yadda saxlandı" if ok else "❌ Xəta", reply_markup=admin_keyboard())
+    await message.answer("✅ Yadda saxlandı" if ok else "❌ Xəta", reply_markup=_KB_ADMIN)
 
 
 @dp.message(F.text == "📜 Kodlar")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_view_codes(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
     today = today_baku()
-    db.init_group_codes()
     rows = db.get_group_codes(date=today, only_active=None)
     if not rows:
         await message.answer("Bu gün üçün kod yoxdur.")
@@ -1222,68 +1458,39 @@ async def btn_view_codes(message: Message) -> None:
 
 
 @dp.message(F.text == "🗒 Qeydiyyatlar")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_regs_today(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
     today = today_baku()
     rows = db.get_registrations(date=today)
     if not rows:
         await message.answer("Bu gün qeydiyyat yoxdur.")
         return
-    lines = ["Bu günün qeydiyyatları:"]
+    buf = io.StringIO()
+    buf.write("Bu günün qeydiyyatları:")
     for r in rows:
-        lines.append(f"• {r.get('profession')} | {r.get('code')} — {r.get('name')} (FIN: {r.get('fin')})")
-    await message.answer("\n".join(lines))
+        buf.write(f"\n• {r.get('profession')} | {r.get('code')} — {r.get('name')} (FIN: {r.get('fin')})")
+    await message.answer(buf.getvalue())
 
 
 @dp.message(F.text == "👨‍👩‍👧‍👦 Qruplar")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_manage_groups(message: Message, state: FSMContext) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
-    
     await state.clear()
     await state.set_state(AdminManageGroup.action)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="➕ Qrup kodu əlavə et")],
-            [KeyboardButton(text="🗑 Qrup kodu sil")],
-            [KeyboardButton(text="📋 Qrup kodlarını göstər")],
-            [KeyboardButton(text="❌ Ləğv et")],
-        ],
-        resize_keyboard=True
-    )
     await message.answer(
         "Qrup idarəetməsi:\n\n"
         "• Qrup kodu əlavə et - yeni qrup kodu əlavə edin\n"
         "• Qrup kodu sil - mövcud qrup kodunu silin\n"
         "• Qrup kodlarını göstər - mövcud kodları görün",
-        reply_markup=kb
+        reply_markup=_KB_MANAGE_GROUPS
     )
 
 
 @dp.message(F.text == "🎓 Tələbələr")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_manage_students(message: Message, state: FSMContext) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
-    
     await state.clear()
     await state.set_state(AdminManageStudent.action)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📋 Tələbələri göstər"), KeyboardButton(text="🗑 Tələbə sil")],
-            [KeyboardButton(text="✏️ Tələbənin məlumatını dəyiş")],
-            [KeyboardButton(text="🔒 Tələbəni deaktiv et"), KeyboardButton(text="🔓 Tələbəni aktiv et")],
-            [KeyboardButton(text="🔒 Qrup tələbələrini deaktiv et"), KeyboardButton(text="🔓 Qrup tələbələrini aktiv et")],
-            [KeyboardButton(text="❌ Ləğv et")],
-        ],
-        resize_keyboard=True
-    )
     await message.answer(
         "Tələbə idarəetməsi:\n\n"
         "• Tələbələri göstər - tələbələrin siyahısını görün\n"
@@ -1292,42 +1499,37 @@ async def btn_manage_students(message: Message, state: FSMContext) -> None:
         "• Tələbəni aktiv et - tələbə üçün giriş-çıxışı açın\n"
         "• Qrup tələbələrini deaktiv et - qrupun bütün tələbələrini deaktiv edin\n"
         "• Qrup tələbələrini aktiv et - qrupun bütün tələbələrini aktiv edin",
-        reply_markup=kb
+        reply_markup=_KB_MANAGE_STUDENTS
     )
 
 
+_LOG_ENTRY_TMPL = (
+    "\n\n• {profession} | {code}"
+    "\n  {name} (FIN: {fin})"
+    "\n  🟢 {giris_time}  📍 {giris_loc}"
+    "\n  🔴 {cixis_time}  📍 {cixis_loc}"
+)
+
+
 @dp.message(F.text == "📡 Loglar")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_logs_today(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
     today = today_baku()
-    rows = db.get_attendance_logs(date=today)
+    rows = db.get_attendance_logs(date=today, limit=30)  # qısa baxış
     if not rows:
         await message.answer("Bu gün üçün log yoxdur.")
         return
-    lines: list[str] = ["Bu günün giriş/çıxış logları:"]
-    for r in rows[:30]:  # qısa baxış
-        lines.append(
-            "\n".join([
-                f"• {r.get('profession','-')} | {r.get('code','-')}",
-                f"  {r.get('name','?')} (FIN: {r.get('fin','-')})",
-                f"  🟢 {r.get('giris_time','-')}  📍 {r.get('giris_loc','-')}",
-                f"  🔴 {r.get('cixis_time','-')}  📍 {r.get('cixis_loc','-')}",
-            ])
-        )
-    for part in chunk_send("\n\n".join(lines)):
-        await message.answer(part)
+    buf = io.StringIO()
+    buf.write("Bu günün giriş/çıxış logları:")
+    for r in rows:
+        # get_attendance_logs həmişə bütün sütunları qaytarır
+        buf.write(_LOG_ENTRY_TMPL.format_map(r))
+    await send_text_or_doc(message, buf.getvalue(), filename="loglar.txt")
 
 
 @dp.message(F.text == "📈 Kod üzrə hesabat")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_report_code(message: Message, state: FSMContext) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
-    
     await state.clear()
     await state.set_state(AdminReportByCode.date)
     today = today_baku()
@@ -1339,7 +1541,7 @@ async def btn_report_code(message: Message, state: FSMContext) -> None:
 
 @dp.message(AdminReportByCode.date)
 async def adminreport_date(message: Message, state: FSMContext) -> None:
-    date_raw = (message.text or "").strip()
+    date_raw = _txt(message)
     date = _parse_date_or_today(date_raw)
     if not date:
         await message.answer("Tarix formatı düzgündürmü? YYYY-MM-DD və ya 'bugun' yazın.")
@@ -1351,54 +1553,38 @@ async def adminreport_date(message: Message, state: FSMContext) -> None:
 
 @dp.message(AdminReportByCode.code)
 async def adminreport_code(message: Message, state: FSMContext) -> None:
-    code = (message.text or "").strip()
+    code = _txt(message)
     data = await state.get_data()
     date = data.get("date")
     if not date or not code:
         await state.clear()
-        await message.answer("❌ Xəta. Yenidən başlayın: '📈 Kod üzrə hesabat'", reply_markup=admin_keyboard())
+        await message.answer("❌ Xəta. Yenidən başlayın: '📈 Kod üzrə hesabat'", reply_markup=_KB_ADMIN)
         return
     rows = db.get_attendance_logs(date=date, code=code)
     await state.clear()
     if not rows:
-        await message.answer("Məlumat tapılmadı.", reply_markup=admin_keyboard())
+        await message.answer("Məlumat tapılmadı.", reply_markup=_KB_ADMIN)
         return
-    lines: list[str] = [f"Hesabat — {date} | Kod: {code}"]
+    buf = io.StringIO()
+    buf.write(f"Hesabat — {date} | Kod: {code}")
     for r in rows:
-        lines.append(
-            "\n".join([
-                f"• {r.get('name','?')} (FIN: {r.get('fin','-')})",
-                f"  Peşə: {r.get('profession','-')}",
-                f"  🟢 {r.get('giris_time','-')}  📍 {r.get('giris_loc','-')}",
-                f"  🔴 {r.get('cixis_time','-')}  📍 {r.get('cixis_loc','-')}",
-            ])
+        buf.write(
+            f"\n• {r.get('name','?')} (FIN: {r.get('fin','-')})"
+            f"\n  Peşə: {r.get('profession','-')}"
+            f"\n  🟢 {r.get('giris_time','-')}  📍 {r.get('giris_loc','-')}"
+            f"\n  🔴 {r.get('cixis_time','-')}  📍 {r.get('cixis_loc','-')}"
         )
-    txt = "\n".join(lines)
-    for part in chunk_send(txt):
-        await message.answer(part)
+    await send_text_or_doc(message, buf.getvalue(), filename="hesabat.txt")
 
 
 @dp.message(F.text == "📥 Excel hesabat")
+@admin_only(_ADMIN_ONLY_ACTION)
 async def btn_excel_report(message: Message, state: FSMContext) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əməliyyat yalnız admin üçündür.")
-        return
-    
     await state.clear()
     await state.set_state(AdminPeriodReport.period_type)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📊 Gündəlik"), KeyboardButton(text="📅 Həftəlik")],
-            [KeyboardButton(text="📆 Aylıq"), KeyboardButton(text="🔖 Kod üzrə")],
-            [KeyboardButton(text="🗓 Tarix aralığı")],
-            [KeyboardButton(text="❌ Ləğv et")],
-        ],
-        resize_keyboard=True
-    )
     await message.answer(
         "Hesabat növünü seçin:",
-        reply_markup=kb
+        reply_markup=_KB_PERIOD
     )
 
 
@@ -1406,11 +1592,11 @@ async def btn_excel_report(message: Message, state: FSMContext) -> None:
 
 @dp.message(AdminPeriodReport.period_type)
 async def admin_period_type(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     
     if text == "❌ Ləğv et":
         await state.clear()
-        await message.answer("Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
     
     period_map = {
@@ -1452,7 +1638,7 @@ async def admin_period_type(message: Message, state: FSMContext) -> None:
 
 @dp.message(AdminPeriodReport.start_date)
 async def admin_period_start_date(message: Message, state: FSMContext) -> None:
-    date_raw = (message.text or "").strip()
+    date_raw = _txt(message)
     date = _parse_date_or_today(date_raw)
     
     if not date:
@@ -1470,13 +1656,7 @@ async def admin_period_start_date(message: Message, state: FSMContext) -> None:
         await state.set_state(AdminPeriodReport.format_type)
         await message.answer(
             "Format seçin:",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="📊 Excel"), KeyboardButton(text="📄 CSV")],
-                    [KeyboardButton(text="❌ Ləğv et")],
-                ],
-                resize_keyboard=True
-            )
+            reply_markup=_KB_FORMAT
         )
     else:
         await state.set_state(AdminPeriodReport.end_date)
@@ -1489,7 +1669,7 @@ async def admin_period_start_date(message: Message, state: FSMContext) -> None:
 
 @dp.message(AdminPeriodReport.end_date)
 async def admin_period_end_date(message: Message, state: FSMContext) -> None:
-    date_raw = (message.text or "").strip()
+    date_raw = _txt(message)
     date = _parse_date_or_today(date_raw)
     
     if not date:
@@ -1507,19 +1687,13 @@ async def admin_period_end_date(message: Message, state: FSMContext) -> None:
     await state.set_state(AdminPeriodReport.format_type)
     await message.answer(
         "Format seçin:",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="📊 Excel"), KeyboardButton(text="📄 CSV")],
-                [KeyboardButton(text="❌ Ləğv et")],
-            ],
-            resize_keyboard=True
-        )
+        reply_markup=_KB_FORMAT
     )
 
 
 @dp.message(AdminPeriodReport.code)
 async def admin_period_code(message: Message, state: FSMContext) -> None:
-    code = (message.text or "").strip()
+    code = _txt(message)
     if not code:
         await message.answer("❌ Kod boş ola bilməz.")
         return
@@ -1533,13 +1707,99 @@ async def admin_period_code(message: Message, state: FSMContext) -> None:
     )
 
 
+def _iter_report_rows(start_dt: _date, end_dt: _date, code: Optional[str]) -> Iterator[dict]:
+    """Dövr hesabatı sətirlərini tarixə görə sıralı verir (bütün dövr bir sorğu ilə alınır).
+
+    Period/range hesabatlarında boş sətrlər (heç bir data olmayan) SQL tərəfində çıxarılır.
+    """
+    yield from db.get_range_report_for_excel(
+        start_dt.isoformat(), end_dt.isoformat(), code, only_with_data=True
+    )
+
+
+_ANNOTATE_BATCH_ROWS = 500
+
+
+def _annotate_row(row: dict) -> None:
+    """Bir sətirə status, pozuntular və lokasiya sahələrini yazır (ünvan hələ koordinat kimi)."""
+    start_lat = row.get('start_lat')
+    start_lon = row.get('start_lon')
+    end_lat = row.get('end_lat')
+    end_lon = row.get('end_lon')
+    # Koordinatları bir dəfə float-a çeviririk; həm qayda yoxlaması, həm lokasiya bunları işlədir
+    start_lat = float(start_lat) if start_lat is not None else None
+    start_lon = float(start_lon) if start_lon is not None else None
+    end_lat = float(end_lat) if end_lat is not None else None
+    end_lon = float(end_lon) if end_lon is not None else None
+    if start_lat is not None and start_lon is not None:
+        lat, lon = start_lat, start_lon
+    elif end_lat is not None and end_lon is not None:
+        lat, lon = end_lat, end_lon
+    else:
+        lat = lon = None
+    row['_lat'] = lat
+    row['_lon'] = lon
+
+    status, violations = check_rules_violation(
+        row.get('giris_time'), row.get('cixis_time'),
+        start_lat, start_lon, end_lat, end_lon,
+        row.get('is_active', 1),
+        _RULES,
+    )
+    row['status'] = get_status_name(status)
+    row['violations'] = "; ".join(render_violations(violations)) if violations else "-"
+
+    # Precompute location fields for both Excel and CSV exports
+    row['gps_coords'] = '-'
+    row['address'] = '-'
+    row['maps_link'] = '-'
+    try:
+        if lat is not None:
+            row['gps_coords'] = f"{lat}, {lon}"
+            # Ünvan aşağıda keşdən doldurulur; yoxdursa koordinat qalır
+            row['address'] = row['gps_coords']
+            row['maps_link'] = _MAPS_POINT(lat, lon)
+        else:
+            # Fallback to legacy location text fields
+            giris_loc = (row.get('giris_loc') or '').strip()
+            cixis_loc = (row.get('cixis_loc') or '').strip()
+            address = giris_loc or cixis_loc
+            if address:
+                row['address'] = address
+                row['maps_link'] = _MAPS_SEARCH(_encode_addr(address))
+    except Exception:
+        logger.exception("[_annotate_row] Error computing location fields")
+
+
+def _annotate_report_rows(rows: Iterable[dict]) -> Iterator[dict]:
+    """Hər sətirə status, pozuntular və lokasiya sahələrini əlavə edir (Excel və CSV üçün).
+
+    Sətirlər partiyalarla emal olunur (axın kimi, bütün dövr yaddaşa yığılmır); hər partiyanın
+    ünvanları geocode_cache cədvəlindən bir toplu sorğu ilə götürülür, keşdə olmayanlar koordinat kimi qalır.
+    """
+    it = iter(rows)
+    while batch := list(islice(it, _ANNOTATE_BATCH_ROWS)):
+        for row in batch:
+            _annotate_row(row)
+        try:
+            addresses = db.get_geocodes([(r['_lat'], r['_lon']) for r in batch if r['_lat'] is not None])
+        except Exception:
+            logger.exception("[_annotate_report_rows] Geocode cache error")
+            addresses = {}
+        if addresses:
+            for row in batch:
+                if row['_lat'] is not None:
+                    row['address'] = addresses.get((row['_lat'], row['_lon']), row['address'])
+        yield from batch
+
+
 @dp.message(AdminPeriodReport.format_type)
 async def admin_period_format(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     
     if text == "❌ Ləğv et":
         await state.clear()
-        await message.answer("Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
     
     format_map = {
@@ -1560,129 +1820,42 @@ async def admin_period_format(message: Message, state: FSMContext) -> None:
     
     await state.clear()
     
+    filepath = None
     try:
+        # Parse once; state holds ISO strings produced by _parse_date_or_today
+        start_dt = _date.fromisoformat(start_date)
+        end_dt = _date.fromisoformat(end_date) if end_date else start_dt
+
         # Calculate date range based on period type
         if period_type == "weekly":
-            # Calculate week start and end
-            start_dt = datetime.strptime(start_date, "%Y-%m-%d").date()
             end_dt = start_dt + timedelta(days=6)
-            end_date = end_dt.isoformat()
         elif period_type == "monthly":
-            # Calculate month start and end
-            start_dt = datetime.strptime(start_date, "%Y-%m-%d").date()
-            # First day of month
-            month_start = start_dt.replace(day=1)
-            # Last day of month
-            if start_dt.month == 12:
-                month_end = start_dt.replace(year=start_dt.year + 1, month=1, day=1) - timedelta(days=1)
-            else:
-                month_end = start_dt.replace(month=start_dt.month + 1, day=1) - timedelta(days=1)
-            start_date = month_start.isoformat()
-            end_date = month_end.isoformat()
-        
-        def _has_real_day_data(r: dict) -> bool:
-            # Any attendance time, legacy location text, or GPS coords means this row is real
-            def _nonempty(v: object) -> bool:
-                if v is None:
-                    return False
-                s = str(v).strip()
-                return s != "" and s != "-"
-
-            return (
-                _nonempty(r.get('giris_time'))
-                or _nonempty(r.get('cixis_time'))
-                or _nonempty(r.get('giris_loc'))
-                or _nonempty(r.get('cixis_loc'))
-                or r.get('start_lat') is not None
-                or r.get('start_lon') is not None
-                or r.get('end_lat') is not None
-                or r.get('end_lon') is not None
-            )
-
-        # Get report data with explicit per-row date to avoid all rows having start_date
-        report_data: list[dict] = []
-        cur_dt = datetime.strptime(start_date, "%Y-%m-%d").date()
-        end_dt2 = datetime.strptime(end_date, "%Y-%m-%d").date()
-        while cur_dt <= end_dt2:
-            d = cur_dt.isoformat()
-            day_rows = db.get_daily_report_for_excel(d)
-            if code:
-                day_rows = [r for r in day_rows if r.get('code') == code]
-            # Period/range hesabatlarında boş sətrləri (heç bir data olmayan) çıxart
-            day_rows = [r for r in day_rows if _has_real_day_data(r)]
-            for r in day_rows:
-                r['date'] = d
-                report_data.append(r)
-            cur_dt += timedelta(days=1)
+            last_day = calendar.monthrange(start_dt.year, start_dt.month)[1]
+            end_dt = start_dt.replace(day=last_day)
+            start_dt = start_dt.replace(day=1)
+        start_date = start_dt.isoformat()
+        end_date = end_dt.isoformat()
         
-        if not report_data:
-            await message.answer("❌ Seçilən dövrdə məlumat tapılmadı.", reply_markup=admin_keyboard())
+        rows = _annotate_report_rows(_iter_report_rows(start_dt, end_dt, code))
+        # Sorğu və annotasiya ilk next()-də işləyir - event loop-u bloklamasın deyə thread-də
+        first = await asyncio.to_thread(next, rows, None)
+        if first is None:
+            await message.answer("❌ Seçilən dövrdə məlumat tapılmadı.", reply_markup=_KB_ADMIN)
             return
-        
-        # Add status and violations to each row
-        for row in report_data:
-            giris_time = row.get('giris_time')
-            cixis_time = row.get('cixis_time')
-            start_lat = row.get('start_lat')
-            start_lon = row.get('start_lon')
-            end_lat = row.get('end_lat')
-            end_lon = row.get('end_lon')
-            is_active = row.get('is_active', 1)
-            
-            status, violations = check_rules_violation(
-                giris_time, cixis_time,
-                float(start_lat) if start_lat is not None else None,
-                float(start_lon) if start_lon is not None else None,
-                float(end_lat) if end_lat is not None else None,
-                float(end_lon) if end_lon is not None else None,
-                is_active,
-                CHECKIN_DEADLINE_HOUR, CHECKOUT_DEADLINE_HOUR, MIN_WORK_DURATION_HOURS,
-                WORKPLACE_LAT, WORKPLACE_LON, WORKPLACE_RADIUS_M, LOCATION_TOLERANCE_M
-            )
-            row['status'] = get_status_name(status)
-            row['violations'] = "; ".join(violations) if violations else "-"
+        report_data = chain((first,), rows)
 
-            # Precompute location fields for both Excel and CSV exports
-            row['gps_coords'] = '-'
-            row['address'] = '-'
-            row['maps_link'] = '-'
-            try:
-                lat = None
-                lon = None
-                if start_lat is not None and start_lon is not None:
-                    lat = float(start_lat)
-                    lon = float(start_lon)
-                elif end_lat is not None and end_lon is not None:
-                    lat = float(end_lat)
-                    lon = float(end_lon)
-
-                if lat is not None and lon is not None:
-                    row['gps_coords'] = f"{lat}, {lon}"
-                    # Sync context: use coordinates (geocoding cache is async-only)
-                    row['address'] = row['gps_coords']
-                    row['maps_link'] = f"https://maps.google.com/?q={lat},{lon}"
-                else:
-                    # Fallback to legacy location text fields
-                    giris_loc = (row.get('giris_loc') or '').strip()
-                    cixis_loc = (row.get('cixis_loc') or '').strip()
-                    address = giris_loc or cixis_loc
-                    if address:
-                        row['address'] = address
-                        encoded_address = urllib.parse.quote(address)
-                        row['maps_link'] = f"https://www.google.com/maps/search/?api=1&query={encoded_address}"
-            except Exception as e:
-                print(f"[admin_period_format] Error computing location fields: {e}")
-        
         await message.answer(f"📊 Hesabat hazırlanır... (Format: {format_type.upper()})")
         
         if format_type == "excel":
             # For daily reports, use existing function
             if period_type == "daily":
-                filepath = generate_daily_excel_report(start_date)
-                filename = f"hesabat_{start_date}.xlsx"
+                filepath = await asyncio.to_thread(generate_daily_excel_report, start_date, code)
+                filename = f"hesabat_{start_date}_{code}.xlsx" if code else f"hesabat_{start_date}.xlsx"
             else:
                 # For period reports, create Excel with all dates
-                filepath = generate_period_excel_report(report_data, start_date, end_date, code)
+                filepath = await asyncio.to_thread(
+                    generate_period_excel_report, report_data, start_date, end_date, code
+                )
                 period_name = f"{start_date}_to_{end_date}"
                 if code:
                     period_name += f"_{code}"
@@ -1707,7 +1880,7 @@ async def admin_period_format(message: Message, state: FSMContext) -> None:
             if code:
                 period_name += f"_{code}"
             filename = f"hesabat_{period_name}.csv"
-            filepath = generate_csv_report(report_data, filename)
+            filepath = await generate_csv_report_async(report_data, filename)
             
             document = FSInputFile(filepath, filename=filename)
             period_str = f"{start_date}"
@@ -1721,75 +1894,59 @@ async def admin_period_format(message: Message, state: FSMContext) -> None:
                 caption=f"📥 Hesabat - {period_str}\n\nFormat: CSV"
             )
         
-        # Clean up
-        try:
-            os.remove(filepath)
-        except Exception:
-            pass
-            
-        await message.answer("✅ Hesabat göndərildi.", reply_markup=admin_keyboard())
+        await message.answer("✅ Hesabat göndərildi.", reply_markup=_KB_ADMIN)
         
     except Exception as e:
-        print(f"[admin_period_format] error: {e}")
-        await message.answer(f"❌ Xəta baş verdi: {str(e)}", reply_markup=admin_keyboard())
+        logger.exception("[admin_period_format] error")
+        await message.answer(f"❌ Xəta baş verdi: {str(e)}", reply_markup=_KB_ADMIN)
+    finally:
+        # Temp faylı həmişə sil (göndərmə xətası olsa belə)
+        if filepath:
+            try:
+                os.unlink(filepath)
+            except OSError:
+                pass
 
 
-def generate_period_excel_report(report_data: List[dict], start_date: str, end_date: str, code: Optional[str] = None) -> str:
-    """Generate Excel report for a date range. Similar to daily but includes all dates."""
-    # Group by date then by code
-    by_date_code: dict[str, dict[str, list[dict]]] = {}
-    for row in report_data:
-        date = row.get('date', start_date)
-        code_key = row.get('code') or '-'
-        if date not in by_date_code:
-            by_date_code[date] = {}
-        if code_key not in by_date_code[date]:
-            by_date_code[date][code_key] = []
-        by_date_code[date][code_key].append(row)
-    
-    wb = Workbook()
-    ws = wb.active
-    period_name = f"{start_date} - {end_date}"
+def generate_period_excel_report(report_data: Iterable[dict], start_date: str, end_date: str, code: Optional[str] = None) -> str:
+    """Generate Excel report for a date range. Similar to daily but includes all dates.
+
+    Written with xlsxwriter in constant_memory mode: rows are flushed to disk as
+    they are written, column widths are applied at the end.
+    `report_data` must already be ordered by date (_iter_report_rows gives it that way).
+    """
+    filename = f"hesabat_{start_date}_to_{end_date}"
     if code:
-        period_name += f" ({code})"
-    ws.title = f"Hesabat {period_name}"
-    
-    # Styles
-    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=12)
-    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    data_alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
-    
-    # Format dates
-    months_az = {
-        1: "Yanvar", 2: "Fevral", 3: "Mart", 4: "Aprel",
-        5: "May", 6: "İyun", 7: "İyul", 8: "Avqust",
-        9: "Sentyabr", 10: "Oktyabr", 11: "Noyabr", 12: "Dekabr"
-    }
-    
-    # Statistics
-    stats = db.get_total_registered_students()
-    active_on_start = db.get_active_students_count(start_date)
-    
-    # Write statistics
-    stats_row = 1
-    ws.cell(row=stats_row, column=1, value="📊 STATİSTİKA").font = Font(bold=True, color="FFFFFF", size=14)
-    ws.cell(row=stats_row, column=1).fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    ws.merge_cells(f'A{stats_row}:F{stats_row}')
-    
-    stats_row += 1
-    ws.cell(row=stats_row, column=1, value="Ümumi qeydiyyatdan keçən tələbələr:").font = Font(bold=True, size=11)
-    ws.cell(row=stats_row, column=2, value=stats['total']).font = Font(bold=True, size=11)
-    
-    stats_row += 1
-    ws.cell(row=stats_row, column=1, value="Aktiv tələbələr:").font = Font(bold=True, size=11, color="006100")
-    ws.cell(row=stats_row, column=2, value=stats['active']).font = Font(bold=True, size=11, color="006100")
-    
-    stats_row += 1
-    ws.cell(row=stats_row, column=1, value=f"Aktiv tələbə sayı ({start_date}):").font = Font(bold=True, size=11)
-    ws.cell(row=stats_row, column=2, value=active_on_start).font = Font(bold=True, size=11)
+        filename += f"_{code}"
+    filename += ".xlsx"
+    filepath = report_tempfile(filename)
     
-    stats_row += 2
+    workbook = xlsxwriter.Workbook(filepath, {
+        'constant_memory': True,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+    })
+    period_name = f"{start_date} - {end_date}"
+    if code:
+        period_name += f" ({code})"
+    # Excel vərəq adı maksimum 31 simvol ola bilər
+    ws = workbook.add_worksheet(f"Hesabat {period_name}"[:31])
+    
+    # Formats (created once per workbook)
+    title_fmt = workbook.add_format({'bold': True, 'font_color': '#FFFFFF', 'font_size': 14, 'bg_color': '#4472C4'})
+    stats_fmt = workbook.add_format({'bold': True, 'font_size': 11})
+    active_fmt = workbook.add_format({'bold': True, 'font_size': 11, 'font_color': '#006100'})
+    header_fmt = workbook.add_format({
+        'bold': True, 'font_color': '#FFFFFF', 'font_size': 12, 'bg_color': '#366092',
+        'align': 'center', 'valign': 'vcenter', 'text_wrap': True,
+    })
+    row_fmts: dict[str, object] = {}
+    link_fmts: dict[str, object] = {}
+    for key in ("ok", "violation", "inactive"):
+        color = f"#{get_status_color(key)}"
+        base = {'bg_color': color, 'align': 'left', 'valign': 'vcenter', 'text_wrap': True}
+        row_fmts[key] = workbook.add_format(base)
+        link_fmts[key] = workbook.add_format({**base, 'font_color': '#0000FF', 'underline': 1})
     
     # Headers
     headers = [
@@ -1797,29 +1954,42 @@ def generate_period_excel_report(report_data: List[dict], start_date: str, end_d
         "Qrup Kodu", "Peşə", "Giriş Saatı", "Çıxış Saatı",
         "GPS Koordinatları", "Lokasiya", "Xəritə Linki", "Status", "Qayda Pozuntuları"
     ]
+    widths = [len(h) for h in headers]
     
-    header_row = stats_row
-    for col_idx, header in enumerate(headers, start=1):
-        cell = ws.cell(row=header_row, column=col_idx, value=header)
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = header_alignment
-    
-    # Write data
+    # Statistics (rows 0-3, header on row 5)
+    stats = db.get_total_registered_students()
+    active_on_start = db.get_active_students_count(start_date)
+    stats_rows = [
+        ("Ümumi qeydiyyatdan keçən tələbələr:", stats['total'], stats_fmt),
+        ("Aktiv tələbələr:", stats['active'], active_fmt),
+        (f"Aktiv tələbə sayı ({start_date}):", active_on_start, stats_fmt),
+    ]
+    ws.merge_range(0, 0, 0, 5, "📊 STATİSTİKA", title_fmt)
+    widths[0] = max(widths[0], len("📊 STATİSTİKA"))
+    for offset, (label, value, fmt) in enumerate(stats_rows, start=1):
+        ws.write_string(offset, 0, label, fmt)
+        ws.write_number(offset, 1, value, fmt)
+        widths[0] = max(widths[0], len(label))
+        widths[1] = max(widths[1], len(str(value)))
+    
+    header_row = len(stats_rows) + 2
+    ws.write_row(header_row, 0, headers, header_fmt)
+    
+    link_col = headers.index("Xəritə Linki")
     row_num = header_row + 1
-    for date in sorted(by_date_code.keys()):
-        try:
-            date_obj = datetime.strptime(date, "%Y-%m-%d").date()
-            formatted_date = f"{date_obj.day} {months_az[date_obj.month]} {date_obj.year}"
-        except:
-            formatted_date = date
+    for date, day_rows in groupby(report_data, key=lambda r: r.get('date', start_date)):
+        formatted_date = _fmt_date_az(date)
         
-        for code_key, members in sorted(by_date_code[date].items()):
+        # Bir günün sətirləri qrup koduna görə sıralanır (stabil sort - daxili sıra qorunur)
+        for code_key, members in groupby(
+            sorted(day_rows, key=lambda r: r.get('code') or '-'),
+            key=lambda r: r.get('code') or '-',
+        ):
             for member in members:
                 name_full = member.get('name', '')
-                name_parts = name_full.strip().split(maxsplit=1)
-                ad = name_parts[0] if name_parts else name_full
-                soyad = name_parts[1] if len(name_parts) > 1 else ""
+                head, _, tail = name_full.strip().partition(' ')
+                ad = head or name_full
+                soyad = tail.lstrip()
                 
                 fin = member.get('fin', '')
                 seriya = member.get('seriya') or '-'
@@ -1838,114 +2008,49 @@ def generate_period_excel_report(report_data: List[dict], start_date: str, end_d
                     giris_time = str(giris_time_raw).strip()
                     cixis_time = str(cixis_time_raw).strip()
                 
-                start_lat = member.get('start_lat')
-                start_lon = member.get('start_lon')
-                end_lat = member.get('end_lat')
-                end_lon = member.get('end_lon')
-
+                # Lokasiya sahələri _annotate_report_rows-da bir dəfə hesablanıb
                 gps_coords = member.get('gps_coords') or '-'
                 address = member.get('address') or '-'
                 maps_link = member.get('maps_link') or '-'
-
-                # Compute if not precomputed
-                if gps_coords == '-' and address == '-' and maps_link == '-':
-                    try:
-                        lat = None
-                        lon = None
-                        if start_lat is not None and start_lon is not None:
-                            lat = float(start_lat)
-                            lon = float(start_lon)
-                        elif end_lat is not None and end_lon is not None:
-                            lat = float(end_lat)
-                            lon = float(end_lon)
-                        if lat is not None and lon is not None:
-                            gps_coords = f"{lat}, {lon}"
-                            # Sync context: use coordinates (geocoding cache is async-only)
-                            address = gps_coords
-                            maps_link = f"https://maps.google.com/?q={lat},{lon}"
-                        else:
-                            giris_loc = (member.get('giris_loc') or '').strip()
-                            cixis_loc = (member.get('cixis_loc') or '').strip()
-                            addr = giris_loc or cixis_loc
-                            if addr:
-                                address = addr
-                                encoded_address = urllib.parse.quote(addr)
-                                maps_link = f"https://www.google.com/maps/search/?api=1&query={encoded_address}"
-                    except Exception as e:
-                        print(f"[generate_period_excel_report] Error computing location: {e}")
                 
                 status = member.get('status', '-')
                 violations = member.get('violations', '-')
                 
                 is_active = member.get('is_active', 1)
-                status_color = get_status_color("inactive" if is_active == 0 else ("ok" if status == "Qaydalara uyğundur" else "violation"))
-                row_fill = PatternFill(start_color=status_color, end_color=status_color, fill_type="solid")
+                status_key = "inactive" if is_active == 0 else ("ok" if status == _OK_STATUS else "violation")
                 
-                # Write row
-                ws.cell(row=row_num, column=1, value=formatted_date).fill = row_fill
-                ws.cell(row=row_num, column=2, value=fin).fill = row_fill
-                ws.cell(row=row_num, column=3, value=ad).fill = row_fill
-                ws.cell(row=row_num, column=4, value=soyad).fill = row_fill
-                ws.cell(row=row_num, column=5, value=seriya).fill = row_fill
-                ws.cell(row=row_num, column=6, value=phone).fill = row_fill
-                ws.cell(row=row_num, column=7, value=code_key).fill = row_fill
-                ws.cell(row=row_num, column=8, value=profession).fill = row_fill
-                ws.cell(row=row_num, column=9, value=giris_time).fill = row_fill
-                ws.cell(row=row_num, column=10, value=cixis_time).fill = row_fill
-                ws.cell(row=row_num, column=11, value=gps_coords).fill = row_fill
-                ws.cell(row=row_num, column=12, value=address).fill = row_fill
+                values = [
+                    formatted_date, fin, ad, soyad, seriya, phone, code_key, profession,
+                    giris_time, cixis_time, gps_coords, address,
+                    "Xəritədə bax" if maps_link != '-' else "-",
+                    status, violations,
+                ]
+                ws.write_row(row_num, 0, values, row_fmts[status_key])
                 if maps_link != '-':
-                    cell = ws.cell(row=row_num, column=13, value="Xəritədə bax")
-                    cell.hyperlink = maps_link
-                    cell.font = Font(color="0000FF", underline="single")
-                    cell.fill = row_fill
-                else:
-                    ws.cell(row=row_num, column=13, value="-").fill = row_fill
-                ws.cell(row=row_num, column=14, value=status).fill = row_fill
-                ws.cell(row=row_num, column=15, value=violations).fill = row_fill
-                
-                for col in range(1, len(headers) + 1):
-                    ws.cell(row=row_num, column=col).alignment = data_alignment
-                
+                    # write_url URL-i çox uzun olduqda yazmır (mənfi kod qaytarır) - onda mətn qalır
+                    ws.write_url(row_num, link_col, maps_link, link_fmts[status_key], "Xəritədə bax")
+                for col_idx, value in enumerate(values):
+                    length = len(str(value))
+                    if length > widths[col_idx]:
+                        widths[col_idx] = length
                 row_num += 1
     
-    # Auto-adjust columns
-    for col_idx in range(1, len(headers) + 1):
-        col_letter = get_column_letter(col_idx)
-        max_length = 0
-        for row in ws[col_letter]:
-            try:
-                if len(str(row.value)) > max_length:
-                    max_length = len(str(row.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[col_letter].width = adjusted_width
-    
+    for col_idx, width in enumerate(widths):
+        ws.set_column(col_idx, col_idx, min(width + 2, 50))
     # Freeze header
-    ws.freeze_panes = f"A{header_row + 1}"
-    ws.auto_filter.ref = f"A{header_row}:{get_column_letter(len(headers))}{row_num - 1}"
-    
-    filename = f"hesabat_{start_date}_to_{end_date}"
-    if code:
-        filename += f"_{code}"
-    filename += ".xlsx"
-    filepath = os.path.join(os.getcwd(), filename)
-    wb.save(filepath)
+    ws.freeze_panes(header_row + 1, 0)
+    ws.autofilter(header_row, 0, max(row_num - 1, header_row), len(headers) - 1)
+    workbook.close()
     
     return filepath
 
 
 @dp.message(Command("excel"))
+@admin_only()
 async def cmd_excel(message: Message) -> None:
     """Command to export today's report to Excel"""
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    
     # Parse date from command if provided
-    parts = shlex.split(message.text or "")
+    parts = _split_command(message.text)
     if len(parts) >= 2:
         date = _parse_date_or_today(parts[1])
         if not date:
@@ -1954,9 +2059,10 @@ async def cmd_excel(message: Message) -> None:
     else:
         date = today_baku()
     
+    filepath = None
     try:
         await message.answer(f"📊 {date} üçün Excel hesabatı hazırlanır...")
-        filepath = generate_daily_excel_report(date)
+        filepath = await asyncio.to_thread(generate_daily_excel_report, date)
         
         # Send Excel file
         document = FSInputFile(filepath, filename=f"hesabat_{date}.xlsx")
@@ -1964,16 +2070,16 @@ async def cmd_excel(message: Message) -> None:
             document,
             caption=f"📥 Günlük hesabat - {date}\n\nBütün işçilərin məlumatları, giriş-çıxış saatları və qrup üzvləri daxildir."
         )
-        
-        # Clean up file after sending
-        try:
-            os.remove(filepath)
-        except Exception:
-            pass
             
     except Exception as e:
-        print(f"[cmd_excel] error: {e}")
+        logger.exception("[cmd_excel] error")
         await message.answer(f"❌ Xəta baş verdi: {str(e)}")
+    finally:
+        if filepath:
+            try:
+                os.unlink(filepath)
+            except OSError:
+                pass
 
 
 # ================== İSTİFADƏÇİ KOMANDALARI ==================
@@ -1988,11 +2094,11 @@ async def cmd_editprofile(message: Message, state: FSMContext) -> None:
         await state.clear()
         await message.answer(
             "❌ Məlumat dəyişdirmə yalnız admin tərəfindən edilir. Zəhmət olmasa adminə müraciət edin.",
-            reply_markup=worker_keyboard(),
+            reply_markup=_KB_WORKER,
         )
         if ADMIN_ID != 0:
             try:
-                prof = db.get_user_by_telegram_id(user.id) or {}
+                prof = db.get_user_cached(user.id) or {}
                 await bot.send_message(
                     ADMIN_ID,
                     "✏️ Məlumat dəyişikliyi sorğusu\n\n"
@@ -2006,7 +2112,7 @@ async def cmd_editprofile(message: Message, state: FSMContext) -> None:
                 pass
         return
     
-    prof = db.get_user_by_telegram_id(user.id)
+    prof = db.get_user_cached(user.id)
     if not prof:
         await message.answer("❌ Qeydiyyatınız tapılmadı. Əvvəlcə /start ilə qeydiyyatdan keçin.")
         return
@@ -2022,36 +2128,19 @@ async def cmd_editprofile(message: Message, state: FSMContext) -> None:
         f"Hansı məlumatı dəyişdirmək istəyirsiniz?"
     )
     
-    edit_kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👤 Adı dəyişdir"), KeyboardButton(text="🆔 FIN-i dəyişdir")],
-            [KeyboardButton(text="❌ Ləğv et")],
-        ],
-        resize_keyboard=True
-    )
-    
-    await message.answer(current_info, reply_markup=edit_kb)
+    await message.answer(current_info, reply_markup=_KB_EDIT_FIELDS)
 
 
 @dp.message(EditProfile.field)
 async def editprofile_field(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     
-    if text == "❌ Ləğv et" or text.lower() in ("ləğv", "cancel", "legv"):
+    if text == "❌ Ləğv et" or text.casefold() in _CANCEL_WORDS:
         await state.clear()
-        await message.answer("❌ Ləğv edildi.", reply_markup=worker_keyboard())
+        await message.answer("❌ Ləğv edildi.", reply_markup=_KB_WORKER)
         return
     
-    field_map = {
-        "👤 adı dəyişdir": "name",
-        "adı dəyişdir": "name",
-        "ad": "name",
-        "🆔 fin-i dəyişdir": "fin",
-        "fin-i dəyişdir": "fin",
-        "fin": "fin",
-    }
-    
-    field = field_map.get(text.lower())
+    field = _EDIT_FIELD_DISPATCH.get(text.casefold())
     if not field:
         await message.answer("❌ Zəhmət olmasa butonlardan birini seçin.")
         return
@@ -2072,7 +2161,7 @@ async def editprofile_value(message: Message, state: FSMContext) -> None:
     if not user:
         return
     
-    new_value = (message.text or "").strip()
+    new_value = _txt(message)
     if not new_value:
         await message.answer("❌ Boş dəyər daxil edilə bilməz.")
         return
@@ -2085,7 +2174,7 @@ async def editprofile_value(message: Message, state: FSMContext) -> None:
         await message.answer("❌ Xəta. Yenidən başlayın: /editprofile")
         return
     
-    prof = db.get_user_by_telegram_id(user.id)
+    prof = db.get_user_cached(user.id)
     if not prof:
         await state.clear()
         await message.answer("❌ Qeydiyyatınız tapılmadı.")
@@ -2101,42 +2190,36 @@ async def editprofile_value(message: Message, state: FSMContext) -> None:
             seriya=prof.get("seriya", ""),
             phone_number=prof.get("phone_number", "")
         )
-        await message.answer(f"✅ Ad dəyişdirildi: {new_value}", reply_markup=worker_keyboard())
+        await message.answer(f"✅ Ad dəyişdirildi: {new_value}", reply_markup=_KB_WORKER)
     elif field == "fin":
-        if not (7 <= len(new_value) <= 10):
+        if not _FIN_RE.match(new_value):
             await message.answer("❌ FIN düzgün deyil. 7-10 simvol olmalıdır.")
             return
+        new_value = new_value.upper()
         db.upsert_user_profile(
             telegram_id=user.id,
             name=prof.get("name", ""),
-            fin=new_value.upper(),
+            fin=new_value,
             code=prof.get("code", ""),
             seriya=prof.get("seriya", ""),
             phone_number=prof.get("phone_number", "")
         )
-        await message.answer(f"✅ FIN dəyişdirildi: {new_value.upper()}", reply_markup=worker_keyboard())
+        await message.answer(f"✅ FIN dəyişdirildi: {new_value}", reply_markup=_KB_WORKER)
     
     await state.clear()
 
 
 @dp.message(Command("professions"))
+@admin_only()
 async def cmd_professions(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
     txt = "Peşələr:\n" + "\n".join(f"{i+1}. {p}" for i, p in enumerate(PROFESSIONS))
     await message.answer(txt)
 
 
 @dp.message(Command("addgcode"))
+@admin_only()
 async def cmd_addgcode(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    db.init_group_codes()
-    parts = shlex.split(message.text or "")
+    parts = _split_command(message.text)
     if len(parts) < 4:
         await message.answer("İstifadə: /addgcode \"Peşə\" YYYY-MM-DD KOD [1|0]")
         return
@@ -2158,18 +2241,20 @@ async def cmd_addgcode(message: Message) -> None:
         await message.answer("Peşə tapılmadı. /professions ilə siyahıya baxın.")
         return
 
-    ok = db.add_group_code(profession=prof, date=date, code=code, is_active=is_active)
+    try:
+        ok = await _sqlite_retry(db.add_group_code, profession=prof, date=date, code=code, is_active=is_active)
+        if ok:
+            _active_codes_cache.clear()
+    except sqlite3.OperationalError:
+        logger.exception("[cmd_addgcode] error")
+        ok = False
     await message.answer("✅ Yadda saxlandı" if ok else "❌ Xəta")
 
 
 @dp.message(Command("listgcodes"))
+@admin_only()
 async def cmd_listgcodes(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    db.init_group_codes()
-    parts = shlex.split(message.text or "")
+    parts = _split_command(message.text)
     date = None
     only_active = None
     if len(parts) >= 2:
@@ -2184,22 +2269,17 @@ async def cmd_listgcodes(message: Message) -> None:
     if not rows:
         await message.answer("Məlumat tapılmadı.")
         return
-    lines: list[str] = ["Qrup kodları:"]
+    buf = io.StringIO()
+    buf.write("Qrup kodları:")
     for r in rows:
-        lines.append(f"• {r.get('date')} | {r.get('profession')} → {r.get('code')}")
-    txt = "\n".join(lines)
-    for part in chunk_send(txt):
-        await message.answer(part)
+        buf.write(f"\n• {r.get('date')} | {r.get('profession')} → {r.get('code')}")
+    await send_text_or_doc(message, buf.getvalue(), filename="qrup_kodlari.txt")
 
 
 @dp.message(Command("listregs"))
+@admin_only()
 async def cmd_listregs(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    db.init_registrations()
-    parts = shlex.split(message.text or "")
+    parts = _split_command(message.text)
     date = None
     profession = None
     code = None
@@ -2221,79 +2301,58 @@ async def cmd_listregs(message: Message) -> None:
     if not rows:
         await message.answer("Qeydiyyat tapılmadı.")
         return
-    lines = ["Qeydiyyatlar:"]
+    buf = io.StringIO()
+    buf.write("Qeydiyyatlar:")
     for r in rows:
-        lines.append(f"• {r.get('date')} | {r.get('profession')} | {r.get('code')} — {r.get('name')} (FIN: {r.get('fin')})")
-    txt = "\n".join(lines)
-    for part in chunk_send(txt):
-        await message.answer(part)
+        buf.write(f"\n• {r.get('date')} | {r.get('profession')} | {r.get('code')} — {r.get('name')} (FIN: {r.get('fin')})")
+    await send_text_or_doc(message, buf.getvalue(), filename="qeydiyyatlar.txt")
 
 
 # ================== QRUPLAR VƏ TƏLƏBƏLƏR İDARƏETMƏSİ ==================
 
 @dp.message(AdminManageGroup.action)
 async def admin_manage_group_action(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     
     if text == "❌ Ləğv et":
         await state.clear()
-        await message.answer("Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
     
     if text == "➕ Qrup kodu əlavə et":
         await state.update_data(action="add_code")
         await state.set_state(AdminManageGroup.profession)
-        await message.answer("Kod əlavə etmək üçün peşə seçin:", reply_markup=professions_keyboard())
+        await message.answer("Kod əlavə etmək üçün peşə seçin:", reply_markup=_KB_PROFESSIONS)
     elif text == "🗑 Qrup kodu sil":
         await state.update_data(action="delete_code")
         await state.set_state(AdminManageGroup.profession)
-        await message.answer("Silinəcək kod üçün peşə seçin:", reply_markup=professions_keyboard())
+        await message.answer("Silinəcək kod üçün peşə seçin:", reply_markup=_KB_PROFESSIONS)
     elif text == "📋 Qrup kodlarını göstər":
         await state.clear()
         today = today_baku()
-        db.init_group_codes()
         rows = db.get_group_codes(active_on=today, only_active=None)
         if not rows:
-            await message.answer("Aktiv kod yoxdur.", reply_markup=admin_keyboard())
+            await message.answer("Aktiv kod yoxdur.", reply_markup=_KB_ADMIN)
             return
         lines = ["Aktiv kodlar:"]
         for r in rows:
             lines.append(f"• {r.get('profession')} → {r.get('code')}")
-        await message.answer("\n".join(lines), reply_markup=admin_keyboard())
+        await message.answer("\n".join(lines), reply_markup=_KB_ADMIN)
     else:
         await message.answer("❌ Zəhmət olmasa butonlardan birini seçin.")
 
 
 @dp.message(AdminManageGroup.profession)
 async def admin_manage_group_profession(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     if text == "❌ Ləğv et":
         await state.clear()
-        await message.answer("Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
     
-    chosen = None
-    raw = text.strip('"\' ').strip()
-    idx_part = raw.split(".", 1)[0]
-    if idx_part.isdigit():
-        idx = int(idx_part) - 1
-        if 0 <= idx < len(PROFESSIONS):
-            chosen = PROFESSIONS[idx]
-    
-    if not chosen:
-        for s in PROFESSIONS:
-            if s.lower() == raw.lower():
-                chosen = s
-                break
-    
-    if not chosen:
-        for s in PROFESSIONS:
-            if raw.lower() in s.lower():
-                chosen = s
-                break
-    
+    chosen = _pick_profession(text.strip('"\' ').strip())
     if not chosen:
-        await message.answer("Düzgün peşə seçin.", reply_markup=professions_keyboard())
+        await message.answer("Düzgün peşə seçin.", reply_markup=_KB_PROFESSIONS)
         return
     
     await state.update_data(profession=chosen)
@@ -2303,7 +2362,7 @@ async def admin_manage_group_profession(message: Message, state: FSMContext) ->
 
 @dp.message(AdminManageGroup.date)
 async def admin_manage_group_date(message: Message, state: FSMContext) -> None:
-    date_raw = (message.text or "").strip()
+    date_raw = _txt(message)
     date = _parse_date_or_today(date_raw)
     
     if not date:
@@ -2324,12 +2383,12 @@ async def admin_manage_group_date(message: Message, state: FSMContext) -> None:
         await message.answer("Silinəcək qrup kodunu daxil edin:", reply_markup=ReplyKeyboardRemove())
     else:
         await state.clear()
-        await message.answer("❌ Xəta.", reply_markup=admin_keyboard())
+        await message.answer("❌ Xəta.", reply_markup=_KB_ADMIN)
 
 
 @dp.message(AdminManageGroup.code)
 async def admin_manage_group_code(message: Message, state: FSMContext) -> None:
-    code = (message.text or "").strip()
+    code = _txt(message)
     if not code:
         await message.answer("❌ Kod boş ola bilməz.")
         return
@@ -2341,157 +2400,118 @@ async def admin_manage_group_code(message: Message, state: FSMContext) -> None:
 
     if action != "delete_code" or not profession or not date:
         await state.clear()
-        await message.answer("❌ Xəta.", reply_markup=admin_keyboard())
+        await message.answer("❌ Xəta.", reply_markup=_KB_ADMIN)
         return
 
     try:
-        db.init_group_codes()
-        ok = False
-        for attempt in range(3):
-            try:
-                ok = db.delete_group_code(profession=profession, date=date, code=code)
-                break
-            except sqlite3.OperationalError as e:
-                if "locked" in str(e).lower():
-                    await asyncio.sleep(0.5 * (attempt + 1))
-                    continue
-                raise
+        ok = await _sqlite_retry(db.delete_group_code, profession=profession, date=date, code=code)
         await state.clear()
         if ok:
-            await message.answer("✅ Qrup kodu silindi.", reply_markup=admin_keyboard())
+            _active_codes_cache.clear()
+            await message.answer("✅ Qrup kodu silindi.", reply_markup=_KB_ADMIN)
         else:
-            await message.answer("ℹ️ Bu tarix, peşə və kod üçün məlumat tapılmadı.", reply_markup=admin_keyboard())
-    except Exception as e:
+            await message.answer("ℹ️ Bu tarix, peşə və kod üçün məlumat tapılmadı.", reply_markup=_KB_ADMIN)
+    except Exception:
         await state.clear()
-        print(f"[admin_manage_group_code] delete_code error: {e}")
-        await message.answer("❌ Xəta baş verdi.", reply_markup=admin_keyboard())
+        logger.exception("[admin_manage_group_code] delete_code error")
+        await message.answer("❌ Xəta baş verdi.", reply_markup=_KB_ADMIN)
+
+
+# is_active -> (ikon, status mətni); ümumi saylar SQL-də hesablanır
+_STUDENT_STATUS = {True: ("✅", "Aktiv"), False: ("❌", "Deaktiv")}
+
+
+def _format_students(rows: list[dict], totals: dict) -> str:
+    """"📋 Tələbələri göstər" cavabının mətni."""
+    lines = ["📋 Tələbələr:\n"]
+
+    # Sətirlər qrup üzrə sıralı gəlir; qrup dəyişəndə başlıq yazılır
+    for code, code_users in groupby(rows, key=lambda u: u['grp']):
+        code_users = list(code_users)
+        grp_total = code_users[0]['grp_total']
+        lines.append(f"📁 Qrup: {code} ({grp_total} tələbə)")
+        for u in code_users:
+            status_icon, status_text = _STUDENT_STATUS[u.get('is_active', 1) == 1]
+            name = u.get('name', '?')
+            fin = u.get('fin', '-')
+            phone = u.get('phone_number', '-')
+            lines.append(f"  {status_icon} {name} (FIN: {fin}, Tel: {phone}) - {status_text}")
+        # Göstərilməyənlər: sorğunun qrup limiti burada təkrarlanmır
+        if grp_total > len(code_users):
+            lines.append(f"  ... və {grp_total - len(code_users)} tələbə daha")
+        lines.append("")
+
+    # Ümumi statistika
+    lines.append(f"📊 Statistikalar:")
+    lines.append(f"• Ümumi: {totals['total']} tələbə")
+    lines.append(f"• Aktiv: {totals['active']} tələbə")
+    lines.append(f"• Deaktiv: {totals['inactive']} tələbə")
+
+    return "\n".join(lines)
+
+
+# Tələbə idarəetməsi düymələri: düymə mətni -> (action, sorğu mətni)
+_STUDENT_ACTIONS: dict[str, tuple[str, str]] = {
+    "🗑 Tələbə sil": ("delete", "Silinəcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:"),
+    "✏️ Tələbənin məlumatını dəyiş": ("edit_profile", "Dəyişiləcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:"),
+    "🔒 Tələbəni deaktiv et": ("deactivate", "Deaktiv ediləcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:"),
+    "🔓 Tələbəni aktiv et": ("activate", "Aktiv ediləcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:"),
+    "🔒 Qrup tələbələrini deaktiv et": ("deactivate_group", "Deaktiv ediləcək qrup kodunu daxil edin:"),
+    "🔓 Qrup tələbələrini aktiv et": ("activate_group", "Aktiv ediləcək qrup kodunu daxil edin:"),
+}
 
 
 @dp.message(AdminManageStudent.action)
 async def admin_manage_student_action(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     
     if text == "❌ Ləğv et":
         await state.clear()
-        await message.answer("Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
     
     if text == "📋 Tələbələri göstər":
         await state.clear()
         try:
-            users = db.get_all_users_with_status()
-            if not users:
-                await message.answer("❌ Tələbə tapılmadı.", reply_markup=admin_keyboard())
+            rows, totals = await asyncio.to_thread(db.get_students_grouped_by_code, limit_per_group=20)  # Hər qrupda max 20 nəfər
+            if not rows:
+                await message.answer("❌ Tələbə tapılmadı.", reply_markup=_KB_ADMIN)
                 return
-            
-            lines = ["📋 Tələbələr:\n"]
-            active_count = 0
-            inactive_count = 0
-            
-            # Qruplar üzrə qruplaşdır
-            by_code: dict[str, list[dict]] = {}
-            for u in users:
-                code = u.get('code') or 'Kod yoxdur'
-                if code not in by_code:
-                    by_code[code] = []
-                by_code[code].append(u)
-            
-            # Hər qrup üçün göstər
-            for code, code_users in sorted(by_code.items()):
-                lines.append(f"📁 Qrup: {code} ({len(code_users)} tələbə)")
-                for u in code_users[:20]:  # Hər qrupda max 20 nəfər
-                    status_icon = "✅" if u.get('is_active', 1) == 1 else "❌"
-                    name = u.get('name', '?')
-                    fin = u.get('fin', '-')
-                    phone = u.get('phone_number', '-')
-                    status_text = "Aktiv" if u.get('is_active', 1) == 1 else "Deaktiv"
-                    lines.append(f"  {status_icon} {name} (FIN: {fin}, Tel: {phone}) - {status_text}")
-                    if u.get('is_active', 1) == 1:
-                        active_count += 1
-                    else:
-                        inactive_count += 1
-                if len(code_users) > 20:
-                    lines.append(f"  ... və {len(code_users) - 20} tələbə daha")
-                lines.append("")
-            
-            # Ümumi statistika
-            lines.append(f"📊 Statistikalar:")
-            lines.append(f"• Ümumi: {len(users)} tələbə")
-            lines.append(f"• Aktiv: {active_count} tələbə")
-            lines.append(f"• Deaktiv: {inactive_count} tələbə")
-            
-            text = "\n".join(lines)
-            for part in chunk_send(text):
+
+            text = await asyncio.to_thread(_format_students, rows, totals)
+            parts = chunk_send(text)
+            # "Menyu:" yer varsa son parçaya əlavə olunur - ayrıca API sorğusu lazım olmur
+            if len(parts[-1]) + len(_MENU_SUFFIX) <= TG_CHUNK_LIMIT:
+                parts[-1] += _MENU_SUFFIX
+            else:
+                parts.append("Menyu:")
+            # Parçalar ardıcıl göndərilir ki, Telegram-da sıra qarışmasın
+            for part in parts[:-1]:
                 await message.answer(part)
-            await message.answer("Menyu:", reply_markup=admin_keyboard())
-        except Exception as e:
-            print(f"[admin_manage_student_action] Error listing students: {e}")
-            await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=admin_keyboard())
+            await message.answer(parts[-1], reply_markup=_KB_ADMIN)
+        except Exception:
+            logger.exception("[admin_manage_student_action] Error listing students")
+            await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=_KB_ADMIN)
 
-    elif text == "🗑 Tələbə sil":
-        await state.update_data(action="delete")
+    elif (entry := _STUDENT_ACTIONS.get(text)) is not None:
+        action, prompt = entry
+        await state.update_data(action=action)
         await state.set_state(AdminManageStudent.code_or_id)
-        await message.answer(
-            "Silinəcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    elif text == "✏️ Tələbənin məlumatını dəyiş":
-        await state.update_data(action="edit_profile")
-        await state.set_state(AdminManageStudent.code_or_id)
-        await message.answer(
-            "Dəyişiləcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    elif text == "🔒 Tələbəni deaktiv et":
-        await state.update_data(action="deactivate")
-        await state.set_state(AdminManageStudent.code_or_id)
-        await message.answer(
-            "Deaktiv ediləcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    elif text == "🔓 Tələbəni aktiv et":
-        await state.update_data(action="activate")
-        await state.set_state(AdminManageStudent.code_or_id)
-        await message.answer(
-            "Aktiv ediləcək tələbənin Telegram ID-sini və ya FIN kodunu daxil edin:",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    elif text == "🔒 Qrup tələbələrini deaktiv et":
-        await state.update_data(action="deactivate_group")
-        await state.set_state(AdminManageStudent.code_or_id)
-        await message.answer(
-            "Deaktiv ediləcək qrup kodunu daxil edin:",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    elif text == "🔓 Qrup tələbələrini aktiv et":
-        await state.update_data(action="activate_group")
-        await state.set_state(AdminManageStudent.code_or_id)
-        await message.answer(
-            "Aktiv ediləcək qrup kodunu daxil edin:",
-            reply_markup=ReplyKeyboardRemove(),
-        )
+        await message.answer(prompt, reply_markup=ReplyKeyboardRemove())
     else:
         await message.answer("❌ Zəhmət olmasa butonlardan birini seçin.")
 
 
 @dp.message(AdminManageStudent.field)
 async def admin_manage_student_edit_field(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
 
-    if text == "❌ Ləğv et" or text.lower() in ("ləğv", "cancel", "legv"):
+    if text == "❌ Ləğv et" or text.casefold() in _CANCEL_WORDS:
         await state.clear()
-        await message.answer("❌ Ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("❌ Ləğv edildi.", reply_markup=_KB_ADMIN)
         return
 
-    field_map = {
-        "👤 adı dəyişdir": "name",
-        "adı dəyişdir": "name",
-        "ad": "name",
-        "🆔 fin-i dəyişdir": "fin",
-        "fin-i dəyişdir": "fin",
-        "fin": "fin",
-    }
-    field = field_map.get(text.lower())
+    field = _EDIT_FIELD_DISPATCH.get(text.casefold())
     if not field:
         await message.answer("❌ Zəhmət olmasa butonlardan birini seçin.")
         return
@@ -2508,7 +2528,7 @@ async def admin_manage_student_edit_field(message: Message, state: FSMContext) -
 
 @dp.message(AdminManageStudent.new_value)
 async def admin_manage_student_edit_value(message: Message, state: FSMContext) -> None:
-    new_value = (message.text or "").strip()
+    new_value = _txt(message)
     if not new_value:
         await message.answer("❌ Boş dəyər daxil edilə bilməz.")
         return
@@ -2519,17 +2539,17 @@ async def admin_manage_student_edit_value(message: Message, state: FSMContext) -
 
     if not field or not target_telegram_id:
         await state.clear()
-        await message.answer("❌ Xəta. Yenidən başlayın.", reply_markup=admin_keyboard())
+        await message.answer("❌ Xəta. Yenidən başlayın.", reply_markup=_KB_ADMIN)
         return
 
-    prof = db.get_user_by_telegram_id(int(target_telegram_id))
+    prof = db.get_user_cached(int(target_telegram_id))
     if not prof:
         await state.clear()
-        await message.answer("❌ Tələbə tapılmadı.", reply_markup=admin_keyboard())
+        await message.answer("❌ Tələbə tapılmadı.", reply_markup=_KB_ADMIN)
         return
 
     if field == "fin":
-        if not (7 <= len(new_value) <= 10):
+        if not _FIN_RE.match(new_value):
             await message.answer("❌ FIN düzgün deyil. 7-10 simvol olmalıdır.")
             return
         new_value = new_value.upper()
@@ -2541,7 +2561,8 @@ async def admin_manage_student_edit_value(message: Message, state: FSMContext) -
         name = prof.get("name", "")
         fin = new_value
 
-    db.upsert_user_profile(
+    await _sqlite_retry(
+        db.upsert_user_profile,
         telegram_id=int(target_telegram_id),
         name=name,
         fin=fin,
@@ -2552,12 +2573,26 @@ async def admin_manage_student_edit_value(message: Message, state: FSMContext) -
 
     await state.clear()
     changed_field = "Ad" if field == "name" else "FIN"
-    await message.answer(f"✅ {changed_field} dəyişdirildi.", reply_markup=admin_keyboard())
+    await message.answer(f"✅ {changed_field} dəyişdirildi.", reply_markup=_KB_ADMIN)
+
+
+# Bir tələbəyə aid əməliyyatlar - tələbə əvvəlcə ID/FIN ilə tapılır
+_SINGLE_STUDENT_ACTIONS = frozenset(("delete", "edit_profile", "deactivate", "activate"))
+
+
+def _resolve_student(code_or_id: str) -> Optional[dict]:
+    """Tələbəni Telegram ID (rəqəm) və ya FIN ilə tapır."""
+    user = None
+    if code_or_id.isdigit():
+        user = db.get_user_cached(int(code_or_id))
+    if not user:
+        user = db.get_user_by_fin(code_or_id)
+    return user
 
 
 @dp.message(AdminManageStudent.code_or_id)
 async def admin_manage_student_code_or_id(message: Message, state: FSMContext) -> None:
-    code_or_id = (message.text or "").strip()
+    code_or_id = _txt(message)
     if not code_or_id:
         await message.answer("❌ Boş dəyər daxil edilə bilməz.")
         return
@@ -2565,25 +2600,16 @@ async def admin_manage_student_code_or_id(message: Message, state: FSMContext) -
     data = await state.get_data()
     action = data.get("action")
     
-    if action == "delete":
+    user = None
+    if action in _SINGLE_STUDENT_ACTIONS:
         # Try to find user by telegram_id or fin
-        user = None
-        if code_or_id.isdigit():
-            user = db.get_user_by_telegram_id(int(code_or_id))
-        
-        if not user:
-            # Try by FIN
-            users = db.get_all_users_with_status()
-            for u in users:
-                if u.get('fin', '').upper() == code_or_id.upper():
-                    user = u
-                    break
-        
+        user = _resolve_student(code_or_id)
         if not user:
             await state.clear()
-            await message.answer("❌ Tələbə tapılmadı.", reply_markup=admin_keyboard())
+            await message.answer("❌ Tələbə tapılmadı.", reply_markup=_KB_ADMIN)
             return
-        
+
+    if action == "delete":
         await state.update_data(user_id=user.get('telegram_id'), user_name=user.get('name'))
         await state.set_state(AdminManageStudent.confirm)
         await message.answer(
@@ -2592,30 +2618,9 @@ async def admin_manage_student_code_or_id(message: Message, state: FSMContext) -
             f"FIN: {user.get('fin')}\n"
             f"Kod: {user.get('code')}\n\n"
             f"Bu tələbəni silmək istədiyinizə əminsiniz?",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="✅ Bəli, sil"), KeyboardButton(text="❌ Xeyr")],
-                ],
-                resize_keyboard=True
-            )
+            reply_markup=_KB_CONFIRM_DELETE,
         )
     elif action == "edit_profile":
-        user = None
-        if code_or_id.isdigit():
-            user = db.get_user_by_telegram_id(int(code_or_id))
-
-        if not user:
-            users = db.get_all_users_with_status()
-            for u in users:
-                if u.get('fin', '').upper() == code_or_id.upper():
-                    user = u
-                    break
-
-        if not user:
-            await state.clear()
-            await message.answer("❌ Tələbə tapılmadı.", reply_markup=admin_keyboard())
-            return
-
         await state.update_data(user_id=user.get('telegram_id'), user_name=user.get('name'))
         await state.set_state(AdminManageStudent.field)
 
@@ -2627,96 +2632,48 @@ async def admin_manage_student_code_or_id(message: Message, state: FSMContext) -
             f"Hansı məlumatı dəyişdirmək istəyirsiniz?"
         )
 
-        edit_kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="👤 Adı dəyişdir"), KeyboardButton(text="🆔 FIN-i dəyişdir")],
-                [KeyboardButton(text="❌ Ləğv et")],
-            ],
-            resize_keyboard=True
-        )
-
-        await message.answer(current_info, reply_markup=edit_kb)
-    elif action == "deactivate":
-        user = None
-        if code_or_id.isdigit():
-            user = db.get_user_by_telegram_id(int(code_or_id))
-        
-        if not user:
-            users = db.get_all_users_with_status()
-            for u in users:
-                if u.get('fin', '').upper() == code_or_id.upper():
-                    user = u
-                    break
-        
-        if not user:
-            await state.clear()
-            await message.answer("❌ Tələbə tapılmadı.", reply_markup=admin_keyboard())
-            return
-        
-        ok = db.set_user_active(user.get('telegram_id'), 0)
+        await message.answer(current_info, reply_markup=_KB_EDIT_FIELDS)
+    elif action in ("deactivate", "activate"):
+        active = action == "activate"
+        ok = await _sqlite_retry(db.set_user_active, user.get('telegram_id'), int(active))
         await state.clear()
         if ok:
-            await message.answer(f"✅ Tələbə deaktiv edildi: {user.get('name')}", reply_markup=admin_keyboard())
-        else:
-            await message.answer("❌ Xəta baş verdi.", reply_markup=admin_keyboard())
-    elif action == "activate":
-        user = None
-        if code_or_id.isdigit():
-            user = db.get_user_by_telegram_id(int(code_or_id))
-        
-        if not user:
-            users = db.get_all_users_with_status()
-            for u in users:
-                if u.get('fin', '').upper() == code_or_id.upper():
-                    user = u
-                    break
-        
-        if not user:
-            await state.clear()
-            await message.answer("❌ Tələbə tapılmadı.", reply_markup=admin_keyboard())
-            return
-        
-        ok = db.set_user_active(user.get('telegram_id'), 1)
-        await state.clear()
-        if ok:
-            await message.answer(f"✅ Tələbə aktiv edildi: {user.get('name')}", reply_markup=admin_keyboard())
+            await message.answer(
+                f"✅ Tələbə {'aktiv' if active else 'deaktiv'} edildi: {user.get('name')}",
+                reply_markup=_KB_ADMIN,
+            )
         else:
-            await message.answer("❌ Xəta baş verdi.", reply_markup=admin_keyboard())
+            await message.answer("❌ Xəta baş verdi.", reply_markup=_KB_ADMIN)
     elif action == "deactivate_group":
         try:
             count = db.deactivate_user_by_code(code_or_id)
             await state.clear()
             if count > 0:
-                await message.answer(f"✅ {count} tələbə deaktiv edildi (Kod: {code_or_id})", reply_markup=admin_keyboard())
+                await message.answer(f"✅ {count} tələbə deaktiv edildi (Kod: {code_or_id})", reply_markup=_KB_ADMIN)
             else:
-                await message.answer(f"ℹ️ Bu kod üçün tələbə tapılmadı (Kod: {code_or_id})", reply_markup=admin_keyboard())
-        except Exception as e:
-            print(f"[admin_manage_student_code_or_id] Error deactivating group: {e}")
+                await message.answer(f"ℹ️ Bu kod üçün tələbə tapılmadı (Kod: {code_or_id})", reply_markup=_KB_ADMIN)
+        except Exception:
+            logger.exception("[admin_manage_student_code_or_id] Error deactivating group")
             await state.clear()
-            await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=admin_keyboard())
+            await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=_KB_ADMIN)
     elif action == "activate_group":
         try:
-            # Activate only inactive users in the group
-            users = db.get_users_by_code(code_or_id, only_active=False)
-            changed = 0
-            for u in users:
-                if u.get('is_active', 1) == 0 and u.get('telegram_id') is not None:
-                    if db.set_user_active(int(u['telegram_id']), 1):
-                        changed += 1
+            # Activate only inactive users in the group (one UPDATE)
+            changed = db.activate_user_by_code(code_or_id)
             await state.clear()
             if changed > 0:
-                await message.answer(f"✅ {changed} tələbə aktiv edildi (Kod: {code_or_id})", reply_markup=admin_keyboard())
+                await message.answer(f"✅ {changed} tələbə aktiv edildi (Kod: {code_or_id})", reply_markup=_KB_ADMIN)
             else:
-                await message.answer(f"ℹ️ Aktiv ediləcək deaktiv tələbə tapılmadı (Kod: {code_or_id})", reply_markup=admin_keyboard())
-        except Exception as e:
-            print(f"[admin_manage_student_code_or_id] Error activating group: {e}")
+                await message.answer(f"ℹ️ Aktiv ediləcək deaktiv tələbə tapılmadı (Kod: {code_or_id})", reply_markup=_KB_ADMIN)
+        except Exception:
+            logger.exception("[admin_manage_student_code_or_id] Error activating group")
             await state.clear()
-            await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=admin_keyboard())
+            await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=_KB_ADMIN)
 
 
 @dp.message(AdminManageStudent.confirm)
 async def admin_manage_student_confirm(message: Message, state: FSMContext) -> None:
-    text = (message.text or "").strip()
+    text = _txt(message)
     
     if text == "✅ Bəli, sil":
         data = await state.get_data()
@@ -2724,29 +2681,42 @@ async def admin_manage_student_confirm(message: Message, state: FSMContext) -> N
         user_name = data.get("user_name")
         
         if user_id:
-            ok = db.delete_user_by_telegram_id(user_id)
+            ok = await _sqlite_retry(db.delete_user_by_telegram_id, user_id)
+            _forget_checkins()
             await state.clear()
             if ok:
-                await message.answer(f"✅ Tələbə silindi: {user_name}", reply_markup=admin_keyboard())
+                await message.answer(f"✅ Tələbə silindi: {user_name}", reply_markup=_KB_ADMIN)
             else:
-                await message.answer("❌ Xəta baş verdi.", reply_markup=admin_keyboard())
+                await message.answer("❌ Xəta baş verdi.", reply_markup=_KB_ADMIN)
         else:
             await state.clear()
-            await message.answer("❌ Xəta.", reply_markup=admin_keyboard())
-    elif text == "❌ Xeyr" or text == "❌ Xeyr, ləğv et" or text.lower() in ("xeyr", "ləğv", "cancel", "no"):
+            await message.answer("❌ Xəta.", reply_markup=_KB_ADMIN)
+    elif text in _DECLINE_BUTTONS or text.casefold() in _DECLINE_WORDS:
         await state.clear()
-        await message.answer("❌ Silmə əməliyyatı ləğv edildi.", reply_markup=admin_keyboard())
+        await message.answer("❌ Silmə əməliyyatı ləğv edildi.", reply_markup=_KB_ADMIN)
     else:
         await message.answer("❌ Zəhmət olmasa '✅ Bəli, sil' və ya '❌ Xeyr, ləğv et' seçin.")
 
 
+def _format_logs(rows: list[dict]) -> str:
+    """/logs cavabının mətni."""
+    buf = io.StringIO()
+    write = buf.write
+    write("Giriş/Çıxış logları:")
+    for r in rows:
+        write(
+            f"\n• {r.get('date')} | {r.get('profession','-')} | {r.get('code','-')}"
+            f"\n  {r.get('name','?')} (FIN: {r.get('fin','-')})"
+            f"\n  🟢 {r.get('giris_time','-')}  📍 {r.get('giris_loc','-')}"
+            f"\n  🔴 {r.get('cixis_time','-')}  📍 {r.get('cixis_loc','-')}"
+        )
+    return buf.getvalue()
+
+
 @dp.message(Command("logs"))
+@admin_only()
 async def cmd_logs(message: Message) -> None:
-    user = message.from_user
-    if not user or not is_admin(user.id):
-        await message.answer("❌ Bu əmr yalnız admin üçündür.")
-        return
-    parts = shlex.split(message.text or "")
+    parts = _split_command(message.text)
     date = None
     profession = None
     code = None
@@ -2764,147 +2734,129 @@ async def cmd_logs(message: Message) -> None:
                 profession = m
     if len(parts) >= 4:
         code = parts[3]
-    rows = db.get_attendance_logs(date=date, profession=profession, code=code)
+    rows = await asyncio.to_thread(db.get_attendance_logs, date=date, profession=profession, code=code)
     if not rows:
         await message.answer("Log tapılmadı.")
         return
-    lines: list[str] = ["Giriş/Çıxış logları:"]
-    for r in rows:
-        lines.append(
-            "\n".join([
-                f"• {r.get('date')} | {r.get('profession','-')} | {r.get('code','-')}",
-                f"  {r.get('name','?')} (FIN: {r.get('fin','-')})",
-                f"  🟢 {r.get('giris_time','-')}  📍 {r.get('giris_loc','-')}",
-                f"  🔴 {r.get('cixis_time','-')}  📍 {r.get('cixis_loc','-')}",
-            ])
-        )
-    txt = "\n".join(lines)
-    for part in chunk_send(txt):
-        await message.answer(part)
+    # Minlərlə sətir ola bilər - mətn worker thread-də yığılır, event loop bloklanmır
+    txt = await asyncio.to_thread(_format_logs, rows)
+    await send_text_or_doc(message, txt, filename="loglar.txt")
 
 
 # ================== GİRİŞ / ÇIXIŞ ==================
 
-@dp.message(F.text == "🟢 Giriş")
-async def handle_giris(message: Message) -> None:
+async def _prepare_attendance(message: Message, kind: str) -> Optional[tuple[int, Optional[int], datetime]]:
+    """Giriş/Çıxış üçün ortaq yoxlamalar: son saat, aktivlik, users2 id.
+
+    Cavab göndərilib dayandırılmalıdırsa None, əks halda (telegram_id, uid, now) qaytarır.
+    uid DB xətası olduqda None ola bilər - çağıran yoxlamaları keçir.
+    """
     user = message.from_user
     if not user:
-        return
+        return None
     user_id = user.id
 
     now = now_baku()
-    if now.hour >= CHECKIN_DEADLINE_HOUR:
+    deadline = CHECKIN_DEADLINE_HOUR if kind == "checkin" else CHECKOUT_DEADLINE_HOUR
+    if now.hour >= deadline:
+        label = "Giriş" if kind == "checkin" else "Çıxış"
         await message.answer(
-            f"❌ Giriş {CHECKIN_DEADLINE_HOUR}:00-dan sonra vurula bilməz. "
+            f"❌ {label} {deadline}:00-dan sonra vurula bilməz. "
             f"Hal-hazırda vaxt: {now.strftime('%H:%M')}",
-            reply_markup=worker_keyboard(),
+            reply_markup=_KB_WORKER,
         )
         pending_action.pop(user_id, None)
-        return
+        return None
 
     # Check if user is active
-    prof = db.get_user_by_telegram_id(user_id)
+    prof = db.get_user_cached(user_id)
     if prof and prof.get("is_active", 1) == 0:
         await message.answer(
             "❌ Sizin giriş-çıxış hüququnuz deaktiv edilib. "
             "Zəhmət olmasa admin ilə əlaqə saxlayın.",
-            reply_markup=worker_keyboard()
+            reply_markup=_KB_WORKER
         )
-        return
+        return None
 
     try:
-        db.init_gps_tables()
-        uid = db.get_or_create_user2(telegram_id=user_id, full_name=user.full_name)
-        today = today_baku()
-        existing = db.get_user_session_on_date(uid, today)
-        if existing:
-            await message.answer("ℹ️ Bu gün artıq giriş etmisiniz.", reply_markup=worker_keyboard())
-            pending_action.pop(user_id, None)
-            return
-    except Exception as e:
-        print(f"[handle_giris] db error: {e}")
+        uid: Optional[int] = db.get_or_create_user2(telegram_id=user_id, full_name=user.full_name)
+    except Exception:
+        logger.exception("[_prepare_attendance] %s db error", kind)
+        uid = None
+    return user_id, uid, now
+
+
+@dp.message(F.text == "🟢 Giriş")
+async def handle_giris(message: Message) -> None:
+    ctx = await _prepare_attendance(message, "checkin")
+    if ctx is None:
+        return
+    user_id, uid, now = ctx
+
+    if uid is not None:
+        try:
+            if _user_has_checkin_today(uid, now.date().isoformat()):
+                await message.answer("ℹ️ Bu gün artıq giriş etmisiniz.", reply_markup=_KB_WORKER)
+                pending_action.pop(user_id, None)
+                return
+        except Exception:
+            logger.exception("[handle_giris] db error")
 
-    pending_action[user_id] = ("checkin", time.time())
+    _set_pending(user_id, "checkin")
     await message.answer(
         "📍 Giriş üçün lokasiya göndər",
-        reply_markup=location_keyboard("Lokasiyanı göndər"),
+        reply_markup=_KB_LOCATION,
     )
 
 
 @dp.message(F.text == "🔴 Çıxış")
 async def handle_cixis(message: Message) -> None:
-    user = message.from_user
-    if not user:
-        return
-    user_id = user.id
-
-    now = now_baku()
-    if now.hour >= CHECKOUT_DEADLINE_HOUR:
-        await message.answer(
-            f"❌ Çıxış {CHECKOUT_DEADLINE_HOUR}:00-dan sonra vurula bilməz. "
-            f"Hal-hazırda vaxt: {now.strftime('%H:%M')}",
-            reply_markup=worker_keyboard(),
-        )
-        pending_action.pop(user_id, None)
-        return
-
-    # Check if user is active
-    prof = db.get_user_by_telegram_id(user_id)
-    if prof and prof.get("is_active", 1) == 0:
-        await message.answer(
-            "❌ Sizin giriş-çıxış hüququnuz deaktiv edilib. "
-            "Zəhmət olmasa admin ilə əlaqə saxlayın.",
-            reply_markup=worker_keyboard()
-        )
+    ctx = await _prepare_attendance(message, "checkout")
+    if ctx is None:
         return
+    user_id, uid, now = ctx
 
     try:
-        db.init_gps_tables()
-        uid = db.get_or_create_user2(telegram_id=user_id, full_name=user.full_name)
-        sess = db.get_open_session(uid)
-        if not sess:
+        sess = db.get_open_session(uid) if uid is not None else None
+        if uid is not None and not sess:
             await message.answer(
                 "❌ Giriş etmədiyiniz üçün çıxış edə bilmirsiniz. Əvvəlcə giriş edin.",
-                reply_markup=worker_keyboard(),
+                reply_markup=_KB_WORKER,
             )
             pending_action.pop(user_id, None)
             return
-        else:
+        elif sess:
             try:
                 start_time = parse_dt_to_baku(sess["start_time"])  # type: ignore[index]
-                today = today_baku()
-                if start_time.date().isoformat() != today:
+            except Exception:
+                start_time = None
+            if start_time is not None:
+                if start_time.date() != now.date():
                     await message.answer(
                         "❌ Bu gün giriş etmədiyiniz üçün çıxış edə bilmirsiniz. Əvvəlcə giriş edin.",
-                        reply_markup=worker_keyboard(),
+                        reply_markup=_KB_WORKER,
                     )
                     pending_action.pop(user_id, None)
                     return
-            except Exception:
-                pass
-            # Early safeguard: do not even prompt for location if minimum work duration not passed
-            try:
-                start_time = parse_dt_to_baku(sess["start_time"])  # type: ignore[index]
-                now = now_baku()
-                duration_hours = (now - start_time).total_seconds() / 3600.0
-                duration_min = max(0, int((now - start_time).total_seconds() // 60))
+                # Early safeguard: do not even prompt for location if minimum work duration not passed
+                elapsed = (now - start_time).total_seconds()
+                duration_hours = elapsed / 3600.0
+                duration_min = max(0, int(elapsed // 60))
                 if duration_hours < MIN_WORK_DURATION_HOURS:
                     await message.answer(
                         f"❌ Ən azı {MIN_WORK_DURATION_HOURS} saat sonra çıxış edə bilərsiniz.\n\n"
                         f"⏱ Hal-hazırda keçən vaxt: {duration_min} dəqiqə ({duration_hours:.1f} saat)\n"
                         f"📅 Giriş vaxtı: {start_time.strftime('%H:%M')}",
-                        reply_markup=worker_keyboard()
+                        reply_markup=_KB_WORKER
                     )
                     return
-            except Exception:
-                pass
-    except Exception as e:
-        print(f"[handle_cixis] db error: {e}")
+    except Exception:
+        logger.exception("[handle_cixis] db error")
 
-    pending_action[user_id] = ("checkout", time.time())
+    _set_pending(user_id, "checkout")
     await message.answer(
         "📍 Çıxış üçün lokasiya göndər",
-        reply_markup=location_keyboard("Lokasiyanı göndər"),
+        reply_markup=_KB_LOCATION,
     )
 
 
@@ -2939,13 +2891,58 @@ async def cmd_help(message: Message) -> None:
     
     if user and is_admin(user.id):
         help_text += "\n\n🔧 Admin funksiyaları üçün admin menyusundan istifadə edin."
-        await message.answer(help_text, reply_markup=admin_keyboard())
+        await message.answer(help_text, reply_markup=_KB_ADMIN)
     else:
-        await message.answer(help_text, reply_markup=worker_keyboard())
+        await message.answer(help_text, reply_markup=_KB_WORKER)
 
 
 # ================== LOKASİYA HANDLER ==================
 
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _post_address(message: Message, addr: str) -> None:
+    """Tapılmış ünvanı istifadəçiyə göndərir (fon növbəsi partial(message) ilə çağırır)."""
+    await message.answer(f"📍 Ünvan: {addr}")
+
+
+async def _notify_violation(**kwargs) -> None:
+    """notify_rule_violation-u fon rejimində göndərir; xəta yalnız loga yazılır."""
+    try:
+        await notifications.notify_rule_violation(bot=bot, admin_id=ADMIN_ID, **kwargs)
+    except Exception:
+        logger.exception("[_notify_violation] %s send failed", kwargs.get("violation_type"))
+
+
+async def _reject_and_report(
+    message: Message,
+    text: str,
+    *,
+    user_id: int,
+    name: str,
+    user_phone: Optional[str],
+    violation_type: str,
+    details: str,
+) -> None:
+    """Qayda pozuntusu: istifadəçiyə dərhal cavab verilir, çağrı mərkəzinə bildiriş fonda gedir."""
+    pending_action.pop(user_id, None)
+    if ADMIN_ID != 0:
+        task = asyncio.create_task(_notify_violation(
+            user_id=user_id,
+            user_name=name,
+            user_phone=user_phone,
+            violation_type=violation_type,
+            details=details,
+        ))
+        # Task-a güclü istinad saxlanılır ki, bitməmiş GC olunmasın
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    try:
+        await message.answer(text, reply_markup=_KB_WORKER)
+    except Exception:
+        logger.exception("[_reject_and_report] %s reply failed", violation_type)
+
+
 @dp.message(F.location)
 async def handle_location(message: Message) -> None:
     try:
@@ -2966,15 +2963,33 @@ async def handle_location(message: Message) -> None:
         # Expire old intents
         if time.time() - ts > LOCATION_TIMEOUT:
             pending_action.pop(user_id, None)
-            await message.answer("⏱ Lokasiya çox gec gəldi, yenidən giriş/çıxış seçin.", reply_markup=worker_keyboard())
+            await message.answer("⏱ Lokasiya çox gec gəldi, yenidən giriş/çıxış seçin.", reply_markup=_KB_WORKER)
             return
 
-        db.init_db()
-        db.init_gps_tables()
-
         lat = float(message.location.latitude)
         lon = float(message.location.longitude)
 
+        # Profil bir dəfə oxunur - bütün qayda pozuntusu bildirişləri və cavablar onu istifadə edir
+        prof = db.get_user_cached(user_id)
+        name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
+        user_phone = prof.get("phone_number") if prof else None
+
+        # Qayda 1: GPS aktivdir? (Koordinatlar düzgündürmü?) - heç bir DB/geocoding işindən əvvəl
+        if (lat == 0.0 and lon == 0.0) or not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            await _reject_and_report(
+                message,
+                _MSG_GPS_INVALID,
+                user_id=user_id,
+                name=name,
+                user_phone=user_phone,
+                violation_type="GPS problemi",
+                details=f"{'Giriş' if action == 'checkin' else 'Çıxış'} zamanı GPS koordinatları düzgün deyil ({lat}, {lon})",
+            )
+            return
+
+        code = prof.get("code") if prof else None
+        legacy_user_id = _legacy_id(prof)
+
         uid = db.get_or_create_user2(telegram_id=user_id, full_name=user.full_name)
 
         now = now_baku()
@@ -2982,122 +2997,49 @@ async def handle_location(message: Message) -> None:
         today = now.date().isoformat()
 
         if action == "checkin" and now.hour >= CHECKIN_DEADLINE_HOUR:
-            prof = db.get_user_by_telegram_id(user_id)
-            name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-            user_phone = prof.get("phone_number") if prof else None
-
-            await message.answer(
+            await _reject_and_report(
+                message,
                 f"❌ Giriş {CHECKIN_DEADLINE_HOUR}:00-dan sonra vurula bilməz. "
                 f"Hal-hazırda vaxt: {now.strftime('%H:%M')}",
-                reply_markup=worker_keyboard(),
+                user_id=user_id,
+                name=name,
+                user_phone=user_phone,
+                violation_type="Gecikmə - giriş vaxtı keçib",
+                details=f"Giriş {CHECKIN_DEADLINE_HOUR}:00-dan sonra vurulmağa cəhd edildi. Cari vaxt: {now.strftime('%H:%M')}",
             )
-            pending_action.pop(user_id, None)
-            if ADMIN_ID != 0:
-                await notifications.notify_rule_violation(
-                    bot=bot,
-                    admin_id=ADMIN_ID,
-                    user_id=user_id,
-                    user_name=name,
-                    user_phone=user_phone,
-                    violation_type="Gecikmə - giriş vaxtı keçib",
-                    details=f"Giriş {CHECKIN_DEADLINE_HOUR}:00-dan sonra vurulmağa cəhd edildi. Cari vaxt: {now.strftime('%H:%M')}" ,
-                )
             return
 
         if action == "checkout" and now.hour >= CHECKOUT_DEADLINE_HOUR:
-            prof = db.get_user_by_telegram_id(user_id)
-            name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-            user_phone = prof.get("phone_number") if prof else None
-
-            await message.answer(
+            await _reject_and_report(
+                message,
                 f"❌ Çıxış {CHECKOUT_DEADLINE_HOUR}:00-dan sonra vurula bilməz. "
                 f"Hal-hazırda vaxt: {now.strftime('%H:%M')}",
-                reply_markup=worker_keyboard(),
+                user_id=user_id,
+                name=name,
+                user_phone=user_phone,
+                violation_type="Gecikmə - çıxış vaxtı keçib",
+                details=f"Çıxış {CHECKOUT_DEADLINE_HOUR}:00-dan sonra vurulmağa cəhd edildi. Cari vaxt: {now.strftime('%H:%M')}",
             )
-            pending_action.pop(user_id, None)
-            if ADMIN_ID != 0:
-                await notifications.notify_rule_violation(
-                    bot=bot,
-                    admin_id=ADMIN_ID,
-                    user_id=user_id,
-                    user_name=name,
-                    user_phone=user_phone,
-                    violation_type="Gecikmə - çıxış vaxtı keçib",
-                    details=f"Çıxış {CHECKOUT_DEADLINE_HOUR}:00-dan sonra vurulmağa cəhd edildi. Cari vaxt: {now.strftime('%H:%M')}" ,
-                )
             return
 
         if action == "checkin":
-            # Qayda 1: GPS aktivdir? (Koordinatlar düzgündürmü?)
-            # Location göndərilmişsə, GPS aktivdir, amma koordinatların düzgün olduğunu yoxlayırıq
-            if lat == 0.0 and lon == 0.0:
-                prof = db.get_user_by_telegram_id(user_id)
-                name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-                user_phone = prof.get("phone_number") if prof else None
-                
-                await message.answer(
-                    "❌ GPS koordinatları düzgün deyil. GPS-i aktiv edin və yenidən cəhd edin.",
-                    reply_markup=worker_keyboard()
-                )
-                pending_action.pop(user_id, None)
-                
-                # Çağrı mərkəzinə bildiriş
-                if ADMIN_ID != 0:
-                    await notifications.notify_rule_violation(
-                        bot=bot,
-                        admin_id=ADMIN_ID,
-                        user_id=user_id,
-                        user_name=name,
-                        user_phone=user_phone,
-                        violation_type="GPS problemi",
-                        details=f"Giriş zamanı GPS koordinatları düzgün deyil (0.0, 0.0)"
-                    )
-                return
-            
             # Qayda 2: Bu gün artıq giriş vurulub?
-            existing = db.get_user_session_on_date(uid, today)
-            if existing:
-                await message.answer("❌ Bu gün artıq giriş etmisiniz. Giriş-çıxış yalnız bir dəfə vurula bilər.", reply_markup=worker_keyboard())
+            if _user_has_checkin_today(uid, today):
+                await message.answer("❌ Bu gün artıq giriş etmisiniz. Giriş-çıxış yalnız bir dəfə vurula bilər.", reply_markup=_KB_WORKER)
                 pending_action.pop(user_id, None)
                 return
             
-            # Qayda 3: Giriş 11:00-a qədər vurulmalıdır
-            if now.hour >= CHECKIN_DEADLINE_HOUR:
-                prof = db.get_user_by_telegram_id(user_id)
-                name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-                user_phone = prof.get("phone_number") if prof else None
-                
-                await message.answer(
-                    f"❌ Giriş {CHECKIN_DEADLINE_HOUR}:00-dan sonra vurula bilməz. "
-                    f"Hal-hazırda vaxt: {now.strftime('%H:%M')}",
-                    reply_markup=worker_keyboard()
-                )
-                pending_action.pop(user_id, None)
-                
-                # Çağrı mərkəzinə bildiriş
-                if ADMIN_ID != 0:
-                    await notifications.notify_rule_violation(
-                        bot=bot,
-                        admin_id=ADMIN_ID,
-                        user_id=user_id,
-                        user_name=name,
-                        user_phone=user_phone,
-                        violation_type="Gecikmə - giriş vaxtı keçib",
-                        details=f"Giriş {CHECKIN_DEADLINE_HOUR}:00-dan sonra vurulmağa cəhd edildi. Cari vaxt: {now.strftime('%H:%M')}"
-                    )
-                return
-            
             # Qayda 4 (dəyişdirildi): Giriş zamanı məkan məhdudiyyəti tətbiq edilmir.
 
-            db.create_session(user_id=uid, start_time=now_iso, lat=lat, lon=lon)
+            # Await-dən əvvəl işarələnir: eyni istifadəçinin paralel lokasiya mesajı ikinci sessiya yaratmasın
+            _checked_in_today.add(uid)
+            try:
+                await _sqlite_retry(db.create_session, user_id=uid, start_time=now_iso, lat=lat, lon=lon)
+            except Exception:
+                _checked_in_today.discard(uid)
+                raise
 
-            start_link = f"https://maps.google.com/?q={lat},{lon}"
-            kb = InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="Xəritədə bax", url=start_link)]]
-            )
-            prof = db.get_user_by_telegram_id(user_id)
-            name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-            code = prof.get("code") if prof else None
+            kb = _map_kb(lat, lon)
             
             # Cavabı dərhal göndər (adres yüklənməsini gözləmə)
             info_lines = [
@@ -3110,50 +3052,31 @@ async def handle_location(message: Message) -> None:
             await message.answer("📍 Başlanğıc nöqtəsi", reply_markup=kb)
             
             # Xatırlatma mesajı
-            reminder_text = (
-                "💡 Xatırlatma\n\n"
-                "Gününüz xoş keçsin! 🌟\n\n"
-                "⚠️ Çıxış etməyi unutmayın!\n"
-                "Yoxsa iş günü kimi hesablanmayacaq."
-            )
-            await message.answer(reminder_text)
+            await message.answer(_MSG_CHECKIN_REMINDER)
             
-            await message.answer("Menyu:", reply_markup=worker_keyboard())
+            await message.answer("Menyu:", reply_markup=_KB_WORKER)
+
+            # Ünvan yaddaş keşindədirsə (adətən eyni iş yeri) legacy qeyd ünvanla birlikdə bir yazı ilə edilir.
+            # DB keşi burada oxunmur - kilidli SQLite cavabı ləngitməsin; onu fon növbəsi yoxlayır
+            known_addr = await cached_address(lat, lon, persistent=False)
 
-            # Legacy attendance (save without address initially)
+            # Legacy attendance (address is filled later by the background task if not cached)
             try:
-                if prof and isinstance(prof.get("id"), int):
-                    legacy_user_id = int(prof["id"])  # type: ignore[index]
+                if legacy_user_id is not None:
                     db.record_giris(
                         user_id=legacy_user_id,
                         date=today,
                         time=now.strftime("%H:%M:%S"),
-                        location=None,  # Will be updated by background task if geocoding enabled
+                        location=known_addr,
                     )
-            except Exception as e:
-                print(f"[handle_location checkin legacy] {e}")
-            
-            # Background geocoding task (non-blocking)
-            async def send_address():
-                try:
-                    addr = await reverse_geocode(lat, lon)
-                    if addr:
-                        await message.answer(f"📍 Ünvan: {addr}")
-                        # Update legacy attendance with address
-                        if prof and isinstance(prof.get("id"), int):
-                            legacy_user_id = int(prof["id"])
-                            conn = db.sqlite3.connect(db.DB_FILE)
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                'UPDATE attendance SET giris_loc = ? WHERE user_id = ? AND date = ?',
-                                (addr, legacy_user_id, today)
-                            )
-                            conn.commit()
-                            conn.close()
-                except Exception as e:
-                    print(f"[send_address checkin] {e}")
+            except Exception:
+                logger.exception("[handle_location checkin legacy]")
             
-            asyncio.create_task(send_address())
+            # Ünvan keşdə yoxdursa fon növbəsi tapır, istifadəçiyə göndərir və legacy qeydi yeniləyir
+            if known_addr:
+                await _post_address(message, known_addr)
+            else:
+                enqueue_geocode_update(lat, lon, legacy_user_id, today, "giris", reply=functools.partial(_post_address, message))
 
             # Schedule reminder after 8 hours
             asyncio.create_task(schedule_checkout_reminder(user_id, now, uid))
@@ -3162,115 +3085,58 @@ async def handle_location(message: Message) -> None:
             return
 
         if action == "checkout":
-            prof = db.get_user_by_telegram_id(user_id)
-            name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-            user_phone = prof.get("phone_number") if prof else None
-            
-            # Qayda 1: GPS aktivdir? (Koordinatlar düzgündürmü?)
-            if lat == 0.0 and lon == 0.0:
-                await message.answer(
-                    "❌ GPS koordinatları düzgün deyil. GPS-i aktiv edin və yenidən cəhd edin.",
-                    reply_markup=worker_keyboard()
-                )
-                pending_action.pop(user_id, None)
-                
-                # Çağrı mərkəzinə bildiriş
-                if ADMIN_ID != 0:
-                    await notifications.notify_rule_violation(
-                        bot=bot,
-                        admin_id=ADMIN_ID,
-                        user_id=user_id,
-                        user_name=name,
-                        user_phone=user_phone,
-                        violation_type="GPS problemi",
-                        details=f"Çıxış zamanı GPS koordinatları düzgün deyil (0.0, 0.0)"
-                    )
-                return
-            
             # Qayda 2: Giriş vurulubmu?
             sess = db.get_open_session(uid)
             if not sess:
                 await message.answer(
                     "❌ Giriş etmədiyiniz üçün çıxış edə bilmirsiniz. Əvvəlcə giriş edin.",
-                    reply_markup=worker_keyboard(),
+                    reply_markup=_KB_WORKER,
                 )
                 pending_action.pop(user_id, None)
                 return
 
-            try:
-                start_time = parse_dt_to_baku(sess["start_time"])  # type: ignore[index]
-                if start_time.date().isoformat() != today:
-                    await message.answer(
-                        "❌ Bu gün giriş etmədiyiniz üçün çıxış edə bilmirsiniz. Əvvəlcə giriş edin.",
-                        reply_markup=worker_keyboard(),
-                    )
-                    pending_action.pop(user_id, None)
-                    return
-            except Exception:
-                pass
+            # start_time bir dəfə parse olunur - həm tarix yoxlaması, həm də müddət üçün
+            start_time = parse_dt_to_baku(sess["start_time"])  # type: ignore[index]
+            if start_time.date().isoformat() != today:
+                await message.answer(
+                    "❌ Bu gün giriş etmədiyiniz üçün çıxış edə bilmirsiniz. Əvvəlcə giriş edin.",
+                    reply_markup=_KB_WORKER,
+                )
+                pending_action.pop(user_id, None)
+                return
             
             # Bu gün üçün artıq çıxış vurulubmu yoxlayırıq
             today_sess = db.get_user_session_on_date(uid, today)
             if today_sess and today_sess.get("end_time"):
                 await message.answer(
                     "❌ Bu gün artıq çıxış etmisiniz. Giriş-çıxış yalnız bir dəfə vurula bilər.",
-                    reply_markup=worker_keyboard()
+                    reply_markup=_KB_WORKER
                 )
                 pending_action.pop(user_id, None)
                 return
 
             # Compute metrics
-            start_time = parse_dt_to_baku(sess["start_time"])  # type: ignore[index]
-            duration_hours = (now - start_time).total_seconds() / 3600.0
-            duration_min = max(0, int((now - start_time).total_seconds() // 60))
+            elapsed_sec = (now - start_time).total_seconds()
+            duration_hours = elapsed_sec / 3600.0
+            duration_min = max(0, int(elapsed_sec // 60))
             
             start_lat = float(sess["start_lat"])  # type: ignore[index]
             start_lon = float(sess["start_lon"])  # type: ignore[index]
             dist_m = haversine_m(start_lat, start_lon, lat, lon)
             
-            # Qayda 3: Çıxış 19:00-a qədər vurulmalıdır
-            if now.hour >= CHECKOUT_DEADLINE_HOUR:
-                await message.answer(
-                    f"❌ Çıxış {CHECKOUT_DEADLINE_HOUR}:00-dan sonra vurula bilməz. "
-                    f"Hal-hazırda vaxt: {now.strftime('%H:%M')}",
-                    reply_markup=worker_keyboard()
-                )
-                pending_action.pop(user_id, None)
-                
-                # Çağrı mərkəzinə bildiriş
-                if ADMIN_ID != 0:
-                    await notifications.notify_rule_violation(
-                        bot=bot,
-                        admin_id=ADMIN_ID,
-                        user_id=user_id,
-                        user_name=name,
-                        user_phone=user_phone,
-                        violation_type="Gecikmə - çıxış vaxtı keçib",
-                        details=f"Çıxış {CHECKOUT_DEADLINE_HOUR}:00-dan sonra vurulmağa cəhd edildi. Cari vaxt: {now.strftime('%H:%M')}"
-                    )
-                return
-            
             # Qayda 4: Minimum 3 saat keçibmi?
             if duration_hours < MIN_WORK_DURATION_HOURS:
-                await message.answer(
+                await _reject_and_report(
+                    message,
                     f"❌ Ən azı {MIN_WORK_DURATION_HOURS} saat sonra çıxış edə bilərsiniz.\n\n"
                     f"⏱ Hal-hazırda keçən vaxt: {duration_min} dəqiqə ({duration_hours:.1f} saat)\n"
                     f"📅 Giriş vaxtı: {start_time.strftime('%H:%M')}",
-                    reply_markup=worker_keyboard()
+                    user_id=user_id,
+                    name=name,
+                    user_phone=user_phone,
+                    violation_type="Minimum iş müddəti pozulub",
+                    details=f"Girişdən sonra yalnız {duration_hours:.1f} saat keçib. Minimum: {MIN_WORK_DURATION_HOURS} saat. Giriş vaxtı: {start_time.strftime('%H:%M')}",
                 )
-                pending_action.pop(user_id, None)
-                
-                # Çağrı mərkəzinə bildiriş
-                if ADMIN_ID != 0:
-                    await notifications.notify_rule_violation(
-                        bot=bot,
-                        admin_id=ADMIN_ID,
-                        user_id=user_id,
-                        user_name=name,
-                        user_phone=user_phone,
-                        violation_type="Minimum iş müddəti pozulub",
-                        details=f"Girişdən sonra yalnız {duration_hours:.1f} saat keçib. Minimum: {MIN_WORK_DURATION_HOURS} saat. Giriş vaxtı: {start_time.strftime('%H:%M')}"
-                    )
                 return
             
             # Qayda 5 (praktika): Giriş-çıxış eyni nöqtə məhdudiyyəti tətbiq edilmir.
@@ -3278,26 +3144,18 @@ async def handle_location(message: Message) -> None:
             # Qayda 6: Çıxış giriş lokasiyasına yaxın olmalıdır
             dist_from_start = dist_m
             if dist_from_start > WORKPLACE_RADIUS_M:
-                await message.answer(
+                await _reject_and_report(
+                    message,
                     f"❌ Çıxış giriş nöqtəsindən uzaqda vurula bilməz.\n\n"
                     f"📍 Radius: {WORKPLACE_RADIUS_M} metr\n"
                     f"📍 Məsafə (giriş → çıxış): {int(dist_from_start)} metr\n\n"
                     f"Zəhmət olmasa giriş etdiyiniz məkana yaxın olun.",
-                    reply_markup=worker_keyboard()
+                    user_id=user_id,
+                    name=name,
+                    user_phone=user_phone,
+                    violation_type="Məkandan kənar çıxış cəhdi",
+                    details=f"Lokasiya: {lat}, {lon}. Məsafə (giriş→çıxış): {int(dist_from_start)} metr (Maksimum: {WORKPLACE_RADIUS_M} metr)",
                 )
-                pending_action.pop(user_id, None)
-                
-                # Çağrı mərkəzinə bildiriş
-                if ADMIN_ID != 0:
-                    await notifications.notify_rule_violation(
-                        bot=bot,
-                        admin_id=ADMIN_ID,
-                        user_id=user_id,
-                        user_name=name,
-                        user_phone=user_phone,
-                        violation_type="Məkandan kənar çıxış cəhdi",
-                        details=f"Lokasiya: {lat}, {lon}. Məsafə (giriş→çıxış): {int(dist_from_start)} metr (Maksimum: {WORKPLACE_RADIUS_M} metr)"
-                    )
                 return
             db.close_session(
                 session_id=int(sess["id"]),  # type: ignore[index]
@@ -3325,10 +3183,6 @@ async def handle_location(message: Message) -> None:
                     [InlineKeyboardButton(text="Marşrut", url=route_link)],
                 ]
             )
-
-            prof = db.get_user_by_telegram_id(user_id)
-            name = (prof.get("name") if prof else user.full_name) or "Istifadəçi"
-            code = prof.get("code") if prof else None
             
             # Cavabı dərhal göndər
             info_lines = [
@@ -3342,55 +3196,37 @@ async def handle_location(message: Message) -> None:
             await message.answer("🗺 Xəritə linkləri", reply_markup=ikb)
             
             # Uğurlu tamamlanma mesajı
-            success_message = (
-                "🎉 İş gününüz uğurla tamamlandı!\n\n"
-                "Xoş istirahətlər! 😊"
-            )
-            await message.answer(success_message)
+            await message.answer(_MSG_CHECKOUT_DONE)
             
-            await message.answer("Menyu:", reply_markup=worker_keyboard())
+            await message.answer("Menyu:", reply_markup=_KB_WORKER)
+
+            # Ünvan yaddaş keşindədirsə legacy qeyd ünvanla birlikdə bir yazı ilə edilir (DB keşi fon növbəsində)
+            known_addr = await cached_address(lat, lon, persistent=False)
 
             # Legacy attendance
             try:
-                if prof and isinstance(prof.get("id"), int):
-                    legacy_user_id = int(prof["id"])  # type: ignore[index]
+                if legacy_user_id is not None:
                     db.record_cixis(
                         user_id=legacy_user_id,
                         date=today,
                         time=now.strftime("%H:%M:%S"),
-                        location=None,
+                        location=known_addr,
                     )
-            except Exception as e:
-                print(f"[handle_location checkout legacy] {e}")
-            
-            # Background geocoding task (non-blocking)
-            async def send_address():
-                try:
-                    end_addr = await reverse_geocode(lat, lon)
-                    if end_addr:
-                        await message.answer(f"📍 Ünvan: {end_addr}")
-                        # Update legacy attendance with address
-                        if prof and isinstance(prof.get("id"), int):
-                            legacy_user_id = int(prof["id"])
-                            conn = db.sqlite3.connect(db.DB_FILE)
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                'UPDATE attendance SET cixis_loc = ? WHERE user_id = ? AND date = ?',
-                                (end_addr, legacy_user_id, today)
-                            )
-                            conn.commit()
-                            conn.close()
-                except Exception as e:
-                    print(f"[send_address checkout] {e}")
+            except Exception:
+                logger.exception("[handle_location checkout legacy]")
             
-            asyncio.create_task(send_address())
+            # Ünvan keşdə yoxdursa fon növbəsi tapır
+            if known_addr:
+                await _post_address(message, known_addr)
+            else:
+                enqueue_geocode_update(lat, lon, legacy_user_id, today, "cixis", reply=functools.partial(_post_address, message))
 
             pending_action.pop(user_id, None)
             return
 
-    except Exception as e:
-        print(f"[handle_location] error: {e}")
-        await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=worker_keyboard())
+    except Exception:
+        logger.exception("[handle_location] error")
+        await message.answer("❌ Xəta baş verdi. Yenidən yoxlayın.", reply_markup=_KB_WORKER)
         if message.from_user:
             pending_action.pop(message.from_user.id, None)
         return
@@ -3407,14 +3243,35 @@ async def fallback_show_menu(message: Message, state: FSMContext) -> None:
     if not user:
         return
     if is_admin(user.id):
-        await message.answer("Admin menyusundan istifadə edin:", reply_markup=admin_keyboard())
+        await message.answer("Admin menyusundan istifadə edin:", reply_markup=_KB_ADMIN)
     else:
-        await message.answer("Menyudan istifadə edin:", reply_markup=worker_keyboard())
+        await message.answer("Menyudan istifadə edin:", reply_markup=_KB_WORKER)
 
 
 # ================== MAIN ==================
 
+def _setup_logging() -> logging.handlers.QueueListener:
+    """Root logger-i QueueHandler-ə bağlayır; stderr-ə yazma ayrıca thread-də (QueueListener) gedir."""
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
 async def main() -> None:
+    listener = _setup_logging()
+    try:
+        await _run()
+    finally:
+        listener.stop()
+
+
+async def _run() -> None:
     print("aiogram bot starting (GPS attendance)...")
 
     if not acquire_single_instance_lock():
@@ -3448,12 +3305,17 @@ async def main() -> None:
     db.init_gps_tables()
     db.init_group_codes()
     db.init_registrations()
+    db.init_geocode_cache()
+    set_geocoding_cache(db.get_geocode, db.put_geocode)
 
+    start_geocoding_worker(db.update_attendance_addresses)
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except TelegramConflictError:
         print("TelegramConflictError: eyni BOT_TOKEN ilə başqa bot instansiyası işləyir. Digər prosesi/dayployment-i dayandırın.")
     finally:
+        await stop_geocoding_worker()
+        await close_geocoding_session()
         # Clean up connection pool on shutdown
         db.close_pool()
         print("✓ Database connection pool closed")
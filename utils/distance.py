@@ -1,15 +1,55 @@
+import functools
 import math
 
 # Haversine distance in meters
 # lat/lon in decimal degrees
 
-def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    R = 6371000.0  # Earth radius in meters
+_EARTH_R_M = 6371000.0
+_M_PER_DEG = math.radians(1.0) * _EARTH_R_M
+# Equirectangular approximation is well within this relative error for the
+# sub-kilometre distances it is used for; anything closer to the edge goes to haversine.
+_FAST_MARGIN = 1e-3
+
+
+def _haversine_a(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """sin²(Δφ/2) + cos φ1 · cos φ2 · sin²(Δλ/2) - the haversine term before atan2."""
     phi1 = math.radians(lat1)
     phi2 = math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlambda = math.radians(lon2 - lon1)
+    return math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+
+
+@functools.lru_cache(maxsize=16)
+def _a_limit(radius_m: float) -> float:
+    """Value of the haversine term at exactly radius_m (a is monotonic in distance)."""
+    return math.sin(radius_m / (2 * _EARTH_R_M)) ** 2
+
 
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    R = _EARTH_R_M  # Earth radius in meters
+    a = _haversine_a(lat1, lon1, lat2, lon2)
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
+
+
+def farther_than_m(lat1: float, lon1: float, lat2: float, lon2: float, radius_m: float) -> bool:
+    """Exact haversine_m(...) > radius_m without the atan2/sqrt (compares the haversine term)."""
+    return _haversine_a(lat1, lon1, lat2, lon2) > _a_limit(radius_m)
+
+
+def within_radius_m(lat1: float, lon1: float, lat2: float, lon2: float, radius_m: float) -> bool:
+    """Fast conservative geofence test: True only if the points are certainly within radius_m.
+
+    Uses the equirectangular approximation (one cos, no sqrt). A False result means
+    "not certain" - callers that need the exact answer fall back to haversine_m.
+    """
+    limit = radius_m * (1.0 - _FAST_MARGIN)
+    limit2 = limit * limit
+    dy = (lat2 - lat1) * _M_PER_DEG
+    dy2 = dy * dy
+    if dy2 > limit2:
+        # Enlik fərqi tək başına radiusu keçir - cos hesablamağa ehtiyac yoxdur
+        return False
+    dx = (lon2 - lon1) * _M_PER_DEG * math.cos(math.radians((lat1 + lat2) * 0.5))
+    return dx * dx + dy2 <= limit2
@@ -1,88 +1,78 @@
 """
 Hesabat ixrac funksiyaları - Excel, CSV, PDF
 """
+import asyncio
 import csv
 import os
+import tempfile
 from datetime import datetime, timedelta
-from typing import List, Dict
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill
-from openpyxl.utils import get_column_letter
+from typing import Dict, Iterable
 
 
-def generate_csv_report(report_data: List[Dict], filename: str) -> str:
-    """Generate CSV report. Returns path to the CSV file."""
-    filepath = os.path.join(os.getcwd(), filename)
-    
-    if not report_data:
-        # Create empty CSV with headers
-        headers = [
-            "Tarix", "FIN Kodu", "Ad", "Soyad", "Vəsiqə Seriya", "Telefon",
-            "Qrup Kodu", "Peşə", "Giriş Saatı", "Çıxış Saatı", 
-            "GPS Koordinatları", "Lokasiya", "Status", "Qayda Pozuntuları"
-        ]
-        with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.writer(f)
-            writer.writerow(headers)
-        return filepath
-    
-    # Get headers from first row keys
-    headers = [
-        "Tarix", "FIN Kodu", "Ad", "Soyad", "Vəsiqə Seriya", "Telefon",
-        "Qrup Kodu", "Peşə", "Giriş Saatı", "Çıxış Saatı",
-        "GPS Koordinatları", "Lokasiya", "Xəritə Linki", "Status", "Qayda Pozuntuları"
-    ]
-    
-    with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.writer(f)
-        writer.writerow(headers)
-        
-        for row in report_data:
-            # Extract data from row dict
-            date = row.get('date', '')
-            fin = row.get('fin', '')
-            name = row.get('name', '')
-            name_parts = name.strip().split(maxsplit=1)
-            ad = name_parts[0] if name_parts else name
-            soyad = name_parts[1] if len(name_parts) > 1 else ""
-            seriya = row.get('seriya', '') or ''
-            phone = row.get('phone_number', '') or ''
-            code = row.get('code', '')
-            profession = row.get('profession', '')
-            giris_time = row.get('giris_time') or ''
-            cixis_time = row.get('cixis_time') or ''
+_CSV_BUFFER_SIZE = 1024 * 1024
+_CSV_HEADERS = (
+    "Tarix", "FIN Kodu", "Ad", "Soyad", "Vəsiqə Seriya", "Telefon",
+    "Qrup Kodu", "Peşə", "Giriş Saatı", "Çıxış Saatı",
+    "GPS Koordinatları", "Lokasiya", "Xəritə Linki", "Status", "Qayda Pozuntuları",
+)
+
+
+def report_tempfile(filename: str) -> str:
+    """Hesabat üçün temp qovluqda unikal fayl yaradır (ad filename-ə oxşar) və yolunu qaytarır.
+    Faylı göndərəndən sonra silmək çağıranın işidir."""
+    stem, ext = os.path.splitext(filename)
+    with tempfile.NamedTemporaryFile(prefix=f"{stem}_", suffix=ext, delete=False, dir=tempfile.gettempdir()) as f:
+        return f.name
+
 
-            # Prefer precomputed fields from caller (period export computes these)
-            gps_coords = row.get('gps_coords') or ''
-            address = row.get('address') or ''
-            maps_link = row.get('maps_link') or ''
+def _csv_row(row: Dict) -> tuple:
+    """Hesabat sətrini CSV sütunlarına çevirir."""
+    get = row.get  # hər sətirdə ~20 lookup: bound method bir dəfə alınır
+    name = get('name', '')
+    head, _, tail = name.strip().partition(' ')
 
-            # Fallback: compute from raw GPS/loc fields if not provided
-            if not gps_coords:
-                start_lat = row.get('start_lat')
-                start_lon = row.get('start_lon')
-                end_lat = row.get('end_lat')
-                end_lon = row.get('end_lon')
-                if start_lat is not None and start_lon is not None:
-                    gps_coords = f"{start_lat}, {start_lon}"
-                    maps_link = maps_link or f"https://maps.google.com/?q={start_lat},{start_lon}"
-                elif end_lat is not None and end_lon is not None:
-                    gps_coords = f"{end_lat}, {end_lon}"
-                    maps_link = maps_link or f"https://maps.google.com/?q={end_lat},{end_lon}"
+    # Prefer precomputed fields from caller (period export computes these)
+    gps_coords = get('gps_coords') or ''
+    address = get('address') or ''
+    maps_link = get('maps_link') or ''
 
-            if not address:
-                giris_loc = (row.get('giris_loc', '') or '').strip()
-                cixis_loc = (row.get('cixis_loc', '') or '').strip()
-                address = giris_loc or cixis_loc or ''
+    # Fallback: compute from raw GPS/loc fields if not provided
+    if not gps_coords:
+        lat = get('start_lat')
+        lon = get('start_lon')
+        if lat is None or lon is None:
+            lat = get('end_lat')
+            lon = get('end_lon')
+        if lat is not None and lon is not None:
+            gps_coords = f"{lat}, {lon}"
+            maps_link = maps_link or f"https://maps.google.com/?q={lat},{lon}"
 
-            # Status and violations (pre-filled by caller)
-            status = row.get('status', '')
-            violations = row.get('violations', '')
-            
-            writer.writerow([
-                date, fin, ad, soyad, seriya, phone, code, profession,
-                giris_time, cixis_time, gps_coords, address, maps_link, status, violations
-            ])
+    if not address:
+        address = (get('giris_loc') or '').strip() or (get('cixis_loc') or '').strip()
+
+    # Status and violations (pre-filled by caller)
+    return (
+        get('date', ''), get('fin', ''), head or name, tail.lstrip(),
+        get('seriya') or '', get('phone_number') or '', get('code', ''), get('profession', ''),
+        get('giris_time') or '', get('cixis_time') or '',
+        gps_coords, address, maps_link, get('status', ''), get('violations', ''),
+    )
+
+
+def generate_csv_report(report_data: Iterable[Dict], filename: str) -> str:
+    """Generate CSV report. Returns path to the CSV file."""
+    filepath = report_tempfile(filename)
+    
+    # Böyük bufer + writerows(map(...)): sətir dövrü C səviyyəsində gedir, CSV yaddaşda yığılmır
+    # (boş hesabatda da eyni başlıq yazılır)
+    with open(filepath, 'w', newline='', encoding='utf-8-sig', buffering=_CSV_BUFFER_SIZE) as f:
+        writer = csv.writer(f)
+        writer.writerow(_CSV_HEADERS)
+        writer.writerows(map(_csv_row, report_data))
     
     return filepath
 
+
+async def generate_csv_report_async(report_data: Iterable[Dict], filename: str) -> str:
+    """generate_csv_report-un async variantı: fayl yazılışı worker thread-də gedir, event loop bloklanmır."""
+    return await asyncio.to_thread(generate_csv_report, report_data, filename)
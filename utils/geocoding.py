@@ -3,7 +3,7 @@ Async Reverse Geocoding Module with Rate Limiting and Cache
 
 Features:
 - Non-blocking async geocoding
-- In-memory cache with TTL
+- In-memory LRU cache with TTL, backed by the persistent geocode_cache table
 - Global rate limiting (respects Nominatim 1 req/sec)
 - Multiple provider support (Nominatim, Photon)
 - Graceful fallback on errors
@@ -11,12 +11,16 @@ Features:
 """
 
 import asyncio
+import logging
 import os
 import time
-from typing import Optional, Dict, Tuple
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, Tuple
 from datetime import datetime, timedelta
 import aiohttp
 
+logger = logging.getLogger(__name__)
+
 
 # ================== CONFIGURATION ==================
 
@@ -25,7 +29,11 @@ GEOCODING_PROVIDER = os.getenv("GEOCODING_PROVIDER", "nominatim").lower()
 GEOCODING_URL = os.getenv("GEOCODING_URL", "")  # Custom URL for Photon or other
 GEOCODING_TIMEOUT_SEC = int(os.getenv("GEOCODING_TIMEOUT_SEC", "3"))
 GEOCODING_RPS = float(os.getenv("GEOCODING_RPS", "1.0"))  # Requests per second
+GEOCODING_BURST = int(os.getenv("GEOCODING_BURST", "3"))  # Requests allowed back-to-back before RPS applies
 GEOCODING_CACHE_TTL_SEC = int(os.getenv("GEOCODING_CACHE_TTL_SEC", "86400"))  # 24 hours
+# Cache key = coordinates rounded to this many decimals (4 ≈ 11 m, same grid as the DB geocode_cache)
+GEOCODING_CACHE_PRECISION = int(os.getenv("GEOCODING_CACHE_PRECISION", "4"))
+GEOCODING_CACHE_MAX = int(os.getenv("GEOCODING_CACHE_MAX", "10000"))  # LRU bound for the in-memory cache
 
 # User-Agent for Nominatim (required by their policy)
 USER_AGENT = os.getenv("GEOCODING_USER_AGENT", "tgbotcuk/2.0 (attendance bot)")
@@ -33,12 +41,18 @@ USER_AGENT = os.getenv("GEOCODING_USER_AGENT", "tgbotcuk/2.0 (attendance bot)")
 
 # ================== CACHE ==================
 
+def _cache_key(lat: float, lon: float) -> Tuple[float, float]:
+    """Grid cell for a point; nearby fixes from the same workplace share one entry."""
+    return (round(lat, GEOCODING_CACHE_PRECISION), round(lon, GEOCODING_CACHE_PRECISION))
+
+
 class GeocodingCache:
-    """In-memory cache with TTL for geocoding results"""
+    """In-memory LRU cache with TTL for geocoding results"""
     
-    def __init__(self, ttl_seconds: int = 86400):
-        self._cache: Dict[Tuple[float, float], Tuple[str, float]] = {}
+    def __init__(self, ttl_seconds: int = 86400, max_entries: int = 10000):
+        self._cache: "OrderedDict[Tuple[float, float], Tuple[str, float]]" = OrderedDict()
         self._ttl = ttl_seconds
+        self._max = max_entries
         self._lock = asyncio.Lock()
     
     def _is_expired(self, timestamp: float) -> bool:
@@ -47,11 +61,12 @@ class GeocodingCache:
     
     async def get(self, lat: float, lon: float) -> Optional[str]:
         """Get cached address if available and not expired"""
-        key = (round(lat, 5), round(lon, 5))
+        key = _cache_key(lat, lon)
         async with self._lock:
             if key in self._cache:
                 address, timestamp = self._cache[key]
                 if not self._is_expired(timestamp):
+                    self._cache.move_to_end(key)
                     return address
                 else:
                     # Remove expired entry
@@ -60,9 +75,12 @@ class GeocodingCache:
     
     async def set(self, lat: float, lon: float, address: str) -> None:
         """Store address in cache with current timestamp"""
-        key = (round(lat, 5), round(lon, 5))
+        key = _cache_key(lat, lon)
         async with self._lock:
             self._cache[key] = (address, time.time())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max:
+                self._cache.popitem(last=False)
     
     async def clear_expired(self) -> int:
         """Remove all expired entries, return count removed"""
@@ -81,30 +99,81 @@ class GeocodingCache:
 # ================== RATE LIMITER ==================
 
 class RateLimiter:
-    """Global async rate limiter for geocoding requests"""
+    """Global async rate limiter for geocoding requests (token bucket).
+
+    Up to `burst` requests go out immediately, then one per 1/rps seconds.
+    A caller reserves its token under the lock and sleeps outside it, so
+    concurrent lookups are not serialized behind one another's sleep.
+    """
     
-    def __init__(self, requests_per_second: float = 1.0):
+    def __init__(self, requests_per_second: float = 1.0, burst: int = 1):
         self._rps = requests_per_second
-        self._min_interval = 1.0 / requests_per_second if requests_per_second > 0 else 0
-        self._last_request_time = 0.0
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last_refill = time.monotonic()
         self._lock = asyncio.Lock()
     
     async def acquire(self) -> None:
         """Wait if necessary to respect rate limit"""
+        if self._rps <= 0:
+            return
         async with self._lock:
-            if self._min_interval > 0:
-                now = time.time()
-                time_since_last = now - self._last_request_time
-                if time_since_last < self._min_interval:
-                    wait_time = self._min_interval - time_since_last
-                    await asyncio.sleep(wait_time)
-                self._last_request_time = time.time()
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rps)
+            self._last_refill = now
+            self._tokens -= 1
+            # Mənfi balans = bizdən əvvəl növbəyə düşənlər; gözləmə onların payını da nəzərə alır
+            wait_time = -self._tokens / self._rps if self._tokens < 0 else 0.0
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
 
 
 # ================== GLOBAL INSTANCES ==================
 
-_cache = GeocodingCache(ttl_seconds=GEOCODING_CACHE_TTL_SEC)
-_rate_limiter = RateLimiter(requests_per_second=GEOCODING_RPS)
+_cache = GeocodingCache(ttl_seconds=GEOCODING_CACHE_TTL_SEC, max_entries=GEOCODING_CACHE_MAX)
+_rate_limiter = RateLimiter(requests_per_second=GEOCODING_RPS, burst=GEOCODING_BURST)
+_inflight: Dict[Tuple[float, float], asyncio.Future] = {}
+
+# Persistent cache (geocode_cache table) callables, set by the bot at startup.
+# They are blocking DB calls and always run in a worker thread.
+_db_get: Optional[Callable[[float, float], Optional[str]]] = None
+_db_put: Optional[Callable[[float, float, str], None]] = None
+
+
+def set_persistent_cache(
+    get: Callable[[float, float], Optional[str]],
+    put: Callable[[float, float, str], None],
+) -> None:
+    """Plug in the persistent cache read/write functions (e.g. db.get_geocode / db.put_geocode)."""
+    global _db_get, _db_put
+    _db_get, _db_put = get, put
+
+# Shared HTTP session: keep-alive + DNS cache instead of a new TCP/TLS handshake per lookup
+_session: Optional[aiohttp.ClientSession] = None
+_session_lock = asyncio.Lock()
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Return the shared ClientSession, creating it on first use."""
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+    async with _session_lock:
+        if _session is None or _session.closed:
+            _session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=GEOCODING_TIMEOUT_SEC),
+                connector=aiohttp.TCPConnector(limit=4, ttl_dns_cache=300),
+                headers={"User-Agent": USER_AGENT},
+            )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared ClientSession (call on shutdown)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
 
 # ================== PROVIDERS ==================
@@ -119,10 +188,9 @@ async def _fetch_nominatim(lat: float, lon: float, session: aiohttp.ClientSessio
         "zoom": 18,
         "addressdetails": 1
     }
-    headers = {"User-Agent": USER_AGENT}
     
     try:
-        async with session.get(url, params=params, headers=headers) as resp:
+        async with session.get(url, params=params) as resp:
             if resp.status == 200:
                 data = await resp.json()
                 
@@ -161,7 +229,7 @@ async def _fetch_nominatim(lat: float, lon: float, session: aiohttp.ClientSessio
             
             return None
     except Exception as e:
-        print(f"[geocoding] Nominatim error: {e}")
+        logger.warning("[geocoding] Nominatim error: %s", e)
         return None
 
 
@@ -188,12 +256,42 @@ async def _fetch_photon(lat: float, lon: float, session: aiohttp.ClientSession)
                         return ", ".join(parts)
             return None
     except Exception as e:
-        print(f"[geocoding] Photon error: {e}")
+        logger.warning("[geocoding] Photon error: %s", e)
         return None
 
 
 # ================== MAIN API ==================
 
+async def cached_address(lat: float, lon: float, persistent: bool = True) -> Optional[str]:
+    """
+    Cache-only lookup (memory, then the persistent DB cache); never calls the provider.
+    
+    Args:
+        persistent: False = memory cache only (no DB access at all)
+    
+    Returns:
+        Address string or None if geocoding is disabled or the point is not cached
+    """
+    if not GEOCODING_ENABLED:
+        return None
+    
+    cached = await _cache.get(lat, lon)
+    if cached:
+        return cached
+    
+    # Then the persistent cache (shared with report exports)
+    if not persistent or _db_get is None:
+        return None
+    try:
+        cached = await asyncio.to_thread(_db_get, lat, lon)
+    except Exception:
+        logger.exception("[geocoding] DB cache read error")
+        cached = None
+    if cached:
+        await _cache.set(lat, lon, cached)
+    return cached
+
+
 async def reverse_geocode(lat: float, lon: float) -> Optional[str]:
     """
     Async reverse geocoding with cache, rate limiting, and graceful fallback.
@@ -209,32 +307,55 @@ async def reverse_geocode(lat: float, lon: float) -> Optional[str]:
     if not GEOCODING_ENABLED:
         return None
     
-    # Check cache first
-    cached = await _cache.get(lat, lon)
+    cached = await cached_address(lat, lon)
     if cached:
         return cached
     
+    # Single-flight: concurrent lookups of the same point share one provider request
+    key = _cache_key(lat, lon)
+    pending = _inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    
+    fut: asyncio.Future = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        address = await _fetch_address(lat, lon)
+        fut.set_result(address)
+        return address
+    finally:
+        if not fut.done():
+            fut.set_result(None)
+        _inflight.pop(key, None)
+
+
+async def _fetch_address(lat: float, lon: float) -> Optional[str]:
+    """Rate-limited provider request; successful results are written to both caches."""
     # Acquire rate limit token
     await _rate_limiter.acquire()
     
     # Fetch from provider
     address = None
-    timeout = aiohttp.ClientTimeout(total=GEOCODING_TIMEOUT_SEC)
     
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            if GEOCODING_PROVIDER == "photon":
-                address = await _fetch_photon(lat, lon, session)
-            else:  # Default to nominatim
-                address = await _fetch_nominatim(lat, lon, session)
+        session = await _get_session()
+        if GEOCODING_PROVIDER == "photon":
+            address = await _fetch_photon(lat, lon, session)
+        else:  # Default to nominatim
+            address = await _fetch_nominatim(lat, lon, session)
     except asyncio.TimeoutError:
-        print(f"[geocoding] Timeout for {lat}, {lon}")
-    except Exception as e:
-        print(f"[geocoding] Unexpected error: {e}")
+        logger.warning("[geocoding] Timeout for %s, %s", lat, lon)
+    except Exception:
+        logger.exception("[geocoding] Unexpected error")
     
     # Cache result if successful
     if address:
         await _cache.set(lat, lon, address)
+        if _db_put is not None:
+            try:
+                await asyncio.to_thread(_db_put, lat, lon, address)
+            except Exception:
+                logger.exception("[geocoding] DB cache write error")
     
     return address
 
@@ -252,8 +373,8 @@ async def reverse_geocode_background(lat: float, lon: float, callback=None) -> N
         address = await reverse_geocode(lat, lon)
         if address and callback:
             await callback(address)
-    except Exception as e:
-        print(f"[geocoding] Background task error: {e}")
+    except Exception:
+        logger.exception("[geocoding] Background task error")
 
 
 # ================== MAINTENANCE ==================
@@ -0,0 +1,135 @@
+"""
+Background address resolution for attendance records
+
+Check-in/check-out handlers enqueue a job instead of spawning a task per
+event. A single consumer drains the queue in batches: addresses are
+resolved through reverse_geocode (cache, single-flight, rate limit) and all
+attendance UPDATEs of a batch go to the database in one transaction.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+from utils.geocoding import reverse_geocode
+
+logger = logging.getLogger(__name__)
+
+
+# ================== CONFIGURATION ==================
+
+GEOCODING_QUEUE_MAX = int(os.getenv("GEOCODING_QUEUE_MAX", "1000"))
+GEOCODING_BATCH_SIZE = int(os.getenv("GEOCODING_BATCH_SIZE", "16"))
+
+
+class GeocodeJob(NamedTuple):
+    lat: float
+    lon: float
+    legacy_user_id: Optional[int]
+    date: str
+    kind: str  # "giris" | "cixis"
+    reply: Optional[Callable[[str], Awaitable]] = None  # ünvan tapılanda çağırılır
+
+
+_queue: Optional[asyncio.Queue] = None
+_worker_task: Optional[asyncio.Task] = None
+# Blocking batch writer of (user_id, date, kind, address) rows, set by the bot (db.update_attendance_addresses)
+_write_addresses: Optional[Callable[[List[Tuple[int, str, str, str]]], int]] = None
+
+
+# ================== WORKER ==================
+
+async def _resolve(job: GeocodeJob) -> Optional[str]:
+    """Resolve one job's address and send the reply; errors are logged, not raised.
+    A failed reply does not lose the address - it is still written to the record."""
+    try:
+        address = await reverse_geocode(job.lat, job.lon)
+    except Exception:
+        logger.exception("[geocoding_worker] Resolve error")
+        return None
+    if address and job.reply is not None:
+        try:
+            await job.reply(address)
+        except Exception:
+            logger.exception("[geocoding_worker] Reply error")
+    return address
+
+
+async def _worker() -> None:
+    """Consume jobs; each batch is resolved concurrently and written in one transaction."""
+    assert _queue is not None
+    while True:
+        batch = [await _queue.get()]
+        while len(batch) < GEOCODING_BATCH_SIZE and not _queue.empty():
+            batch.append(_queue.get_nowait())
+        try:
+            addresses = await asyncio.gather(*(_resolve(job) for job in batch))
+            rows = [
+                (job.legacy_user_id, job.date, job.kind, address)
+                for job, address in zip(batch, addresses)
+                if address and job.legacy_user_id is not None
+            ]
+            if rows and _write_addresses is not None:
+                await asyncio.to_thread(_write_addresses, rows)
+        except Exception:
+            logger.exception("[geocoding_worker] Batch error")
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def start_worker(
+    write_addresses: Optional[Callable[[List[Tuple[int, str, str, str]]], int]] = None,
+) -> None:
+    """Start the consumer task (idempotent; needs a running event loop).
+    write_addresses: batch writer for resolved addresses (kept from an earlier call if None)."""
+    global _queue, _worker_task, _write_addresses
+    if write_addresses is not None:
+        _write_addresses = write_addresses
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=GEOCODING_QUEUE_MAX)
+    if _worker_task is None or _worker_task.done():
+        _worker_task = asyncio.create_task(_worker())
+
+
+async def stop_worker() -> None:
+    """Cancel the consumer task. Jobs still in the queue are dropped."""
+    global _worker_task
+    if _worker_task is not None:
+        _worker_task.cancel()
+        try:
+            await _worker_task
+        except asyncio.CancelledError:
+            pass
+        _worker_task = None
+
+
+def enqueue_geocode_update(
+    lat: float,
+    lon: float,
+    legacy_user_id: Optional[int],
+    date: str,
+    kind: str,
+    reply: Optional[Callable[[str], Awaitable]] = None,
+) -> bool:
+    """
+    Queue an address lookup for an attendance record.
+
+    Args:
+        lat, lon: GPS coordinates
+        legacy_user_id: attendance.user_id to update (None = only reply)
+        date: attendance date (YYYY-MM-DD)
+        kind: "giris" or "cixis"
+        reply: optional async callback receiving the resolved address
+
+    Returns:
+        False if the queue is full and the job was dropped.
+    """
+    start_worker()
+    try:
+        _queue.put_nowait(GeocodeJob(lat, lon, legacy_user_id, date, kind, reply))
+        return True
+    except asyncio.QueueFull:
+        logger.warning("[geocoding_worker] Queue full, dropping address lookup")
+        return False
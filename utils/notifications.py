@@ -1,21 +1,56 @@
 """
 Bildiriş sistemi - Telegram vasitəsilə bildirişlər göndərir
 """
+import asyncio
 import logging
+import time
 from typing import Optional
-from datetime import datetime
 from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
 
 logger = logging.getLogger(__name__)
 
+_ts_cache = [0, ""]  # [saniyə, formatlanmış vaxt] - eyni saniyədə təkrar formatlanmır
+
+# Sabit mesaj şablonları (bound str.format)
+_REG_TMPL = (
+    "✅ Yeni qeydiyyat:\n\n"
+    "👤 Ad: {}\n"
+    "🆔 FIN: {}\n"
+    "📞 Telefon: {}\n"
+    "📋 Kod: {}\n"
+    "📅 Tarix: {}"
+).format
+_VIOLATION_TMPL = (
+    "⚠️ Qayda pozuntusu:\n\n"
+    "👤 İstifadəçi: {} (ID: {})\n"
+    "📞 Telefon: {}\n"
+    "🔴 Pozuntunun növü: {}\n"
+    "📝 Detallar: {}"
+).format
+_WARNING_TMPL = "⚠️ Xəbərdarlıq\n\n{}\n\n{}".format
+
+
+def _now_str() -> str:
+    """Cari lokal vaxt "%Y-%m-%d %H:%M:%S" formatında, saniyəlik keşlə."""
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        # strftime əvəzinə sahələr birbaşa formatlanır (locale axtarışı yoxdur)
+        n = time.localtime(t)
+        _ts_cache[1] = f"{n.tm_year:04d}-{n.tm_mon:02d}-{n.tm_mday:02d} {n.tm_hour:02d}:{n.tm_min:02d}:{n.tm_sec:02d}"
+        _ts_cache[0] = t
+    return _ts_cache[1]
+
 
 async def send_telegram_notification(bot: Bot, chat_id: int, message: str) -> bool:
-    """Telegram vasitəsilə bildiriş göndərir"""
+    """Telegram vasitəsilə bildiriş göndərir. Telegram API/şəbəkə xətasında False qaytarır,
+    digər xətalar (və CancelledError) çağırana ötürülür."""
     try:
-        await bot.send_message(chat_id=chat_id, text=message)
+        # Düz mətn: ad/FIN içindəki "<", "*" kimi simvollar parse xətası verməsin
+        await bot.send_message(chat_id=chat_id, text=message, parse_mode=None)
         return True
-    except Exception as e:
-        logger.error(f"Telegram bildirişi göndərilmədi {chat_id}: {e}")
+    except TelegramAPIError as e:
+        logger.error("Telegram bildirişi göndərilmədi %s: %s", chat_id, e)
         return False
 
 
@@ -27,15 +62,8 @@ async def notify_call_center(bot: Bot, admin_id: int, message: str, user_phone:
 
 async def notify_registration_complete(bot: Bot, admin_id: int, user_name: str, user_phone: str, user_fin: str, code: str) -> None:
     """Qeydiyyat tamamlandıqda admin-ə bildiriş"""
-    message = (
-        f"✅ Yeni qeydiyyat:\n\n"
-        f"👤 Ad: {user_name}\n"
-        f"🆔 FIN: {user_fin}\n"
-        f"📞 Telefon: {user_phone}\n"
-        f"📋 Kod: {code}\n"
-        f"📅 Tarix: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    )
     if admin_id != 0:
+        message = _REG_TMPL(user_name, user_fin, user_phone, code, _now_str())
         await send_telegram_notification(bot, admin_id, message)
 
 
@@ -49,22 +77,12 @@ async def notify_rule_violation(
     details: str
 ) -> None:
     """Qayda pozuntusu zamanı bildiriş göndərir"""
-    message = (
-        f"⚠️ Qayda pozuntusu:\n\n"
-        f"👤 İstifadəçi: {user_name} (ID: {user_id})\n"
-        f"📞 Telefon: {user_phone or 'Yoxdur'}\n"
-        f"🔴 Pozuntunun növü: {violation_type}\n"
-        f"📝 Detallar: {details}"
-    )
-    
-    # İstifadəçiyə bildiriş
-    try:
-        await send_telegram_notification(bot, user_id, 
-            f"⚠️ Xəbərdarlıq\n\n{violation_type}\n\n{details}")
-    except Exception:
-        pass
-    
-    # Admin və çağrı mərkəzinə bildiriş
+    # İstifadəçiyə və admin/çağrı mərkəzinə bildiriş paralel gedir
+    sends = [send_telegram_notification(bot, user_id, _WARNING_TMPL(violation_type, details))]
     if admin_id != 0:
-        await notify_call_center(bot, admin_id, message, user_phone)
+        message = _VIOLATION_TMPL(user_name, user_id, user_phone or 'Yoxdur', violation_type, details)
+        sends.append(notify_call_center(bot, admin_id, message, user_phone))
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error("Qayda pozuntusu bildirişi göndərilmədi", exc_info=result)
 
@@ -1,9 +1,9 @@
 """
 Hesabat funksiyaları - qayda yoxlamaları və formatlar
 """
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
-from utils.distance import haversine_m
+import functools
+from typing import NamedTuple, Optional, Tuple
+from utils.distance import farther_than_m, haversine_m, within_radius_m
 
 
 # Qayda konstantaları (main_aiogram.py-dən import olunacaq)
@@ -16,7 +16,57 @@ WORKPLACE_RADIUS_M = 100
 LOCATION_TOLERANCE_M = 50
 
 
-def check_rules_violation(
+class RulesConfig(NamedTuple):
+    """Qayda yoxlamasının həddləri (bir obyekt kimi ötürülür və keş açarına daxildir)."""
+    checkin_deadline: int = 11
+    checkout_deadline: int = 19
+    min_work_hours: float = 3.0
+    workplace_lat: float = 40.4093
+    workplace_lon: float = 49.8671
+    workplace_radius: float = 100.0
+    location_tolerance: float = 50.0
+
+
+RULES = RulesConfig()
+
+# Pozuntu strukturlaşdırılmış tuple kimi saxlanılır: (açar, *dəyərlər).
+# Mətn yalnız göstəriləndə render_violations ilə qurulur.
+Violation = Tuple
+
+_RENDERERS = {
+    "inactive": lambda: "Kursdan çıxarılıb",
+    "no_checkin": lambda: "Giriş yoxdur",
+    "late_in": lambda deadline, t: f"Giriş {deadline}:00-dan sonra ({t})",
+    "late_out": lambda deadline, t: f"Çıxış {deadline}:00-dan sonra ({t})",
+    "short_shift": lambda duration, min_hours: f"Minimum iş müddəti pozulub ({duration:.1f} saat < {min_hours} saat)",
+    "moved": lambda dist, tol: f"Çıxış fərqli yerdə ({int(dist)}m > {tol}m)",
+}
+
+
+def render_violations(violations) -> list[str]:
+    """Pozuntu tuple-larını istifadəçiyə göstərilən mətnlərə çevirir."""
+    return [_RENDERERS[v[0]](*v[1:]) for v in violations]
+
+
+def _parse_hms(value) -> Optional[int]:
+    """"HH:MM[:SS]" -> gün əvvəlindən saniyə; format uyğun deyilsə None (strptime sərhədləri ilə)."""
+    if not isinstance(value, str):
+        return None
+    parts = value.split(':')
+    if not 2 <= len(parts) <= 3:
+        return None
+    for part in parts:
+        if not (0 < len(part) <= 2 and part.isdecimal()):
+            return None
+    h = int(parts[0])
+    m = int(parts[1])
+    sec = int(parts[2]) if len(parts) == 3 else 0
+    if h > 23 or m > 59 or sec > 59:
+        return None
+    return h * 3600 + m * 60 + sec
+
+
+def _check_rules(
     giris_time: Optional[str],
     cixis_time: Optional[str],
     giris_lat: Optional[float],
@@ -24,77 +74,68 @@ def check_rules_violation(
     cixis_lat: Optional[float],
     cixis_lon: Optional[float],
     is_active: int = 1,
-    checkin_deadline: int = 11,
-    checkout_deadline: int = 19,
-    min_work_hours: float = 3.0,
-    workplace_lat: float = 40.4093,
-    workplace_lon: float = 49.8671,
-    workplace_radius: float = 100.0,
-    location_tolerance: float = 50.0
-) -> Tuple[str, list[str]]:
-    """
-    Qayda pozuntularını yoxlayır.
-    Returns: (status, violations)
-    status: "ok" (yaşıl), "violation" (qırmızı), "inactive" (boz)
-    violations: pozuntuların siyahısı
-    """
+    cfg: RulesConfig = RULES,
+) -> Tuple[str, Tuple[Violation, ...]]:
+    """check_rules_violation-un təmiz hissəsi; pozuntular tuple kimi qaytarılır (keşdə paylaşıla bilsin)."""
+    # Burada mətn qurulmur - yalnız açar və dəyərlər; statistika üçün sayılan sətirlər render olunmur
     violations = []
     
     # Kursdan çıxarılanlar
     if is_active == 0:
-        return ("inactive", ["Kursdan çıxarılıb"])
+        return ("inactive", (("inactive",),))
     
     # Giriş yoxdursa
     if not giris_time:
-        return ("violation", ["Giriş yoxdur"])
+        return ("violation", (("no_checkin",),))
     
+    # Həddlər bir UNPACK ilə lokal dəyişənlərə (dörd ayrı atribut oxunuşundan ucuz)
+    checkin_deadline, checkout_deadline, min_work_hours, _, _, _, location_tolerance = cfg
+
     try:
-        # Giriş vaxtını parse et
-        if isinstance(giris_time, str):
+        # Vaxtlar bir dəfə saniyəyə çevrilir; saat yoxlamaları və müddət tam ədədlərlə gedir.
+        # Düzgün formatda olmayan vaxtlar üçün köhnə split yolu saxlanılıb.
+        gsec = _parse_hms(giris_time)
+        if gsec is not None:
+            giris_hour = gsec // 3600
+        elif isinstance(giris_time, str):
             # Format: HH:MM:SS və ya HH:MM
             time_parts = giris_time.split(':')
-            if len(time_parts) >= 2:
-                giris_hour = int(time_parts[0])
-                # Qayda: Giriş deadline-a qədər
-                if giris_hour >= checkin_deadline:
-                    violations.append(f"Giriş {checkin_deadline}:00-dan sonra ({giris_time})")
+            giris_hour = int(time_parts[0]) if len(time_parts) >= 2 else None
+        else:
+            giris_hour = None
+        # Qayda: Giriş deadline-a qədər
+        if giris_hour is not None and giris_hour >= checkin_deadline:
+            violations.append(("late_in", checkin_deadline, giris_time))
+        
+        # Çıxış yoxdursa qalan yoxlamalar (müddət, lokasiya) tətbiq olunmur - dərhal qayıt
+        if not cixis_time:
+            return ("violation", tuple(violations)) if violations else ("ok", ())
         
-        # Çıxış varsa, yoxla
-        if cixis_time:
+        # Çıxış qaydaları
+        csec = _parse_hms(cixis_time)
+        if csec is not None:
+            cixis_hour = csec // 3600
+        else:
             time_parts = cixis_time.split(':')
-            if len(time_parts) >= 2:
-                cixis_hour = int(time_parts[0])
-                # Qayda: Çıxış deadline-a qədər
-                if cixis_hour >= checkout_deadline:
-                    violations.append(f"Çıxış {checkout_deadline}:00-dan sonra ({cixis_time})")
-            
-            # Minimum iş müddəti yoxla
-            try:
-                giris_dt = datetime.strptime(giris_time, "%H:%M:%S")
-            except:
-                try:
-                    giris_dt = datetime.strptime(giris_time, "%H:%M")
-                except:
-                    giris_dt = None
-            
-            try:
-                cixis_dt = datetime.strptime(cixis_time, "%H:%M:%S")
-            except:
-                try:
-                    cixis_dt = datetime.strptime(cixis_time, "%H:%M")
-                except:
-                    cixis_dt = None
-            
-            if giris_dt and cixis_dt:
-                duration = (cixis_dt - giris_dt).total_seconds() / 3600.0
-                if duration < min_work_hours:
-                    violations.append(f"Minimum iş müddəti pozulub ({duration:.1f} saat < {min_work_hours} saat)")
-            
-            # Lokasiya yoxlaması - çıxış girişdən fərqli yerdədirsə
-            if giris_lat is not None and giris_lon is not None and cixis_lat is not None and cixis_lon is not None:
-                dist = haversine_m(float(giris_lat), float(giris_lon), float(cixis_lat), float(cixis_lon))
-                if dist > location_tolerance:
-                    violations.append(f"Çıxış fərqli yerdə ({int(dist)}m > {location_tolerance}m)")
+            cixis_hour = int(time_parts[0]) if len(time_parts) >= 2 else None
+        # Qayda: Çıxış deadline-a qədər
+        if cixis_hour is not None and cixis_hour >= checkout_deadline:
+            violations.append(("late_out", checkout_deadline, cixis_time))
+        
+        # Minimum iş müddəti yoxla
+        if gsec is not None and csec is not None:
+            duration = (csec - gsec) / 3600.0
+            if duration < min_work_hours:
+                violations.append(("short_shift", duration, min_work_hours))
+        
+        # Lokasiya yoxlaması - çıxış girişdən fərqli yerdədirsə
+        if giris_lat is not None and giris_lon is not None and cixis_lat is not None and cixis_lon is not None:
+            # Əksər sətirlər eyni yerdədir - dəqiq yoxlama yalnız sürətli yoxlama əmin olmayanda;
+            # metr dəyəri (mesaj üçün) yalnız pozuntu olanda hesablanır
+            if (not within_radius_m(giris_lat, giris_lon, cixis_lat, cixis_lon, location_tolerance)
+                    and farther_than_m(giris_lat, giris_lon, cixis_lat, cixis_lon, location_tolerance)):
+                dist = haversine_m(giris_lat, giris_lon, cixis_lat, cixis_lon)
+                violations.append(("moved", dist, location_tolerance))
         
         # İş yeri mərkəzinə görə yoxlama deaktiv edilib
         
@@ -103,27 +144,58 @@ def check_rules_violation(
         pass
     
     if violations:
-        return ("violation", violations)
+        return ("violation", tuple(violations))
     else:
-        return ("ok", [])
+        return ("ok", ())
+
+
+# Eyni (vaxt, vaxt, koordinat) dəstləri hesabatlarda təkrarlanır (xüsusilə giriş yoxdur/deaktiv sətirlər)
+_check_rules_cached = functools.lru_cache(maxsize=8192)(_check_rules)
+
+
+def check_rules_violation(
+    giris_time: Optional[str],
+    cixis_time: Optional[str],
+    giris_lat: Optional[float],
+    giris_lon: Optional[float],
+    cixis_lat: Optional[float],
+    cixis_lon: Optional[float],
+    is_active: int = 1,
+    cfg: RulesConfig = RULES,
+) -> Tuple[str, list[Violation]]:
+    """
+    Qayda pozuntularını yoxlayır.
+    Returns: (status, violations)
+    status: "ok" (yaşıl), "violation" (qırmızı), "inactive" (boz)
+    violations: (açar, *dəyərlər) tuple-larının siyahısı; mətn üçün render_violations
+    Koordinatlar float (və ya None) gəlməlidir - çevrilmə sətir oxunanda bir dəfə edilir.
+    """
+    args = (giris_time, cixis_time, giris_lat, giris_lon, cixis_lat, cixis_lon, is_active, cfg)
+    try:
+        status, violations = _check_rules_cached(*args)
+    except TypeError:
+        # Hash olunmayan dəyər (gözlənilmir) - keşsiz yoxlanılır
+        status, violations = _check_rules(*args)
+    return (status, list(violations))
+
+
+_STATUS_COLORS = {
+    "ok": "00FF00",  # Yaşıl
+    "violation": "FF0000",  # Qırmızı
+    "inactive": "808080",  # Boz
+}
+_STATUS_NAMES = {
+    "ok": "Qaydalara uyğundur",
+    "violation": "Qayda pozuntusu",
+    "inactive": "Kursdan çıxarılıb",
+}
 
 
 def get_status_color(status: str) -> str:
     """Status-a görə rəng hex kodu qaytarır"""
-    colors = {
-        "ok": "00FF00",  # Yaşıl
-        "violation": "FF0000",  # Qırmızı
-        "inactive": "808080",  # Boz
-    }
-    return colors.get(status, "FFFFFF")
+    return _STATUS_COLORS.get(status, "FFFFFF")
 
 
 def get_status_name(status: str) -> str:
     """Status-a görə ad qaytarır"""
-    names = {
-        "ok": "Qaydalara uyğundur",
-        "violation": "Qayda pozuntusu",
-        "inactive": "Kursdan çıxarılıb",
-    }
-    return names.get(status, "Naməlum")
-
+    return _STATUS_NAMES.get(status, "Naməlum")